@@ -4,6 +4,34 @@ import sys
 sys.path.append('../')
 from utils.util import load_checkpoint
 
+#################################################################################################################################
+# Encoder pass over packed rows (see src/batching.py PackingCollator): positions restart at every example and a token only
+# attends to the tokens of its own example (block-diagonal attention). Returns the encoder states of every example, gathered
+# back into one row per example (examples, longest example, d_model), to be used with the per-example attention_mask.
+# Layers are dropped (encoder.layerdrop) and masked (head_mask) as in BartEncoder.forward; only the last hidden states are
+# returned, packed batches are training batches.
+#################################################################################################################################
+def packed_encoder_outputs(encoder, input_ids, segment_ids, position_ids, example_index, head_mask=None):
+    ## older BartEncoders scale the token embeddings themselves, newer ones use a scaled embedding
+    inputs_embeds = encoder.embed_tokens(input_ids) * getattr(encoder, 'embed_scale', 1.0)
+    hidden_states = inputs_embeds + encoder.embed_positions.weight[position_ids + encoder.embed_positions.offset]
+    hidden_states = encoder.layernorm_embedding(hidden_states)
+    hidden_states = nn.functional.dropout(hidden_states, p=encoder.dropout, training=encoder.training)
+
+    # (rows, 1, width, width), 0 inside an example's block, dtype min elsewhere
+    blocks = segment_ids[:, :, None] == segment_ids[:, None, :]
+    attention_mask = torch.zeros(blocks.shape, dtype=hidden_states.dtype, device=hidden_states.device)
+    attention_mask = attention_mask.masked_fill(~blocks, torch.finfo(hidden_states.dtype).min)[:, None]
+
+    for idx, encoder_layer in enumerate(encoder.layers):
+        # add LayerDrop (see https://arxiv.org/abs/1909.11556 for description)
+        if encoder.training and torch.rand([]) < encoder.layerdrop:
+            continue
+        layer_outputs = encoder_layer(hidden_states, attention_mask, layer_head_mask=(head_mask[idx] if head_mask is not None else None))
+        hidden_states = layer_outputs[0] if isinstance(layer_outputs, tuple) else layer_outputs
+
+    return BaseModelOutput(last_hidden_state=hidden_states.reshape(-1, hidden_states.size(-1))[example_index])
+
 #################################################################################################################################
 class BartModel_DualDecoder(BartPretrainedModel):
     def __init__(self, config: BartConfig):
@@ -259,14 +287,24 @@ class BartForConditionalGeneration_DualDecoder(BartPretrainedModel):
         output_attentions=None,
         output_hidden_states=None,
         return_dict=None,
+        segment_ids=None,
+        position_ids=None,
+        example_index=None,
     ):
         r"""
         labels (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
             Labels for computing the masked language modeling loss. Indices should either be in `[0, ..., config.vocab_size]` or -100 (see `input_ids` docstring). Tokens with indices set to `-100` are ignored
             (masked), the loss is only computed for the tokens with labels in `[0, ..., config.vocab_size]`.
+        segment_ids, position_ids, example_index (`torch.LongTensor`, *optional*):
+            Packed training batch, see `packed_encoder_outputs`.
         Returns:
         """
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+
+        # Train with packed encoder rows
+        if segment_ids is not None:
+            encoder_outputs = packed_encoder_outputs(self.get_encoder(), input_ids, segment_ids, position_ids, example_index, head_mask)
+            input_ids = None
         
         # Train, Validation
         if labels is not None:
@@ -428,6 +466,32 @@ class BartForConditionalGeneration_DualDecoder(BartPretrainedModel):
         return reordered_past
 
 
+#################################################################################################################################
+class BartForConditionalGeneration_Packed(BartForConditionalGeneration):
+    # BartForConditionalGeneration that also accepts packed training batches (see packed_encoder_outputs)
+    def forward(
+        self,
+        input_ids=None,
+        attention_mask=None,
+        labels=None,
+        encoder_outputs=None,
+        segment_ids=None,
+        position_ids=None,
+        example_index=None,
+        **kwargs
+    ):
+        if segment_ids is not None:
+            encoder_outputs = packed_encoder_outputs(self.get_encoder(), input_ids, segment_ids, position_ids, example_index, kwargs.get('head_mask'))
+            input_ids = None
+        return super().forward(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            labels=labels,
+            encoder_outputs=encoder_outputs,
+            **kwargs
+        )
+
+
 #################################################################################################################################
 class BartForConditionalGeneration_DualHead(BartPretrainedModel):
     base_model_prefix = "model"
@@ -0,0 +1,111 @@
+import os
+import glob
+import hashlib
+import numpy as np
+from datasets import Dataset as ArrowDataset
+
+
+#####################################################################################
+# Alternative construction of a split as a `datasets` Arrow dataset. Both stages run as
+# batched datasets.map calls over num_proc processes:
+#   texts:  augmentation (commonsense injection, emotion tagging, media message rewriting),
+#           i.e. the text of every field as CommonsenseDataset.get_texts builds it
+#   tokens: batched tokenization of those texts
+# Each stage is fingerprinted with the cache key of the split, and its Arrow file is
+# written to arrow_dir, so that a re-run with the same configuration loads it back.
+# The result is given to the Seq2SeqTrainer like the torch datasets.
+#####################################################################################
+
+
+def stage_path(dataset, arrow_dir, stage, fingerprint):
+    return os.path.join(arrow_dir, f"{dataset.dataset_name}_{dataset.split_type}_{fingerprint}_{stage}.arrow")
+
+
+def is_cached(path):
+    ## written by a single process, or by every one of the num_proc processes of an earlier run
+    if os.path.exists(path):
+        return True
+    prefix, ext = os.path.splitext(path)
+    shards = glob.glob(f"{prefix}_*_of_*{ext}")
+    for num_proc in {int(shard[len(prefix):-len(ext)].split('_of_')[1]) for shard in shards}:
+        if all(os.path.exists(f"{prefix}_{rank:05d}_of_{num_proc:05d}{ext}") for rank in range(num_proc)):
+            return True
+    return False
+
+
+def build_texts(batch, dataset):
+    texts = {}
+    for index in batch['index']:
+        for field, text in dataset.get_texts(index).items():
+            texts.setdefault(field, []).append(text)
+    return texts
+
+
+def tokenize_texts(batch, dataset):
+    model_inputs = {}
+    for field in dataset.text_fields():
+        encoded = dataset.tokenizer(batch[field],
+                                    padding=False if dataset.dynamic_padding else 'max_length',
+                                    truncation=True,
+                                    max_length=dataset.max_length(field))
+        model_inputs[field] = encoded['input_ids']
+        if field == 'input_ids':
+            model_inputs['attention_mask'] = encoded['attention_mask']
+    return model_inputs
+
+
+def build_arrow_dataset(dataset, arrow_dir, num_proc=1, batch_size=64):
+    ###########################################################
+    # dataset: SamsumDataset / DialogsumDataset / TweetsummDataset
+    # returns the same examples as dataset[index], as torch tensors
+    ###########################################################
+    os.makedirs(arrow_dir, exist_ok=True)
+    fields = dataset.text_fields()
+    ids = hashlib.sha1('\n'.join(map(str, dataset.id)).encode()).hexdigest()
+    texts_fingerprint = dataset.cache_key(stage='texts',
+                                          extra_context=dataset.extra_context,
+                                          extra_supervision=dataset.extra_supervision,
+                                          supervision_relation=dataset.supervision_relation,
+                                          summary_sources=[(path, os.path.getmtime(path), os.path.getsize(path)) for path in dataset.summary_source_files],
+                                          ids=ids)
+    tokens_fingerprint = dataset.token_key(stage='tokens', dynamic_padding=dataset.dynamic_padding)
+    texts_path = stage_path(dataset, arrow_dir, 'texts', texts_fingerprint)
+
+    if not is_cached(texts_path) and dataset.extra_context==True:
+        ## what is computed once for the whole split is computed before the workers are started
+        dataset.prefetch_best_relations(range(dataset.data_len))
+        if dataset.needs_sentence_segments() and dataset.segments is None:
+            dataset.segments = dataset.split_sentences()
+        if dataset.emotion==True and dataset.emotion_dir and dataset.emotion_store is None:
+            dataset.emotion_store = dataset.build_emotion_store()
+
+    indices = ArrowDataset.from_dict({'index': list(range(dataset.data_len))})
+    texts = indices.map(build_texts,
+                        batched=True,
+                        batch_size=batch_size,
+                        fn_kwargs={'dataset': dataset},
+                        remove_columns=['index'],
+                        num_proc=num_proc if num_proc > 1 else None,
+                        cache_file_name=texts_path,
+                        load_from_cache_file=True,
+                        new_fingerprint=texts_fingerprint,
+                        desc=f"Augmenting {dataset.dataset_name} {dataset.split_type}")
+    tokens = texts.map(tokenize_texts,
+                       batched=True,
+                       batch_size=batch_size * 16,
+                       fn_kwargs={'dataset': dataset},
+                       remove_columns=fields,
+                       num_proc=num_proc if num_proc > 1 else None,
+                       cache_file_name=stage_path(dataset, arrow_dir, 'tokens', tokens_fingerprint),
+                       load_from_cache_file=True,
+                       new_fingerprint=tokens_fingerprint,
+                       desc=f"Tokenizing {dataset.dataset_name} {dataset.split_type}")
+    tokens.set_format('torch', columns=['input_ids', 'attention_mask'] + fields[1:])
+    return tokens
+
+
+def arrow_lengths(dataset, field='input_ids'):
+    ## token length of every example of an Arrow split, to bucket batches as CommonsenseDataset.lengths() does
+    if field == 'input_ids':
+        return np.array([sum(mask) for mask in dataset.with_format(None)['attention_mask']])
+    return np.array([len(ids) for ids in dataset.with_format(None)[field]])
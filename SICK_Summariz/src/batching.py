@@ -0,0 +1,296 @@
+import math
+import random
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+#####################################################################################
+# Dynamic padding: datasets built with dynamic_padding=True return unpadded examples,
+# the collator pads each batch only up to its longest example and the batch samplers
+# group examples of similar length so that little padding is left.
+#####################################################################################
+
+
+class DynamicPaddingCollator:
+    """
+    Pads a list of unpadded examples to the longest one of the batch.
+    input_ids are padded with pad_token_id, attention_mask with 0 and every label field
+    with label_pad_token_id (pad_token_id by default, as with max_length padding).
+    """
+    def __init__(self, pad_token_id, label_pad_token_id=None, pad_to_multiple_of=None):
+        self.pad_token_id = pad_token_id
+        self.label_pad_token_id = pad_token_id if label_pad_token_id is None else label_pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def padding_value(self, field):
+        if field == 'input_ids':
+            return self.pad_token_id
+        if field == 'attention_mask':
+            return 0
+        return self.label_pad_token_id
+
+    def __call__(self, features):
+        batch = {}
+        for field in features[0]:
+            values = [feature[field] for feature in features]
+            if not torch.is_tensor(values[0]):
+                batch[field] = values
+                continue
+            max_len = max(len(value) for value in values)
+            if self.pad_to_multiple_of:
+                max_len = int(math.ceil(max_len / self.pad_to_multiple_of) * self.pad_to_multiple_of)
+            padded = torch.full((len(values), max_len), self.padding_value(field), dtype=torch.long)
+            for i, value in enumerate(values):
+                padded[i, :len(value)] = value
+            batch[field] = padded
+        return batch
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batches of examples with similar lengths.
+    With shuffle=True the examples are shuffled, cut into buckets of batch_size*bucket_size_multiplier,
+    sorted by length inside each bucket and batched, and the batch order is shuffled again, so every
+    epoch sees different batches. With shuffle=False the examples are simply batched in length order.
+    """
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size_multiplier=100, drop_last=False, seed=0, indices=None):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.indices = list(range(len(lengths))) if indices is None else list(indices)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        indices = list(self.indices)
+        if not self.shuffle:
+            indices.sort(key=lambda index: self.lengths[index], reverse=True)
+            return [indices[start:start + self.batch_size] for start in range(0, len(indices), self.batch_size)]
+
+        rng = random.Random(self.seed + self.epoch)
+        rng.shuffle(indices)
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(indices[start:start + self.bucket_size], key=lambda index: self.lengths[index])
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+        rng.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        batches = self.batches()
+        ## the next pass over the data is bucketed differently even if set_epoch is never called
+        self.epoch += 1
+        for batch in batches:
+            if self.drop_last and len(batch) < self.batch_size:
+                continue
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.indices) // self.batch_size
+        return int(math.ceil(len(self.indices) / self.batch_size))
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    Batches holding at most max_tokens tokens once padded, counted over every field given in
+    lengths (e.g. input_ids, labels and extra_labels lengths): a batch of n examples costs
+    n * (longest input + longest label + ...), so batches of short dialogues hold more examples.
+    With shuffle=True the examples are shuffled, cut into buckets of bucket_size examples, sorted by
+    length inside each bucket and batched once; every epoch then shuffles the order of these batches.
+    The batches are formed once so that their number does not change between epochs: the Trainer
+    computes max_steps and the learning rate schedule from the first len(dataloader).
+    """
+    def __init__(self, lengths, max_tokens, shuffle=True, bucket_size=2000, seed=0, indices=None):
+        self.lengths = [np.asarray(field_lengths) for field_lengths in lengths]
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.epoch = 0
+        self.indices = list(range(len(self.lengths[0]))) if indices is None else list(indices)
+        self.fixed = self.form_batches()
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def fill(self, indices):
+        ## greedy batches of length-sorted indices, an example alone over the budget gets its own batch
+        batches = []
+        batch = []
+        longest = np.zeros(len(self.lengths), dtype=np.int64)
+        for index in indices:
+            candidate = np.maximum(longest, [field_lengths[index] for field_lengths in self.lengths])
+            if batch and (len(batch) + 1) * int(candidate.sum()) > self.max_tokens:
+                batches.append(batch)
+                batch = []
+                candidate = np.array([field_lengths[index] for field_lengths in self.lengths])
+            batch.append(index)
+            longest = candidate
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def form_batches(self):
+        indices = list(self.indices)
+        if not self.shuffle:
+            indices.sort(key=lambda index: self.lengths[0][index], reverse=True)
+            return self.fill(indices)
+        random.Random(self.seed).shuffle(indices)
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(indices[start:start + self.bucket_size], key=lambda index: self.lengths[0][index])
+            batches.extend(self.fill(bucket))
+        return batches
+
+    def batches(self):
+        batches = list(self.fixed)
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        batches = self.batches()
+        ## the next pass over the data sees the batches in another order even if set_epoch is never called
+        self.epoch += 1
+        for batch in batches:
+            yield batch
+
+    def __len__(self):
+        return len(self.fixed)
+
+
+#####################################################################################
+# Sequence packing: several short training dialogues share one encoder row of
+# max_length tokens. Positions restart at every dialogue and each token only attends
+# to the tokens of its own dialogue (block-diagonal attention, see
+# models.bart.packed_encoder_outputs); every dialogue keeps its own decoder targets.
+#####################################################################################
+
+
+def pack(lengths, max_length):
+    ## first fit, in the given order: rows of example positions whose lengths add up to at most max_length
+    rows = []
+    free = []
+    for position, length in enumerate(lengths):
+        for row, space in enumerate(free):
+            if length <= space:
+                rows[row].append(position)
+                free[row] -= length
+                break
+        else:
+            rows.append([position])
+            free.append(max_length - length)
+    return rows
+
+
+class PackingCollator:
+    """
+    Packs a list of unpadded examples (datasets built with dynamic_padding=True) into rows of at most max_length tokens.
+    The batch holds the packed encoder rows:
+        input_ids, segment_ids (1, 2, ... for the examples of a row, 0 for padding), position_ids (restarting at every example)
+    and, per example, in the order of the features:
+        example_index (position of each of its tokens in the flattened rows), attention_mask, labels, extra_labels, ...
+    """
+    def __init__(self, pad_token_id, max_length, label_pad_token_id=None):
+        self.pad_token_id = pad_token_id
+        self.max_length = max_length
+        self.padding = DynamicPaddingCollator(pad_token_id, label_pad_token_id)
+
+    def __call__(self, features):
+        lengths = [len(feature['input_ids']) for feature in features]
+        rows = pack(lengths, self.max_length)
+        width = max(sum(lengths[position] for position in row) for row in rows)
+        input_ids = torch.full((len(rows), width), self.pad_token_id, dtype=torch.long)
+        segment_ids = torch.zeros((len(rows), width), dtype=torch.long)
+        position_ids = torch.zeros((len(rows), width), dtype=torch.long)
+        example_index = torch.zeros((len(features), max(lengths)), dtype=torch.long)
+        attention_mask = torch.zeros((len(features), max(lengths)), dtype=torch.long)
+        for r, row in enumerate(rows):
+            start = 0
+            for segment, position in enumerate(row, 1):
+                length = lengths[position]
+                input_ids[r, start:start + length] = features[position]['input_ids']
+                segment_ids[r, start:start + length] = segment
+                position_ids[r, start:start + length] = torch.arange(length)
+                example_index[position, :length] = r * width + start + torch.arange(length)
+                attention_mask[position, :length] = 1
+                start += length
+
+        batch = self.padding([{field: value for field, value in feature.items() if field not in ('input_ids', 'attention_mask')}
+                              for feature in features])
+        batch.update({'input_ids': input_ids,
+                      'segment_ids': segment_ids,
+                      'position_ids': position_ids,
+                      'example_index': example_index,
+                      'attention_mask': attention_mask})
+        return batch
+
+
+class PackedBatchSampler(Sampler):
+    """
+    Batches of as many examples as fit, packed with pack(), into rows_per_batch rows of max_length tokens.
+    The examples are packed once, shuffled with the seed (shuffle=True) or in length order (shuffle=False),
+    and every epoch shuffles the order of the batches, so that len() is the same every epoch (as for
+    TokenBudgetBatchSampler).
+    """
+    def __init__(self, lengths, max_length, rows_per_batch, shuffle=True, seed=0, indices=None):
+        self.lengths = lengths
+        self.max_length = max_length
+        self.rows_per_batch = rows_per_batch
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.indices = list(range(len(lengths))) if indices is None else list(indices)
+        self.fixed = self.form_batches()
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def form_batches(self):
+        indices = list(self.indices)
+        if self.shuffle:
+            random.Random(self.seed).shuffle(indices)
+        else:
+            indices.sort(key=lambda index: self.lengths[index], reverse=True)
+        batches = []
+        batch = []
+        free = []
+        for index in indices:
+            length = min(int(self.lengths[index]), self.max_length)
+            ## same first fit as pack(), so the collator packs the batch into the same rows
+            row = next((row for row, space in enumerate(free) if length <= space), None)
+            if row is None and len(free) == self.rows_per_batch:
+                batches.append(batch)
+                batch = []
+                free = []
+            if row is None:
+                free.append(self.max_length - length)
+            else:
+                free[row] -= length
+            batch.append(index)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def batches(self):
+        batches = list(self.fixed)
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        batches = self.batches()
+        ## the next pass over the data sees the batches in another order even if set_epoch is never called
+        self.epoch += 1
+        for batch in batches:
+            yield batch
+
+    def __len__(self):
+        return len(self.fixed)
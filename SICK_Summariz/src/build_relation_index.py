@@ -0,0 +1,128 @@
+# Build the best relation index of COMET / PARACOMET files once, instead of scoring the relations inside the datasets.
+# python build_relation_index.py --input ../data/COMET_data/comet/dialogue/samsum/comet_train.json --strip_sentence
+# python build_relation_index.py --input ../data/COMET_data/paracomet/dialogue/dialogsum/dialog_train_split5_collated.json --paracomet
+# SamsumDataset strips the utterances before scoring them (--strip_sentence), DialogsumDataset does not.
+import os
+import json
+import argparse
+import multiprocessing
+import numpy as np
+from relation_scorer import COMET_RELATIONS, PARACOMET_RELATIONS, BestRelationScorer, relation_index_path
+from storage import write_atomic
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input', type=str, nargs='+', required=True) #COMET / PARACOMET dialogue files
+parser.add_argument('--paracomet', action='store_true') #PARACOMET files, keyed by sentence index
+parser.add_argument('--scoring', type=str, default='token') #token: cosine of the token ids (as the datasets do), embedding: cosine of sentence embeddings
+parser.add_argument('--tokenizer', type=str, default='facebook/bart-large') #token scoring, must be the tokenizer of the model that will be trained
+parser.add_argument('--encoder_max_len', type=int, default=1024) #token scoring
+parser.add_argument('--embedding_model', type=str, default='sentence-transformers/all-MiniLM-L6-v2') #embedding scoring
+parser.add_argument('--strip_sentence', action='store_true') #strip the utterances before scoring, as SamsumDataset does
+parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+parser.add_argument('--dialogues_per_task', type=int, default=64)
+
+
+def utterances(dialogue):
+    ## PARACOMET dialogues are dicts keyed by sentence index, COMET dialogues are lists
+    return list(dialogue.values()) if isinstance(dialogue, dict) else dialogue
+
+
+def candidates(dialogue, relations, strip_sentence):
+    ## (utterance, relations) of every utterance, None when a relation is missing
+    pairs = []
+    for sent in utterances(dialogue):
+        if all(len(sent.get(relation, [])) > 0 for relation in relations):
+            sentence = sent['sentence'].strip() if strip_sentence else sent['sentence']
+            pairs.append((sentence, {relation: sent[relation][:1] for relation in relations}))
+        else:
+            pairs.append(None)
+    return pairs
+
+
+def encode(relations, best):
+    return ''.join('-' if relation is None else str(relations.index(relation)) for relation in best)
+
+
+###########################################################
+# token scoring: one tokenizer per worker process
+###########################################################
+_scorer = None
+
+
+def init_worker(tokenizer_name, max_length, relations):
+    global _scorer
+    from transformers import AutoTokenizer
+    _scorer = BestRelationScorer(AutoTokenizer.from_pretrained(tokenizer_name), max_length, relations)
+
+
+def score_dialogues(task):
+    _scorer.score([pair for _, pairs in task for pair in pairs if pair is not None])
+    return [(key, encode(_scorer.relations, [None if pair is None else _scorer.best_relation(*pair) for pair in pairs]))
+            for key, pairs in task]
+
+
+def token_index(dialogues, args, relations):
+    tasks = [dialogues[start:start + args.dialogues_per_task] for start in range(0, len(dialogues), args.dialogues_per_task)]
+    index = {}
+    with multiprocessing.Pool(args.num_workers, initializer=init_worker, initargs=(args.tokenizer, args.encoder_max_len, relations)) as pool:
+        for done, results in enumerate(pool.imap(score_dialogues, tasks), 1):
+            index.update(results)
+            if done % 50 == 0 or done == len(tasks):
+                print(f"scored {min(done * args.dialogues_per_task, len(dialogues))}/{len(dialogues)} dialogues")
+    return index
+
+
+###########################################################
+# embedding scoring: the model batches the unique texts itself
+###########################################################
+def embedding_index(dialogues, args, relations):
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(args.embedding_model)
+    texts = list(dict.fromkeys(text for _, pairs in dialogues for pair in pairs if pair is not None
+                               for text in [pair[0]] + [pair[1][relation][0] for relation in relations]))
+    embeddings = model.encode(texts, batch_size=256, normalize_embeddings=True, show_progress_bar=True)
+    position = {text: i for i, text in enumerate(texts)}
+    index = {}
+    for key, pairs in dialogues:
+        best = []
+        for pair in pairs:
+            if pair is None:
+                best.append(None)
+                continue
+            sentence, d = pair
+            similarities = embeddings[[position[d[relation][0]] for relation in relations]] @ embeddings[position[sentence]]
+            best.append(relations[int(np.argmax(similarities))])
+        index[key] = encode(relations, best)
+    return index
+
+
+def build_index(path, args):
+    relations = PARACOMET_RELATIONS if args.paracomet else COMET_RELATIONS
+    with open(path) as f:
+        data = json.load(f)
+    dialogues = [(key, candidates(dialogue, relations, args.strip_sentence)) for key, dialogue in data.items()]
+    print(f"{path}: {len(dialogues)} dialogues, {sum(len(pairs) for _, pairs in dialogues)} utterances")
+    if args.scoring == 'token':
+        index = token_index(dialogues, args, relations)
+    elif args.scoring == 'embedding':
+        index = embedding_index(dialogues, args, relations)
+    else:
+        raise ValueError(f"Unknown scoring {args.scoring}")
+
+    output = relation_index_path(path, args.scoring)
+    with write_atomic(output) as f:
+        json.dump({'source': path,
+                   'scoring': args.scoring,
+                   'tokenizer': args.tokenizer if args.scoring == 'token' else args.embedding_model,
+                   'max_length': args.encoder_max_len,
+                   'strip_sentence': args.strip_sentence,
+                   'relations': list(relations),
+                   'dialogues': index}, f, separators=(',', ':'))
+    print(f"Best relation index written to {output}")
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    for path in args.input:
+        build_index(path, args)
@@ -0,0 +1,82 @@
+import os
+import torch
+from tqdm import tqdm
+from transformers import AutoConfig, AutoTokenizer, AutoModelForSeq2SeqLM
+from generation_cache import GenerationCache
+
+
+#####################################################################################
+# Batched COMET-ATOMIC 2020 generation, shared by the offline extraction of the COMET files
+# (processing_tweetsumm/comet_extraction.py) and the online augmentation of new dialogues
+# (online_augment.py): queries are sorted by token length so that each batch is padded to
+# about the same length, and the generations are looked up in / added to the cache of
+# generation_cache.py.
+#####################################################################################
+
+
+def query(sentence, relation):
+    return f"{sentence} {relation} [GEN]"
+
+
+def length_sorted(queries, tokenizer):
+    ## longest queries first, so that a batch running out of memory does it at once
+    if not queries:
+        return []
+    lengths = [len(ids) for ids in tokenizer(queries)['input_ids']]
+    return [queries[i] for i in sorted(range(len(queries)), key=lambda i: -lengths[i])]
+
+
+def length_sorted_batches(queries, tokenizer, batch_size):
+    queries = length_sorted(queries, tokenizer)
+    return [queries[start:start + batch_size] for start in range(0, len(queries), batch_size)]
+
+
+def decoding_params(model_path, num_generate=5):
+    ## everything the generations depend on besides the model and the query
+    params = dict((AutoConfig.from_pretrained(model_path).task_specific_params or {}).get('summarization', {}))
+    params.update(decode_method='beam', num_beams=num_generate, num_return_sequences=num_generate)
+    return params
+
+
+def open_cache(path, model_path, num_generate=5, max_mb=2048, model_id=None):
+    model_id = model_id or os.path.basename(os.path.normpath(model_path))
+    return GenerationCache(path, model_id, decoding_params(model_path, num_generate), max_bytes=max_mb << 20)
+
+
+def cached_results(cache, queries):
+    ## query -> generations of the queries the cache has
+    if cache is None:
+        return {}
+    found = cache.get_many(queries.values())
+    results = {query: found[pair] for query, pair in queries.items() if pair in found}
+    print(f"{len(results)} of them found in {cache.path}")
+    return results
+
+
+class Comet:
+    """COMET-ATOMIC 2020 BART, generating as generation_example.Comet of the comet-atomic-2020 repository."""
+    def __init__(self, model_path, device='cpu'):
+        self.device = torch.device(device)
+        self.model = AutoModelForSeq2SeqLM.from_pretrained(model_path).to(self.device)
+        self.model.eval()
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        ## use_task_specific_params(model, "summarization") of the original class
+        self.generation_kwargs = dict((self.model.config.task_specific_params or {}).get('summarization', {}))
+
+    def generate(self, queries, decode_method="beam", num_generate=5):
+        ## num_generate generations of each query, in the order of queries
+        batch = self.tokenizer(queries, return_tensors="pt", truncation=True, padding=True).to(self.device)
+        kwargs = dict(self.generation_kwargs)
+        kwargs.update(num_beams=num_generate, num_return_sequences=num_generate)
+        with torch.no_grad():
+            summaries = self.model.generate(input_ids=batch['input_ids'], attention_mask=batch['attention_mask'], decoder_start_token_id=None, **kwargs)
+        dec = self.tokenizer.batch_decode(summaries, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+        return [dec[i:i + num_generate] for i in range(0, len(dec), num_generate)]
+
+
+def generate_all(comet, queries, batch_size=32, num_generate=5):
+    ## query -> its num_generate generations
+    results = {}
+    for batch in tqdm(length_sorted_batches(queries, comet.tokenizer, batch_size), desc="generating commonsense"):
+        results.update(zip(batch, comet.generate(batch, num_generate=num_generate)))
+    return results
@@ -0,0 +1,173 @@
+# Convert COMET / PARACOMET inference files (and their roberta / sentence_transformer variants) to an indexed SQLite store.
+# python comet_store.py --input ../data/COMET_data/comet/dialogue/samsum/comet_train.json ../data/COMET_data/comet/summary/samsum/comet_train_w.json
+# The datasets read <file>.sqlite instead of <file>.json as soon as it exists and is newer than the .json file.
+import os
+import json
+import sqlite3
+import argparse
+from collections.abc import Mapping
+from storage import atomic_path, select_in
+
+
+#####################################################################################
+# One row per dialogue, keyed by the top-level key of the .json file (dialogue id).
+# Every string of the file is stored once in the `strings` table, and the dialogue
+# records are the original JSON structure with each string replaced by its id (other
+# scalars, e.g. scores, are kept as their JSON text prefixed with "=").
+#####################################################################################
+
+
+class StringTable:
+    """
+    Interned commonsense strings: every distinct string is stored once and known by its id,
+    and its PersonX / PersonY normalized variant is computed once.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.texts = []
+        self.persons = []
+
+    def intern(self, text):
+        id = self.ids.get(text)
+        if id is None:
+            id = len(self.texts)
+            self.ids[text] = id
+            self.texts.append(text)
+            self.persons.append(None)
+        return id
+
+    def person(self, text):
+        ## text with PersonX / PersonY replaced by Person
+        id = self.intern(text)
+        if self.persons[id] is None:
+            self.persons[id] = self.texts[id].replace("PersonX","Person").replace("PersonY","Person")
+        return self.persons[id]
+
+
+## shared by every commonsense file of a process
+STRINGS = StringTable()
+
+
+def store_path(source):
+    return f"{os.path.splitext(source)[0]}.sqlite"
+
+
+def encode_record(obj, intern):
+    if isinstance(obj, str):
+        return intern(obj)
+    if isinstance(obj, list):
+        return [encode_record(item, intern) for item in obj]
+    if isinstance(obj, dict):
+        return {key: encode_record(value, intern) for key, value in obj.items()}
+    return "=" + json.dumps(obj)
+
+
+def decode_record(obj, strings):
+    if isinstance(obj, int):
+        return strings[obj]
+    if isinstance(obj, list):
+        return [decode_record(item, strings) for item in obj]
+    if isinstance(obj, dict):
+        return {key: decode_record(value, strings) for key, value in obj.items()}
+    return json.loads(obj[1:])
+
+
+def string_ids(obj, ids):
+    if isinstance(obj, int):
+        ids.add(obj)
+    elif isinstance(obj, list):
+        for item in obj:
+            string_ids(item, ids)
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            string_ids(value, ids)
+    return ids
+
+
+def convert(source, path=None):
+    ###########################################################
+    # .json -> .sqlite, written to a temporary file first
+    ###########################################################
+    path = path or store_path(source)
+    with open(source) as f:
+        data = json.load(f)
+
+    strings = {}
+    def intern(text):
+        if text not in strings:
+            strings[text] = len(strings)
+        return strings[text]
+
+    with atomic_path(path) as tmp_path:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        connection = sqlite3.connect(tmp_path)
+        connection.execute("CREATE TABLE records (key TEXT PRIMARY KEY, record TEXT NOT NULL)")
+        connection.execute("CREATE TABLE strings (id INTEGER PRIMARY KEY, text TEXT NOT NULL)")
+        connection.executemany("INSERT INTO records VALUES (?, ?)",
+                               ((key, json.dumps(encode_record(value, intern), separators=(',', ':'))) for key, value in data.items()))
+        connection.executemany("INSERT INTO strings VALUES (?, ?)", ((id, text) for text, id in strings.items()))
+        connection.commit()
+        connection.close()
+    print(f"{source}: {len(data)} records, {len(strings)} unique strings -> {path}")
+    return path
+
+
+class CometStore(Mapping):
+    """Read-only, dict-like access to a converted file: store[dialogue_id] returns the same structure as the .json file."""
+    def __init__(self, source, path=None):
+        self.path = source
+        self.db_path = path or store_path(source)
+        self.connection = None
+        self.pid = None
+        ## the datasets look the same dialogue up once per utterance
+        self.last = None
+
+    def __getstate__(self):
+        ## sqlite connections are opened again in each DataLoader worker
+        state = self.__dict__.copy()
+        state['connection'] = None
+        return state
+
+    def connect(self):
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+            self.pid = os.getpid()
+        return self.connection
+
+    def strings(self, ids):
+        return dict(select_in(self.connect(), "SELECT id, text FROM strings WHERE id IN ({})", ids))
+
+    def __getitem__(self, key):
+        if self.last is not None and self.last[0] == key:
+            return self.last[1]
+        row = self.connect().execute("SELECT record FROM records WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        record = json.loads(row[0])
+        record = decode_record(record, self.strings(string_ids(record, set())))
+        self.last = (key, record)
+        return record
+
+    def __contains__(self, key):
+        return self.connect().execute("SELECT 1 FROM records WHERE key = ?", (key,)).fetchone() is not None
+
+    def __iter__(self):
+        return (key for key, in self.connect().execute("SELECT key FROM records"))
+
+    def __len__(self):
+        return self.connect().execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+
+def is_current(source):
+    ## a converted store that is at least as recent as its .json file
+    path = store_path(source)
+    return os.path.exists(path) and (not os.path.exists(source) or os.path.getmtime(path) >= os.path.getmtime(source))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, nargs='+', required=True) #.json files to convert, written next to them as .sqlite
+    args = parser.parse_args()
+    for source in args.input:
+        convert(source)
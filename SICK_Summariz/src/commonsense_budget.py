@@ -0,0 +1,104 @@
+from relation_scorer import cosines
+
+
+#####################################################################################
+# Budget-aware commonsense injection. An augmented dialogue that does not fit in the
+# encoder would be cut at its tail by the tokenizer, losing utterances and inserts alike.
+# Instead, the <I> ... </I> lines (commonsense, emotion tags, media messages) are cut
+# down until the dialogue fits, least useful spans first:
+#   1. inserts without content ('none'-like generations) are dropped
+#   2. emotion tags are removed on their own, the commonsense of their insert is kept
+#   3. inserts repeating an earlier insert of the dialogue are dropped
+#   4. the other inserts are dropped by increasing relation score, i.e. the cosine of
+#      their commonsense with the utterance they follow, as relation_scorer scores the
+#      relations of an utterance
+# Inside a step, the lowest scoring spans go first, later ones first on ties.
+# Utterances are never dropped; a dialogue still too long without any insert is left
+# to the tokenizer's truncation as before.
+#####################################################################################
+
+## part of the cache keys of dialogues fitted to a budget, to be bumped when the choice of spans changes
+FIT_VERSION = 2
+NONE_LIKE = ('', 'none', 'nothing', 'n/a')
+## labels of the pysentimiento emotion analyzer, appended as ",emotion" to the commonsense
+EMOTION_LABELS = ('others', 'joy', 'sadness', 'anger', 'surprise', 'disgust', 'fear')
+
+
+def is_insert(line):
+    return line.strip().startswith('<I>') and line.strip().endswith('</I>')
+
+
+def insert_body(line):
+    ## "commonsense[,emotion]" of an "<I> commonsense[,emotion]. </I>" line
+    return line.strip()[len('<I>'):-len('</I>')].strip().rstrip('.')
+
+
+def split_emotion(line):
+    ## (commonsense, emotion tag or None) of an insert line
+    commonsense, comma, emotion = insert_body(line).rpartition(',')
+    if comma and emotion.strip() in EMOTION_LABELS:
+        return commonsense.strip(), emotion.strip()
+    return insert_body(line), None
+
+
+def insert_content(line):
+    ## commonsense of an insert line, to compare inserts
+    return split_emotion(line)[0].lower()
+
+
+def without_emotion(line):
+    ## the insert line with its commonsense only, as commonsense_insert writes it without emotion
+    return "<I> " + split_emotion(line)[0] + ". </I>"
+
+
+def relation_scores(lines, inserts, tokenizer, max_length):
+    ## insert -> cosine of its commonsense with the closest utterance before it
+    pairs = []
+    for i in inserts:
+        utterance = next((lines[j] for j in range(i - 1, -1, -1) if not is_insert(lines[j])), '')
+        pairs.append((utterance.strip(), split_emotion(lines[i])[0]))
+    return dict(zip(inserts, cosines(tokenizer, max_length, pairs)[:, 0]))
+
+
+def fit_to_budget(dialogue, tokenizer, budget):
+    if len(tokenizer(dialogue)['input_ids']) <= budget:
+        return dialogue
+    lines = dialogue.split('\n')
+    inserts = [i for i, line in enumerate(lines) if is_insert(line)]
+    if not inserts:
+        return dialogue
+    score = relation_scores(lines, inserts, tokenizer, budget)
+    by_score = sorted(inserts, key=lambda i: (score[i], -i))
+
+    none_like = [i for i in by_score if insert_content(lines[i]) in NONE_LIKE]
+    tagged = [i for i in by_score if i not in none_like and split_emotion(lines[i])[1] is not None]
+    seen = set()
+    duplicate = set()
+    for i in inserts:
+        if insert_content(lines[i]) in seen:
+            duplicate.add(i)
+        seen.add(insert_content(lines[i]))
+    ## (line, replacement) in the order they are applied, None to drop the line
+    edits = [(i, None) for i in none_like]
+    edits += [(i, without_emotion(lines[i])) for i in tagged]
+    edits += [(i, None) for i in by_score if i not in none_like and i in duplicate]
+    edits += [(i, None) for i in by_score if i not in none_like and i not in duplicate]
+
+    texts = list(dict.fromkeys([lines[i] for i in inserts] + [replacement for i, replacement in edits if replacement is not None]))
+    cost = dict(zip(texts, (len(ids) for ids in tokenizer([text + '\n' for text in texts], add_special_tokens=False)['input_ids'])))
+
+    current = list(lines)
+    applied = 0
+    while applied < len(edits):
+        ## apply edits by their estimated saving, then check the real length (BPE merges across lines may differ slightly)
+        excess = len(tokenizer('\n'.join(line for line in current if line is not None))['input_ids']) - budget
+        if excess <= 0:
+            break
+        while applied < len(edits) and excess > 0:
+            i, replacement = edits[applied]
+            applied += 1
+            if current[i] is None:
+                continue
+            excess -= cost[current[i]] - (cost[replacement] if replacement is not None else 0)
+            current[i] = replacement
+    return '\n'.join(line for line in current if line is not None)
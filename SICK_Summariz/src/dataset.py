@@ -1,32 +1,599 @@
 import json
+import hashlib
 import pickle
 import torch
 import torch.nn as nn
 from torch.utils.data import Dataset, DataLoader, SequentialSampler
 from datasets import load_dataset
 import os
-import spacy
 import re
 import random
 import argparse
+import multiprocessing
 import numpy as np
-from bert_score import score
-from sklearn.metrics.pairwise import cosine_similarity
+from collections import OrderedDict
+from collections.abc import Mapping
+from token_store import TokenStore, build_token_store
+from storage import write_atomic
+from emotion_store import ContextWindow, EmotionStore, predict_emotion
+from comet_store import STRINGS, CometStore, decode_record, encode_record, is_current
+import resources
+import profiling
+from sentence_splits import SENTENCE_PIPES, split_dialogues
+from commonsense_budget import FIT_VERSION, fit_to_budget
+from jsonl_index import JsonlIndex, stream_jsonl
+from relation_scorer import COMET_RELATIONS, PARACOMET_RELATIONS, RelationIndex, get_scorer, relation_index_path
 
 
-########### Emotion extraction Model ################# 
-# Load the model 
-from pysentimiento import create_analyzer
-# We are interested in Emotion analysis task, for English Language
-emotion_analyzer = create_analyzer(task="emotion", lang="en")
-
 random.seed(9001)
 
-class SamsumDataset(Dataset):
+## Bump when the way augmented dialogues are built changes, so stale caches are not reused.
+CACHE_VERSION = 1
+
+
+## Commonsense text with PersonX / PersonY replaced by Person, computed once per distinct string
+person_normalized = STRINGS.person
+
+
+def media_message(sentence, person):
+    ## <I> line replacing the commonsense of a media message, None for other utterances
+    if ('<file_photo>' in sentence) or ('<photo_file>' in sentence) or ('<file_picture>' in sentence):
+        return "<I> " + person + " sent a photo. </I>" + '\n'
+    elif ('<video>' in sentence) or ('<file_video>' in sentence):
+        return "<I> " + person + " sent a video. </I>" + '\n'
+    elif '<file_gif>' in sentence:
+        return "<I> " + person + " sent a file. </I>" + '\n'
+    elif ('<file_other>' in sentence) or ('<file_others>' in sentence):
+        return "<I> " + person + " sent a file. </I>" + '\n'
+    elif ('<link>' in sentence) or ('<file_link>' in sentence):
+        return "<I> " + person + " sent a link. </I>" + '\n'
+    elif '<location>' in sentence:
+        return "<I> " + person + " sent a location. </I>" + '\n'
+    return None
+
+
+def needs_emotion(sentence, commonsense):
+    ## whether commonsense_insert injects commonsense (and so an emotion) for this utterance
+    return media_message(sentence, "") is None and commonsense.strip() != 'none'
+
+
+def commonsense_insert(sentence, person, commonsense, emotion=None):
+    ## <I> line following an utterance in SAMSum dialogues, with the emotion of the utterance when given
+    media = media_message(sentence, person)
+    if media is not None:
+        return media
+    if commonsense.strip() != 'none':
+        if emotion is not None:   ## Return the new emotion aware commensense 
+            return "<I> " + commonsense.strip() + "," + emotion + ". </I>" + '\n'
+        else : ## Emotion not extracted
+            return "<I> " + commonsense.strip() + ". </I>" + '\n'
+    return ""
+
+
+class LazyJson(Mapping):
+    """
+    A commonsense .json file that is only read the first time it is accessed.
+    Each record is kept as nested lists / dicts of interned string ids (see comet_store.StringTable),
+    resolved to the shared strings when it is looked up; the last max_decoded records looked up
+    are kept resolved.
+    """
+    def __init__(self, path, max_decoded=1024):
+        self.path = path
+        self.data = None
+        self.strings = STRINGS
+        ## the datasets look the same dialogue up once per utterance, and its neighbours soon after
+        self.decoded = OrderedDict()
+        self.max_decoded = max_decoded
+
+    def load(self):
+        if self.data is None:
+            with open(self.path) as f:
+                data = json.load(f)
+            self.data = {key: encode_record(value, self.strings.intern) for key, value in data.items()}
+        return self.data
+
+    def __getitem__(self, key):
+        record = self.decoded.get(key)
+        if record is not None:
+            self.decoded.move_to_end(key)
+            return record
+        record = decode_record(self.load()[key], self.strings.texts)
+        self.decoded[key] = record
+        if len(self.decoded) > self.max_decoded:
+            self.decoded.popitem(last=False)
+        return record
+
+    def __contains__(self, key):
+        return key in self.load()
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+
+class CommonsenseDataset(Dataset):
+    """
+    Shared machinery of the SAMSum / DialogSum / TweetSumm datasets.
+    Subclasses implement build_dialogue(index), which returns the x||z dialogue string of one example.
+    """
+    dataset_name = None
+
+    multi_reference = False
+
+    ## whether compute_best_relation is given the stripped utterance
+    strip_relation_sentence = False
+
+    @property
+    def nlp(self):
+        ## spaCy pipeline, loaded once per process on first use
+        return resources.get('spacy')
+
+    def nlp_version(self):
+        ## spaCy and en_core_web_sm versions, the sentence splits (and so the dialogues) change with them
+        import spacy
+        return [spacy.__version__, self.nlp.meta['version']]
+
+    @property
+    def relation_scorer(self):
+        return get_scorer(self.tokenizer, self.encoder_max_len, PARACOMET_RELATIONS if self.paracomet else COMET_RELATIONS)
+
+    def comet_key(self, index):
+        ## key of a dialogue in the COMET / PARACOMET dialogue file
+        raise NotImplementedError
+
+    def best_relation_candidates(self, index):
+        ## (utterance, commonsense dict) pairs that build_dialogue passes to compute_best_relation
+        dia = self.dialogue_comet_inference[self.comet_key(index)]
+        if isinstance(dia, dict):
+            dia = dia.values()
+        return [(sent['sentence'].strip() if self.strip_relation_sentence else sent['sentence'], sent) for sent in dia]
+
+    def open_relation_index(self):
+        ## best relations computed offline by build_relation_index.py, if they match this configuration
+        path = relation_index_path(self.dialogue_comet_inference.path, self.relation_index)
+        if not os.path.exists(path):
+            print(f"No best relation index at {path}, best relations are scored at runtime")
+            return None
+        index = RelationIndex(path)
+        if not index.matches(self.tokenizer, self.encoder_max_len, self.strip_relation_sentence, self.relation_scorer.relations):
+            print(f"Best relation index {path} was built with another configuration, best relations are scored at runtime")
+            return None
+        return index
+
+    def prefetch_best_relations(self, indices):
+        ## score the best relations of many dialogues at once (or read them from the offline index),
+        ## build_dialogue then only hits the memo
+        if self.relation != '<|best_relation|>' or self.roberta or self.sentence_transformer:
+            return
+        scorer = self.relation_scorer
+        relation_index = self.open_relation_index() if self.relation_index else None
+        pairs = []
+        for index in indices:
+            try:
+                candidates = self.best_relation_candidates(index)
+                if relation_index is not None and self.comet_key(index) in relation_index.dialogues:
+                    for (sentence, d), relation in zip(candidates, relation_index.best_relations(self.comet_key(index))):
+                        if relation is not None:
+                            scorer.pin(sentence, d, relation)
+                    continue
+                for sentence, d in candidates:
+                    ## utterances without every relation are left to build_dialogue
+                    if all(len(d.get(relation, [])) > 0 for relation in scorer.relations):
+                        pairs.append((sentence, d))
+            except KeyError:
+                continue
+        scorer.score(pairs)
+
+    def precompute(self, indices):
+        ## whole-split work build_dialogue then only looks up: the best relations, the sentence splits
+        ## and, with emotion_dir, the emotions (whatever cache_dir is, so that DataLoader workers never build them)
+        self.prefetch_best_relations(indices)
+        if self.needs_sentence_segments() and self.segments is None:
+            self.segments = self.split_sentences()
+        if self.emotion==True and self.emotion_dir:
+            self.emotion_store = self.build_emotion_store(indices)
+
+    def prepare(self):
+        ## everything computed once for the whole split, before DataLoader workers are started
+        if self.token_store_dir:
+            self.token_store = self.open_token_store()
+        elif self.extra_context==True and self.cache_dir:
+            self.build_cache()
+        elif self.extra_context==True:
+            self.precompute(range(self.data_len))
+
+    def needs_sentence_segments(self):
+        ## whether build_dialogue splits the utterances into sentences with spaCy
+        return False
+
+    def sentence_segments(self, index):
+        ## sentences of every line of a dialogue, see sentence_splits.py
+        if self.segments is None:
+            self.segments = self.split_sentences()
+        return self.segments[self.id[index]]
+
+    @profiling.timed('sentence splitting')
+    def split_sentences(self):
+        ###########################################################
+        # split the utterances of the whole split with nlp.pipe,
+        # cached on disk next to the augmented dialogues
+        ###########################################################
+        dialogues = {self.id[index]: self.dialogue[index] for index in range(self.data_len)}
+        path = None
+        if self.cache_dir:
+            key = hashlib.sha1(json.dumps({'version': CACHE_VERSION, 'model': 'en_core_web_sm', 'model_version': self.nlp_version(), 'pipes': SENTENCE_PIPES, 'dialogues': dialogues}, sort_keys=True).encode()).hexdigest()[:16]
+            path = os.path.join(self.cache_dir, f"{self.dataset_name}_{self.split_type}_sentences_{key}.pkl")
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    return pickle.load(f)
+        segments = split_dialogues(self.nlp, dialogues, n_process=self.num_proc)
+        if path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with write_atomic(path, 'wb') as f:
+                pickle.dump(segments, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return segments
+
+    def load_json(self, path, dialogue_source=True):
+        ## commonsense files are loaded through here, so the cache keys know which sources were used.
+        ## A .sqlite store converted by comet_store.py is read instead of the .json file when it is up to date.
+        if is_current(path):
+            data = CometStore(path)
+            source = data.db_path
+        else:
+            data = LazyJson(path)
+            source = path
+        if dialogue_source:
+            self.source_files.append(source)
+        else:
+            self.summary_source_files.append(source)
+        if profiling.ENABLED:
+            data = profiling.ProfiledMapping(data, type(self).__name__, 'comet lookup')
+        return data
+
+    def cache_key(self, **extra):
+        key = {
+            'version': CACHE_VERSION,
+            'dataset': self.dataset_name,
+            'split': self.split_type,
+            'relation': self.relation,
+            'paracomet': self.paracomet,
+            'roberta': self.roberta,
+            'sentence_transformer': self.sentence_transformer,
+            'emotion': self.emotion,
+            'sources': [(path, os.path.getmtime(path), os.path.getsize(path)) for path in self.source_files],
+        }
+        if self.relation == '<|best_relation|>':
+            ## the best relation is chosen with the tokenizer, truncated to encoder_max_len
+            key['tokenizer'] = self.tokenizer.name_or_path
+            key['encoder_max_len'] = self.encoder_max_len
+            if self.relation_index:
+                key['relation_index'] = self.relation_index
+        if self.extra_context==True and self.needs_sentence_segments():
+            key['spacy'] = self.nlp_version()
+        if self.fit_commonsense:
+            ## inserts are dropped to fit encoder_max_len tokens of the tokenizer
+            key['fit_commonsense'] = [self.tokenizer.name_or_path, len(self.tokenizer), self.encoder_max_len, FIT_VERSION]
+        if self.emotion:
+            ## emotion labels of the dialogues, and of the emotion store
+            key['emotion_analyzer'] = resources.emotion_analyzer_version()
+        if self.emotion and self.emotion_context != 5:
+            ## the emotion of "others" utterances is the one of their last emotion_context lines
+            key['emotion_context'] = self.emotion_context
+        key.update(extra)
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+    def build_cache(self):
+        ###########################################################
+        # build the augmented dialogues once and store them on disk,
+        # keyed by dialogue id so that subsets share the same file
+        ###########################################################
+        path = os.path.join(self.cache_dir, f"{self.dataset_name}_{self.split_type}_{self.cache_key()}.pkl")
+        cache = {}
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                cache = pickle.load(f)
+        missing = [index for index in range(self.data_len) if self.id[index] not in cache]
+        if len(missing) > 0:
+            self.precompute(missing)
+            print(f"Building augmented dialogue cache for {len(missing)} {self.split_type} dialogues")
+            for index, dialogue in zip(missing, self.augmented_dialogues(missing)):
+                cache[self.id[index]] = dialogue
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with write_atomic(path, 'wb') as f:
+                pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.augmented_cache = cache
+
+    @profiling.timed('emotion analysis')
+    def emotion_of(self, utterance, previous, key):
+        ## emotion of an utterance, or of its previous context when the utterance itself is "others".
+        ## key = (dialogue id, utterance index) in the precomputed emotion store
+        if self.emotion_requests is not None:
+            ## collecting what build_dialogue asks for, see build_emotion_store
+            self.emotion_requests[key] = (utterance, previous)
+            return "others"
+        if self.emotion_store is not None:
+            emotion = self.emotion_store.get(*key)
+            if emotion is not None:
+                return emotion
+        emotion_analyzer = resources.get('emotion_analyzer')
+        emotion = predict_emotion(emotion_analyzer, utterance)
+        if emotion == "others":
+            emotion = predict_emotion(emotion_analyzer, previous)
+        return emotion
+
+    def build_emotion_store(self, indices=None):
+        ###########################################################
+        # run build_dialogue once without emotions to collect every
+        # utterance and context it needs, then label them in batches
+        ###########################################################
+        store = self.emotion_store or EmotionStore(os.path.join(self.emotion_dir, f"{self.dataset_name}_{self.split_type}_{self.cache_key()}_emotions.json"))
+        indices = range(self.data_len) if indices is None else indices
+        missing = [index for index in indices if self.id[index] not in store]
+        if len(missing) > 0:
+            print(f"Precomputing emotions of {len(missing)} {self.split_type} dialogues")
+            self.emotion_requests = {}
+            ## key errors are counted once, when the dialogues are built with their emotions
+            key_errors = self.key_errors
+            try:
+                for index in missing:
+                    self.build_dialogue(index)
+                requests = self.emotion_requests
+            finally:
+                self.emotion_requests = None
+                self.key_errors = key_errors
+            store.fill([self.id[index] for index in missing], requests, resources.get('emotion_analyzer'))
+            store.save()
+        return store
+
+    def get_dialogue(self, index):
+        if self.augmented_cache is not None:
+            return self.augmented_cache[self.id[index]]
+        return self.augmented_dialogue(index)
+
+    def augmented_dialogues(self, indices, chunk_size=64):
+        ###########################################################
+        # augmented_dialogue of many examples, over num_proc forked
+        # processes when num_proc > 1; whole-split precomputation is
+        # done once here, before the workers are started
+        ###########################################################
+        if self.num_proc <= 1 or len(indices) <= chunk_size:
+            return [self.augmented_dialogue(index) for index in indices]
+        if self.needs_sentence_segments() and self.segments is None:
+            self.segments = self.split_sentences()
+        global _building
+        _building = self
+        chunks = [indices[start:start + chunk_size] for start in range(0, len(indices), chunk_size)]
+        dialogues = []
+        try:
+            with multiprocessing.get_context('fork').Pool(self.num_proc) as pool:
+                for chunk_dialogues, key_errors in pool.imap(_augment_chunk, chunks):
+                    dialogues.extend(chunk_dialogues)
+                    self.key_errors += key_errors
+        finally:
+            _building = None
+        return dialogues
+
+    def report_key_error(self, message="key error"):
+        ## an example built without (some of) its commonsense, counted for prepare.py
+        print(message)
+        self.key_errors += 1
+
+    @profiling.timed('augmentation')
+    def augmented_dialogue(self, index):
+        ## with fit_commonsense, the least useful inserts are dropped until the dialogue fits in encoder_max_len tokens
+        dialogue = self.build_dialogue(index)
+        if self.fit_commonsense:
+            dialogue = fit_to_budget(dialogue, self.tokenizer, self.encoder_max_len)
+        return dialogue
+
+    def build_dialogue(self, index):
+        raise NotImplementedError
+
+    def build_summary_commonsense(self, index):
+        raise NotImplementedError
+
+    def text_fields(self):
+        fields = ['input_ids', 'labels']
+        if self.extra_supervision==True and self.split_type=='train':
+            fields.append('extra_labels')
+        return fields
+
+    def reference_fields(self):
+        ## extra references of the multi-reference test split, given as text to the evaluation (never tokenized)
+        if self.multi_reference and self.split_type=='test':
+            return ['references2', 'references3']
+        return []
+
+    def max_length(self, field):
+        return self.encoder_max_len if field == 'input_ids' else self.decoder_max_len
+
+    def get_texts(self, index):
+        ## the text each field of an example is tokenized from
+        texts = {}
+        texts['input_ids'] = self.get_dialogue(index) if self.extra_context==True else self.dialogue[index]
+        texts['labels'] = self.summary[index]
+        if self.extra_supervision==True and self.split_type=='train':
+            texts['extra_labels'] = self.build_summary_commonsense(index)
+        return texts
+
+    def get_references(self, index):
+        references = {}
+        if self.multi_reference and self.split_type=='test':
+            references['references2'] = self.summary2[index]
+            references['references3'] = self.summary3[index]
+        return references
+
+    def token_key(self, **extra):
+        ## cache key of the tokenized examples of this split (and subset)
+        return self.cache_key(tokenizer=self.tokenizer.name_or_path,
+                              vocab_size=len(self.tokenizer),
+                              encoder_max_len=self.encoder_max_len,
+                              decoder_max_len=self.decoder_max_len,
+                              extra_context=self.extra_context,
+                              extra_supervision=self.extra_supervision,
+                              supervision_relation=self.supervision_relation,
+                              summary_sources=[(path, os.path.getmtime(path), os.path.getsize(path)) for path in self.summary_source_files],
+                              ids=hashlib.sha1('\n'.join(map(str, self.id)).encode()).hexdigest(),
+                              fields=self.text_fields(),
+                              **extra)
+
+    def open_token_store(self):
+        ###########################################################
+        # pre-tokenized split, built on first use and then shared
+        # by every later run with the same configuration
+        ###########################################################
+        path = os.path.join(self.token_store_dir, f"{self.dataset_name}_{self.split_type}_{self.token_key()}")
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            return TokenStore(path)
+        if self.extra_context==True and self.cache_dir:
+            self.build_cache()
+        elif self.extra_context==True:
+            self.precompute(range(self.data_len))
+            ## augmented over num_proc processes as build_cache does, only kept in memory while tokenizing
+            self.augmented_cache = dict(zip(self.id, self.augmented_dialogues(list(range(self.data_len)))))
+        print(f"Building token store for {self.dataset_name} {self.split_type} in {path}")
+        os.makedirs(self.token_store_dir, exist_ok=True)
+        try:
+            return build_token_store(self, path)
+        finally:
+            if not self.cache_dir:
+                self.augmented_cache = None
+
+    @profiling.timed('token store read')
+    def get_stored_item(self, index):
+        position = self.token_store.position[self.id[index]]
+        model_inputs = {}
+        for field in self.token_store.fields:
+            tokens = torch.from_numpy(self.token_store.get(field, position)).long()
+            if self.dynamic_padding:
+                ## left unpadded, the collator pads to the longest example of the batch
+                model_inputs[field] = tokens
+                if field == 'input_ids':
+                    model_inputs['attention_mask'] = torch.ones(len(tokens), dtype=torch.long)
+                continue
+            padded = torch.full((self.max_length(field),), self.tokenizer.pad_token_id, dtype=torch.long)
+            padded[:len(tokens)] = tokens
+            model_inputs[field] = padded
+            if field == 'input_ids':
+                attention_mask = torch.zeros(self.encoder_max_len, dtype=torch.long)
+                attention_mask[:len(tokens)] = 1
+                model_inputs['attention_mask'] = attention_mask
+        return model_inputs
+
+    def lengths(self, field='input_ids', batch_size=1000):
+        ###########################################################
+        # token length of every example, used to bucket batches
+        ###########################################################
+        if self.token_store is not None:
+            stored = self.token_store.lengths(field)
+            return np.array([stored[self.token_store.position[self.id[index]]] for index in range(self.data_len)])
+        if field not in self.example_lengths:
+            lengths = []
+            for start in range(0, self.data_len, batch_size):
+                texts = [self.get_texts(index)[field] for index in range(start, min(start + batch_size, self.data_len))]
+                encoded = self.tokenizer(texts, padding=False, truncation=True, max_length=self.max_length(field))
+                lengths.extend(len(ids) for ids in encoded['input_ids'])
+            self.example_lengths[field] = np.array(lengths)
+        return self.example_lengths[field]
+
+    def __len__(self):
+        return self.data_len
+
+    def __getitem__(self, index):
+        if self.token_store is not None:
+            model_inputs = self.get_stored_item(index)
+            model_inputs.update(self.get_references(index))
+            return model_inputs
+
+        model_inputs = {}
+        for field, text in self.get_texts(index).items():
+            # (1, sequence_length)
+            with profiling.stage(type(self).__name__, 'encoder tokenization' if field == 'input_ids' else 'label tokenization'):
+                encoded = self.tokenizer(text,
+                                         padding=False if self.dynamic_padding else 'max_length',
+                                         truncation=True,
+                                         max_length=self.max_length(field),
+                                         return_tensors='pt')
+            model_inputs[field] = encoded['input_ids'].squeeze(0)
+            if field == 'input_ids':
+                model_inputs['attention_mask'] = encoded['attention_mask'].squeeze(0)
+        model_inputs.update(self.get_references(index))
+        return model_inputs
+
+
+## dataset whose dialogues the forked augmented_dialogues workers build
+_building = None
+
+
+def _augment_chunk(indices):
+    key_errors = _building.key_errors
+    dialogues = [_building.augmented_dialogue(index) for index in indices]
+    return dialogues, _building.key_errors - key_errors
+
+
+class LazySplits:
+    """
+    Train / validation / test splits of a *_total wrapper, each built on first use so that a script
+    only pays for the splits it asks for (the tokenizer, spaCy, the emotion analyzer and the relation
+    scorer are shared by the splits of a process anyway).
+    Random subsets (subset_size < 100) are drawn as if the splits were built in the order train,
+    validation, test: a split drawing a subset starts from the random state the earlier ones left,
+    so they are built before it. The test split never draws one and is built directly.
+    """
+    split_types = ('train', 'validation', 'test')
+
+    def __init__(self, dataset_class, subset_size, **kwargs):
+        self.dataset_class = dataset_class
+        self.subset_size = subset_size
+        self.kwargs = kwargs
+        self.datasets = {}
+        self.random_state = random.getstate()
+
+    def subset_size_of(self, split_type):
+        return self.subset_size
+
+    def draws_subset(self, split_type):
+        return self.subset_size_of(split_type) < 100 and split_type in ('train', 'validation')
+
+    def get_split(self, split_type):
+        if split_type not in self.datasets:
+            draws_subset = self.draws_subset(split_type)
+            if draws_subset:
+                ## only the random state of the earlier subsets matters, e.g. validation after train
+                for earlier in self.split_types[:self.split_types.index(split_type)]:
+                    if earlier not in self.datasets and self.draws_subset(earlier):
+                        self.get_split(earlier)
+            state = random.getstate()
+            random.setstate(self.random_state)
+            try:
+                self.datasets[split_type] = self.dataset_class(split_type=split_type, subset_size=self.subset_size_of(split_type), **self.kwargs)
+                if draws_subset:
+                    self.random_state = random.getstate()
+            finally:
+                random.setstate(state)
+        return self.datasets[split_type]
+
+    def getTrainData(self):
+        return self.get_split('train')
+
+    def getEvalData(self):
+        return self.get_split('validation')
+
+    def getTestData(self):
+        return self.get_split('test')
+
+
+class SamsumDataset(CommonsenseDataset):
+    dataset_name = 'samsum'
+
+    strip_relation_sentence = True
+
     def __init__(self, encoder_max_len, decoder_max_len, split_type, 
                  tokenizer, subset_size, relation, extra_context=False, extra_supervision=False, 
                  paracomet=False, supervision_relation="xIntent", 
-                 roberta=False, sentence_transformer=False, emotion = False):
+                 roberta=False, sentence_transformer=False, emotion = False, cache_dir=None, token_store_dir=None, dynamic_padding=False, emotion_dir=None, relation_index=None, num_proc=1, fit_commonsense=False, emotion_context=5):
         self.encoder_max_len = encoder_max_len
         self.decoder_max_len = decoder_max_len
         self.split_type = split_type
@@ -48,6 +615,23 @@ class SamsumDataset(Dataset):
 
         self.roberta = roberta
         self.sentence_transformer = sentence_transformer
+        self.cache_dir = cache_dir
+        self.token_store_dir = token_store_dir
+        self.source_files = []
+        self.summary_source_files = []
+        self.augmented_cache = None
+        self.token_store = None
+        self.dynamic_padding = dynamic_padding
+        self.example_lengths = {}
+        self.emotion_dir = emotion_dir
+        self.emotion_store = None
+        self.emotion_requests = None
+        self.relation_index = relation_index
+        self.num_proc = num_proc
+        self.fit_commonsense = fit_commonsense
+        self.key_errors = 0
+        self.emotion_context = emotion_context
+        self.segments = None
         print(self.relation)
         ##################################################
 
@@ -64,7 +648,6 @@ class SamsumDataset(Dataset):
         self.summary = self.data['summary']
         self.id = self.data['id']
 
-        self.nlp = spacy.load('en_core_web_sm')
         
 
 
@@ -75,376 +658,239 @@ class SamsumDataset(Dataset):
         if self.extra_context==True:
             if self.paracomet==False:
                 ##### COMET #####
-                with open(f"../data/COMET_data/comet/dialogue/samsum/comet_{self.split_type}.json") as f:
-                    self.dialogue_comet_inference = json.load(f)
+                self.dialogue_comet_inference = self.load_json(f"../data/COMET_data/comet/dialogue/samsum/comet_{self.split_type}.json")
                 
                 if self.roberta:
                     print('ROBERTA ON!')
-                    with open(f"../data/COMET_data/comet/dialogue/samsum/roberta_nli/roberta_classified_top1_{self.split_type}.json") as f:
-                        self.roberta_classified_z = json.load(f)
+                    self.roberta_classified_z = self.load_json(f"../data/COMET_data/comet/dialogue/samsum/roberta_nli/roberta_classified_top1_{self.split_type}.json")
                 if self.sentence_transformer:
-                    with open(f"../data/COMET_data/comet/dialogue/samsum/sentence_transformer/comet_{self.split_type}_z.json") as f:
-                        self.sentence_transformer_classified_z = json.load(f)
+                    self.sentence_transformer_classified_z = self.load_json(f"../data/COMET_data/comet/dialogue/samsum/sentence_transformer/comet_{self.split_type}_z.json")
                         
                     
             else:
                 
-                with open(f"../data/COMET_data/paracomet/dialogue/samsum/dialog_{self.split_type}_split5_collated.json") as f:
-                    self.dialogue_comet_inference = json.load(f)
+                self.dialogue_comet_inference = self.load_json(f"../data/COMET_data/paracomet/dialogue/samsum/dialog_{self.split_type}_split5_collated.json")
                 if self.roberta:
                     print('ROBERTA ON!')
-                    with open(f"../data/COMET_data/paracomet/dialogue/samsum/roberta_nli/paracomet_samsum_roberta_classified_top1_{self.split_type}.json") as f:
-                        self.roberta_classified_z = json.load(f)
+                    self.roberta_classified_z = self.load_json(f"../data/COMET_data/paracomet/dialogue/samsum/roberta_nli/paracomet_samsum_roberta_classified_top1_{self.split_type}.json")
                 if self.sentence_transformer:
-                    with open(f"../data/COMET_data/paracomet/dialogue/samsum/sentence_transformer/paracomet_{self.split_type}_z.json") as f:
-                        self.sentence_transformer_classified_z = json.load(f)
+                    self.sentence_transformer_classified_z = self.load_json(f"../data/COMET_data/paracomet/dialogue/samsum/sentence_transformer/paracomet_{self.split_type}_z.json")
                     
               
         
         if self.extra_supervision==True: # use commonsense w
             if self.split_type=='train':
                 if self.paracomet==False: # plain COMET
-                    with open(f"../data/COMET_data/comet/summary/samsum/comet_train_w.json") as f:
-                        self.summary_comet_inference = json.load(f)
+                    self.summary_comet_inference = self.load_json(f"../data/COMET_data/comet/summary/samsum/comet_train_w.json", dialogue_source=False)
 
                     if self.roberta:
                         print('ROBERTA ON!')
-                        with open(f"../data/COMET_data/comet/summary/samsum/roberta_nli/roberta_classified_top1_w.json") as f:
-                            self.roberta_classified_w = json.load(f)
+                        self.roberta_classified_w = self.load_json(f"../data/COMET_data/comet/summary/samsum/roberta_nli/roberta_classified_top1_w.json", dialogue_source=False)
                     if self.sentence_transformer:
-                        with open(f"../data/COMET_data/comet/summary/samsum/sentence_transformer/comet_train_w.json") as f:
-                            self.sentence_transformer_classified_w = json.load(f)
+                        self.sentence_transformer_classified_w = self.load_json(f"../data/COMET_data/comet/summary/samsum/sentence_transformer/comet_train_w.json", dialogue_source=False)
                 else:
-                    with open(f"../data/COMET_data/paracomet/summary/samsum/summary_train_split5_collated.json") as f:
-                        self.summary_comet_inference = json.load(f)
+                    self.summary_comet_inference = self.load_json(f"../data/COMET_data/paracomet/summary/samsum/summary_train_split5_collated.json", dialogue_source=False)
                     if self.roberta:
                         print('ROBERTA ON!')
-                        with open(f"../data/COMET_data/paracomet/summary/samsum/roberta_nli/roberta_classified_top1_w.json") as f:
-                            self.roberta_classified_w = json.load(f)
+                        self.roberta_classified_w = self.load_json(f"../data/COMET_data/paracomet/summary/samsum/roberta_nli/roberta_classified_top1_w.json", dialogue_source=False)
                     
                     if self.sentence_transformer:
-                        with open(f"../data/COMET_data/paracomet/summary/samsum/sentence_transformer/paracomet_train_w.json") as f:
-                            self.sentence_transformer_classified_w = json.load(f)
+                        self.sentence_transformer_classified_w = self.load_json(f"../data/COMET_data/paracomet/summary/samsum/sentence_transformer/paracomet_train_w.json", dialogue_source=False)
         
         self.data_len = len(self.data)
 
+        self.prepare()
+
     ###########################################################################
     #function that computes the best commonsense given an utterance.
     #the cosine similarity is performed to understand what is the best relation
     ###########################################################################
 
+    @profiling.timed('best relation')
     def compute_best_relation(self, sentence, d: dict):
-      encoded_sentence = self.tokenizer(sentence,
-                                            padding='max_length', 
-                                            truncation=True, 
-                                            max_length=self.encoder_max_len, 
-                                            return_tensors='pt')
-      commonsenseDict = {}
-      if self.paracomet:
-        commonsenseDict['<|xReact|>'] = d['<|xReact|>'][0]
-        commonsenseDict['<|xWant|>'] = d['<|xWant|>'][0]
-        commonsenseDict['<|xIntent|>'] = d['<|xIntent|>'][0]
-        commonsenseDict['<|xAttr|>'] = d['<|xAttr|>'][0]
-        commonsenseDict['<|xEffect|>'] = d['<|xEffect|>'][0]
-      else:
-        commonsenseDict['HinderedBy'] = d['HinderedBy'][0]
-        commonsenseDict['xWant'] = d['xWant'][0]
-        commonsenseDict['xIntent'] = d['xIntent'][0]
-        commonsenseDict['xNeed'] = d['xNeed'][0]
-        commonsenseDict['xReason'] = d['xReason'][0]
-
-        
-      for k, v in commonsenseDict.items():
-        encoded = self.tokenizer(v, padding='max_length', 
-                                              truncation=True, 
-                                              max_length=self.encoder_max_len, 
-                                              return_tensors='pt')
-        similarity = cosine_similarity(encoded_sentence['input_ids'], encoded['input_ids'])
-        commonsenseDict[k] = similarity[0][0]
-      
-      best_relation = max(commonsenseDict, key=commonsenseDict.get)
+      best_relation = self.relation_scorer.best_relation(sentence, d)
       return d[best_relation][0]
 
+    def comet_key(self, index):
+      return self.id[index]
+
 
-    def process_media_msg(self,sentence, person, commonsense, previous):
+    @profiling.timed('media rewriting')
+    def process_media_msg(self,sentence, person, commonsense, previous, key):
         # print(person)
-        if ('<file_photo>' in sentence) or ('<photo_file>' in sentence) or ('<file_picture>' in sentence):
-            return "<I> " + person + " sent a photo. </I>" + '\n' 
-        elif ('<video>' in sentence) or ('<file_video>' in sentence):
-            return "<I> " + person + " sent a video. </I>" + '\n'
-        elif '<file_gif>' in sentence:
-            return "<I> " + person + " sent a file. </I>" + '\n'
-        elif ('<file_other>' in sentence) or ('<file_others>' in sentence):
-            return "<I> " + person + " sent a file. </I>" + '\n'
-        elif ('<link>' in sentence) or ('<file_link>' in sentence):
-            return "<I> " + person + " sent a link. </I>" + '\n'
-        elif '<location>' in sentence:
-            return "<I> " + person + " sent a location. </I>" + '\n'
-        else:
-            if commonsense.strip() != 'none':
-                if self.emotion == True :   ## Create the emotion aware commensense 
-                    ## Detet the emotion from the egiven utterance
-                    emotion = emotion_analyzer.predict(sentence).output
-                    if emotion == "others" : ## In case of "others" eemotion detected 
-                        ## We analyzee the previous context of the dialogue to extract the new emotion
-                        emotion2 = emotion_analyzer.predict(previous).output 
-                        ## Return the new emotion aware commensense
-                        return "<I> " + commonsense.strip() + "," + emotion2 + ". </I>" + '\n'
-                    ## Return the new emotion aware commensense 
-                    return "<I> " + commonsense.strip() + "," + emotion + ". </I>" + '\n'
-                else : ## Emotion not extracted
-                    return "<I> " + commonsense.strip() + ". </I>" + '\n'
-            else:
-                return "" 
+        emotion = None
+        if self.emotion == True and needs_emotion(sentence, commonsense):   ## Create the emotion aware commensense 
+            ## Detect the emotion from the given utterance, or from the previous context of the dialogue
+            ## in case of "others" emotion detected (precomputed in batches when emotion_dir is set)
+            emotion = self.emotion_of(sentence, previous, key)
+        return commonsense_insert(sentence, person, commonsense, emotion)
 
 
 
-    def __len__(self):
-        return self.data_len
-
-    def __getitem__(self, index):
-        if self.extra_context==False:
-            encoded_dialogue = self.tokenizer(self.dialogue[index], 
-                                            padding='max_length', 
-                                            truncation=True, 
-                                            max_length=self.encoder_max_len, 
-                                            return_tensors='pt')
-        else:
-            if self.paracomet==False: # plain COMET
-                try:
-                    
-                    dia = self.dialogue_comet_inference[self.id[index]]
-                    dialogue=""
-                    ## Dialogue clean consists of the original dialogue without commonsense,
-                    ## to be used in the case of context emotion-aware commonsense extraction.
-                    dialogue_clean = ""
-
-                    ## A variable to store, for each utterance, the n previous utterances used as context.
-                    previous = []
-                    
-                    for sent_idx, sent in enumerate(dia):
-                        person = sent['speaker'].replace(": ","").replace(":","").strip()
-                        sentence = sent['sentence'].strip()
-                        if self.roberta:
-                            commonsense = self.roberta_classified_z[self.id[index]][str(sent_idx)]["out"]
-
-                        elif self.sentence_transformer:
-                            commonsense = self.sentence_transformer_classified_z[self.id[index]][str(sent_idx)]["out"]
-                            
-                        elif self.relation == '<|best_relation|>':
-                            commonsense = self.compute_best_relation(sentence, sent)
-                        else:
-                            commonsense = sent[self.relation][0].strip()
-
-                        commonsense = commonsense.replace("PersonX","Person").replace("PersonY","Person")
-                        dialogue += person + " said \"" + sentence + ".\"" + '\n'
-                        dialogue_clean +=  person + " said \"" + sentence + ".\"" + '\n' 
-                        if sent['speaker']+sentence != commonsense:
-                            try :
-                                ## Create the context of the utterance to be used to extract the emotion in case of "others' emotion detected."
-                                # n-utterances (n = 5 here)
-                                previous = '\n'.join(line for line in dialogue_clean.splitlines()[-5:] if not line.strip().startswith('<I>'))
-                            except KeyError:
-                                ## In case of non existence of n-previous (for the n-1 first utterances)
-                              previous = dialogue_clean
-                            dialogue += self.process_media_msg(sentence, person, commonsense, previous)
+    def build_dialogue(self, index):
+        if self.paracomet==False: # plain COMET
+            try:
+                
+                dia = self.dialogue_comet_inference[self.id[index]]
+                dialogue=""
+                ## The last n utterances of the original dialogue without commonsense,
+                ## to be used in the case of context emotion-aware commonsense extraction.
+                window = ContextWindow(self.emotion_context)
+                
+                for sent_idx, sent in enumerate(dia):
+                    person = sent['speaker'].replace(": ","").replace(":","").strip()
+                    sentence = sent['sentence'].strip()
+                    if self.roberta:
+                        commonsense = self.roberta_classified_z[self.id[index]][str(sent_idx)]["out"]
 
+                    elif self.sentence_transformer:
+                        commonsense = self.sentence_transformer_classified_z[self.id[index]][str(sent_idx)]["out"]
+                        
+                    elif self.relation == '<|best_relation|>':
+                        commonsense = self.compute_best_relation(sentence, sent)
+                    else:
+                        commonsense = sent[self.relation][0].strip()
 
-                except KeyError:
-                    print("key error")
-                    dialogue = self.dialogue[index]
+                    commonsense = person_normalized(commonsense)
+                    dialogue += person + " said \"" + sentence + ".\"" + '\n'
+                    window.add(person + " said \"" + sentence + ".\"" + '\n')
+                    if sent['speaker']+sentence != commonsense:
+                        ## The context of the utterance to be used to extract the emotion in case of "others' emotion detected."
+                        # n-utterances (n = emotion_context, 5 by default; fewer for the n-1 first utterances)
+                        previous = window.text()
+                        dialogue += self.process_media_msg(sentence, person, commonsense, previous, (self.id[index], sent_idx))
 
-                   
-                        
-            else: # use PARACOMET
-                try:
-                    dia = self.dialogue_comet_inference[self.id[index]]
-                    dialogue=""
-                    ## Dialogue clean consists of the original dialogue without commonsense,
-                    ## to be used in the case of context emotion-aware commonsense extraction.
-                    dialogue_clean = ""
-
-                    ## A variable to store, for each utterance, the n previous utterances used as context.
-                    previous = []
-                    for sent_idx, sent in dia.items():
-                        sentence = sent['sentence'].strip()
-                        person = sentence.split()[0]
-                        if self.roberta:
-                            commonsense = self.roberta_classified_z[self.id[index]][str(sent_idx)]["out"]
-                            
-                        elif self.sentence_transformer:
-                            commonsense = self.sentence_transformer_classified_z[self.id[index]][str(sent_idx)]["out"]
-                        elif self.relation ==  '<|best_relation|>':    
-                            commonsense = self.compute_best_relation(sentence, sent)
-                        else:
-                            #commonsense = sent[self.relation][0].strip() "xReason" is not present in PARACOMET 
-                            commonsense = sent['<|xIntent|>'][0].strip()
-                            
-                        dialogue_clean += sentence +'\n'
-                        dialogue += sentence +'\n'
-                        if sentence != commonsense:
-                            try : 
-                                ## Create the context of the utterance to be used to extract the emotion in case of "others' emotion detected."
-                                # n-utterances (n = 5 here)
-                                previous = '\n'.join(line for line in dialogue_clean.splitlines()[-5:] if not line.strip().startswith('<I>'))
-                            except KeyError:
-                                ## In case of non existence of n-previous (for the n-1 first utterances)
-                                previous = dialogue_clean
-                            dialogue += self.process_media_msg(sentence, person, commonsense, previous)
-                            
-                except KeyError: # when an error occurred while processing commonsense, just give plain utterance as output
-                    print("key error")
-                    dialogue = self.dialogue[index]
-             
-
-            encoded_dialogue = self.tokenizer(dialogue,
-                                            padding='max_length', 
-                                            truncation=True, 
-                                            max_length=self.encoder_max_len, 
-                                            return_tensors='pt')
-
-
-        # (1, sequence_length)
-        with self.tokenizer.as_target_tokenizer():
-            encoded_summary = self.tokenizer(self.summary[index], 
-                                            padding='max_length', 
-                                            truncation=True, 
-                                            max_length=self.decoder_max_len, 
-                                            return_tensors='pt')
-        
-            
-        
-        model_inputs = encoded_dialogue
-        model_inputs['input_ids'] = model_inputs['input_ids'].squeeze(0)
-        model_inputs['attention_mask'] = model_inputs['attention_mask'].squeeze(0)
-        model_inputs['labels'] = encoded_summary['input_ids'].squeeze(0)
 
-        if self.extra_supervision==True:
-            if self.split_type=='train':
-                def split_sentences(text, speaker):
-                    doc = self.nlp(text)
-                    sents = [speaker.replace(":","") + ' said "' + sent.text + '"' for sent in doc.sents]
-                    return sents
+            except KeyError:
+                self.report_key_error()
+                dialogue = self.dialogue[index]
 
-                if self.paracomet==False: # plain COMET
-                    summary_commonsense = ""
+               
+                    
+        else: # use PARACOMET
+            try:
+                dia = self.dialogue_comet_inference[self.id[index]]
+                dialogue=""
+                ## The last n utterances of the original dialogue without commonsense,
+                ## to be used in the case of context emotion-aware commonsense extraction.
+                window = ContextWindow(self.emotion_context)
+                for sent_idx, sent in dia.items():
+                    sentence = sent['sentence'].strip()
+                    person = sentence.split()[0]
                     if self.roberta:
-                        for _, summ in self.roberta_classified_w[self.id[index]].items():
-                            commonsense = summ["out"].strip() + ". "
-                            commonsense = commonsense.replace("PersonX","Person").replace("PersonY","Person")
-                            summary_commonsense += commonsense
-                    elif self.sentence_transformer:
-                        for _, summ in self.sentence_transformer_classified_w[self.id[index]].items():
-                            commonsense = summ["out"].strip() + ". "
-                            commonsense = commonsense.replace("PersonX","Person").replace("PersonY","Person")
-                            summary_commonsense += commonsense
-                    else:
-                        for summ in self.summary_comet_inference[self.id[index]]:
-                            commonsense = summ[self.supervision_relation][0].strip() +'. '
-                            commonsense = commonsense.replace("PersonX","Person").replace("PersonY","Person")
-                            summary_commonsense += commonsense
-
-                    with self.tokenizer.as_target_tokenizer():
-                        encoded_extra_supervision = self.tokenizer(summary_commonsense,
-                                                                padding='max_length',
-                                                                truncation=True,
-                                                                max_length=self.decoder_max_len,
-                                                                return_tensors='pt')
-
-                    model_inputs['extra_labels'] = encoded_extra_supervision['input_ids'].squeeze(0)
-                else: 
-                    if index==6054:
-                        summary_commonsense = "problem with presentation."
-                    elif self.roberta:
-                        summary_commonsense = ""
-                        try:
-                            for _, summ in self.roberta_classified_w[self.id[index]].items():
-                                commonsense = summ["out"].strip() + ". "
-                                commonsense = commonsense.replace("PersonX","Person").replace("PersonY","Person")
-                                summary_commonsense += commonsense
-                        except KeyError:
-                            print("Key error in roberta commonsense extraction")
-                            summary_commonsense = ""
+                        commonsense = self.roberta_classified_z[self.id[index]][str(sent_idx)]["out"]
+                        
                     elif self.sentence_transformer:
-                        summary_commonsense = ""
-                        for _, summ in self.sentence_transformer_classified_w[self.id[index]].items():
-                            commonsense = summ["out"].strip().strip(".") + ". "
-                            commonsense = commonsense.replace("PersonX","Person").replace("PersonY","Person")
-                            summary_commonsense += commonsense
+                        commonsense = self.sentence_transformer_classified_z[self.id[index]][str(sent_idx)]["out"]
+                    elif self.relation ==  '<|best_relation|>':    
+                        commonsense = self.compute_best_relation(sentence, sent)
                     else:
+                        #commonsense = sent[self.relation][0].strip() "xReason" is not present in PARACOMET 
+                        commonsense = sent['<|xIntent|>'][0].strip()
+                        
+                    window.add(sentence +'\n')
+                    dialogue += sentence +'\n'
+                    if sentence != commonsense:
+                        ## The context of the utterance to be used to extract the emotion in case of "others' emotion detected."
+                        # n-utterances (n = emotion_context, 5 by default; fewer for the n-1 first utterances)
+                        previous = window.text()
+                        dialogue += self.process_media_msg(sentence, person, commonsense, previous, (self.id[index], sent_idx))
+                        
+            except KeyError: # when an error occurred while processing commonsense, just give plain utterance as output
+                self.report_key_error()
+                dialogue = self.dialogue[index]
+        return dialogue
+
+    def build_summary_commonsense(self, index):
+        if self.paracomet==False: # plain COMET
+            summary_commonsense = ""
+            if self.roberta:
+                for _, summ in self.roberta_classified_w[self.id[index]].items():
+                    commonsense = person_normalized(summ["out"].strip()) + ". "
+                    summary_commonsense += commonsense
+            elif self.sentence_transformer:
+                for _, summ in self.sentence_transformer_classified_w[self.id[index]].items():
+                    commonsense = person_normalized(summ["out"].strip()) + ". "
+                    summary_commonsense += commonsense
+            else:
+                for summ in self.summary_comet_inference[self.id[index]]:
+                    commonsense = person_normalized(summ[self.supervision_relation][0].strip()) + '. '
+                    summary_commonsense += commonsense
+        else: 
+            if index==6054:
+                summary_commonsense = "problem with presentation."
+            elif self.roberta:
+                summary_commonsense = ""
+                try:
+                    for _, summ in self.roberta_classified_w[self.id[index]].items():
+                        commonsense = person_normalized(summ["out"].strip()) + ". "
+                        summary_commonsense += commonsense
+                except KeyError:
+                    self.report_key_error("Key error in roberta commonsense extraction")
+                    summary_commonsense = ""
+            elif self.sentence_transformer:
+                summary_commonsense = ""
+                for _, summ in self.sentence_transformer_classified_w[self.id[index]].items():
+                    commonsense = person_normalized(summ["out"].strip().strip(".")) + ". "
+                    summary_commonsense += commonsense
+            else:
+                summary_commonsense = ""
+                for _,summ in self.summary_comet_inference[self.id[index]].items():
+                    try:
+                        summary_commonsense += summ[self.supervision_relation][0].strip() +'. '
+                    except KeyError:
+                        self.report_key_error("key error in supervision")
                         summary_commonsense = ""
-                        for _,summ in self.summary_comet_inference[self.id[index]].items():
-                            try:
-                                summary_commonsense += summ[self.supervision_relation][0].strip() +'. '
-                            except KeyError:
-                                print("key error in supervision")
-                                summary_commonsense = ""
-
-                    with self.tokenizer.as_target_tokenizer():
-                        encoded_extra_supervision = self.tokenizer(summary_commonsense,
-                                                                padding='max_length',
-                                                                truncation=True,
-                                                                max_length=self.decoder_max_len,
-                                                                return_tensors='pt')
-
-                    model_inputs['extra_labels'] = encoded_extra_supervision['input_ids'].squeeze(0)
-                # print(summary_commonsense)
-            
-        return model_inputs
+        return summary_commonsense
 
 
 
 
 
-class SamsumDataset_total:
+class SamsumDataset_total(LazySplits):
     def __init__(self, encoder_max_len, decoder_max_len, tokenizer, subset_size, relation, 
                  extra_context=False, extra_supervision=False, paracomet=False,
                  supervision_relation='isAfter',
-                 roberta=False, sentence_transformer=False, emotion = False):
-        self.train_dataset = SamsumDataset(encoder_max_len, decoder_max_len, 'train',tokenizer,subset_size, relation, extra_context=extra_context,extra_supervision=extra_supervision,paracomet=paracomet, supervision_relation=supervision_relation, roberta=roberta, sentence_transformer=sentence_transformer, emotion = emotion)
-        self.eval_dataset = SamsumDataset(encoder_max_len, decoder_max_len, 'validation', tokenizer,subset_size, relation, extra_context=extra_context,extra_supervision=extra_supervision,paracomet=paracomet, supervision_relation=supervision_relation, roberta=roberta, sentence_transformer=sentence_transformer,  emotion = emotion)
-        self.test_dataset = SamsumDataset(encoder_max_len, decoder_max_len, 'test', tokenizer,subset_size, relation, extra_context=extra_context,extra_supervision=extra_supervision,paracomet=paracomet, supervision_relation=supervision_relation, roberta=roberta, sentence_transformer=sentence_transformer,  emotion = emotion)
-    
-    def getTrainData(self):
-        return self.train_dataset
-    
-    def getEvalData(self):
-        return self.eval_dataset
+                 roberta=False, sentence_transformer=False, emotion = False, cache_dir=None, token_store_dir=None, dynamic_padding=False, emotion_dir=None, relation_index=None, num_proc=1, fit_commonsense=False, emotion_context=5):
+        super().__init__(SamsumDataset, subset_size, encoder_max_len=encoder_max_len, decoder_max_len=decoder_max_len, tokenizer=tokenizer, relation=relation, extra_context=extra_context,extra_supervision=extra_supervision,paracomet=paracomet, supervision_relation=supervision_relation, roberta=roberta, sentence_transformer=sentence_transformer, emotion = emotion, cache_dir=cache_dir, token_store_dir=token_store_dir, dynamic_padding=dynamic_padding, emotion_dir=emotion_dir, relation_index=relation_index, num_proc=num_proc, fit_commonsense=fit_commonsense, emotion_context=emotion_context)
 
-    def getTestData(self):
-        return self.test_dataset
+
+## prefix of the DialogSum fname of each split, the dataset ids are the fnames without it
+DIALOGSUM_ID_PREFIX = {'train': 'train_', 'validation': 'dev_', 'test': 'test_'}
+
+
+def dialogsum_path(split):
+    return f"../data/DialogSum_Data/dialogsum.{split}.jsonl"
 
 
-def custom_load_dataset(type,split):
+def custom_load_dataset(type,split,ids=None,index=None):
+    ###########################################################
+    # columns of a split; ids: fnames of the DialogSum records to
+    # load (a random subset), the whole split when None;
+    # index: JsonlIndex of the split by fname, when the caller has it open
+    ###########################################################
     if type == "dialogsum":
-        dir = f"../data/DialogSum_Data/dialogsum.{split}.jsonl"
-        data = {'dialogue': [],'summary':[],'id':[]}
-        with open(dir, 'r') as json_file:
-            json_list = list(json_file)
-        if split == "train":
-            for json_str in json_list:
-                result = json.loads(json_str)
-                data['dialogue'].append(result['dialogue'])
-                data['summary'].append((result['summary']))
-                data['id'].append((result['fname'][6:]))
-        elif split == "validation":
-            for json_str in json_list:
-                result = json.loads(json_str)
-                data['dialogue'].append(result['dialogue'])
-                data['summary'].append((result['summary']))
-                data['id'].append((result['fname'][4:]))
-        elif split == "test":
-            data = {'dialogue': [],'summary':[],'id':[], 'summary2':[], 'summary3':[]}
-            for json_str in json_list:
-                result = json.loads(json_str)
-                data['dialogue'].append(result['dialogue'])
-                data['summary'].append((result['summary1']))
-                data['summary2'].append((result['summary2']))
-                data['summary3'].append((result['summary3']))
-                data['id'].append((result['fname'][5:]))
+        if split not in DIALOGSUM_ID_PREFIX:
+            raise ValueError(f"non-existing DialogSum split {split}")
+        if ids is None:
+            records = stream_jsonl(dialogsum_path(split))
         else:
-            print("non-existing")
-            os.exit()
+            ## only the selected lines are read and parsed, through the offset index by id
+            if index is None:
+                index = JsonlIndex(dialogsum_path(split), id_field='fname')
+            records = index.records_by_id(ids)
+        data = {'dialogue': [],'summary':[],'id':[]}
+        if split == "test":
+            data.update({'summary2':[], 'summary3':[]})
+        for result in records:
+            data['dialogue'].append(result['dialogue'])
+            data['id'].append(result['fname'][len(DIALOGSUM_ID_PREFIX[split]):])
+            if split == "test":
+                data['summary'].append(result['summary1'])
+                data['summary2'].append(result['summary2'])
+                data['summary3'].append(result['summary3'])
+            else:
+                data['summary'].append(result['summary'])
         return data
     elif type == "tweetsumm":
         dialogs_dir = f"../data/Tweetsumm_Data/{split}_dialogs.json"
@@ -452,27 +898,25 @@ def custom_load_dataset(type,split):
         data = {'dialogue': [],'summary':[],'id':[]}
         with open(dialogs_dir, 'r') as json_file:
             all_dialogs = json.load(json_file)
-            for key in all_dialogs.keys():
-                dialog = ''
-                data['id'].append(key[len(split)+1:])
-                for sent in all_dialogs[key]:
-                    sentence = sent['sentence'].replace('\n','')
-                    author = sent['author_id']
-                    dialog += f"#{author}#: {sentence}\n"
-                data['dialogue'].append(dialog)
+        for key, sents in all_dialogs.items():
+            data['id'].append(key[len(split)+1:])
+            lines = []
+            for sent in sents:
+                sentence = sent['sentence'].replace('\n','')
+                lines.append(f"#{sent['author_id']}#: {sentence}\n")
+            data['dialogue'].append(''.join(lines))
 
         with open(summaries_dir, 'r') as json_file:
             all_summaries = json.load(json_file)
-            for key in all_summaries.keys():
-                summ = ''
-                for sent in all_summaries[key]:
-                    summ += sent
-                data['summary'].append(summ)
+        data['summary'] = [''.join(sents) for sents in all_summaries.values()]
         return data
 
 
-class DialogsumDataset(Dataset):
-    def __init__(self, encoder_max_len, decoder_max_len, split_type, tokenizer, subset_size, extra_context=False, extra_supervision=False, paracomet=False, relation="xReason", supervision_relation="isAfter", roberta=False, sentence_transformer=False, emotion = False):
+class DialogsumDataset(CommonsenseDataset):
+    dataset_name = 'dialogsum'
+    multi_reference = True
+
+    def __init__(self, encoder_max_len, decoder_max_len, split_type, tokenizer, subset_size, extra_context=False, extra_supervision=False, paracomet=False, relation="xReason", supervision_relation="isAfter", roberta=False, sentence_transformer=False, emotion = False, cache_dir=None, token_store_dir=None, dynamic_padding=False, emotion_dir=None, relation_index=None, num_proc=1, fit_commonsense=False, emotion_context=5):
         self.encoder_max_len = encoder_max_len
         self.decoder_max_len = decoder_max_len
         self.split_type = split_type
@@ -487,6 +931,23 @@ class DialogsumDataset(Dataset):
         
         self.roberta=roberta
         self.sentence_transformer = sentence_transformer
+        self.cache_dir = cache_dir
+        self.token_store_dir = token_store_dir
+        self.source_files = []
+        self.summary_source_files = []
+        self.augmented_cache = None
+        self.token_store = None
+        self.dynamic_padding = dynamic_padding
+        self.example_lengths = {}
+        self.emotion_dir = emotion_dir
+        self.emotion_store = None
+        self.emotion_requests = None
+        self.relation_index = relation_index
+        self.num_proc = num_proc
+        self.fit_commonsense = fit_commonsense
+        self.key_errors = 0
+        self.emotion_context = emotion_context
+        self.segments = None
 
         if (self.paracomet) and ("<" != self.relation[0]):
             self.relation = f"<|{self.relation}|>"
@@ -503,22 +964,23 @@ class DialogsumDataset(Dataset):
 
         ##################################################
 
-        self.data = custom_load_dataset('dialogsum', split=split_type)
+        ## the subset is drawn over the ids of the split's index, only its records are then parsed
+        ## (random.sample picks the same positions as over range(split_len))
+        selected_ids = None
+        split_index = None
         if self.subset_size < 100 and (split_type == 'train' or split_type == 'validation'):
-          selected_indices = random.sample(range(len(self.data['dialogue'])), int((self.subset_size)/100 * len(self.data['dialogue'])))
-          self.dialogue = [self.data["dialogue"][i]  for i in selected_indices]
-          self.summary = [self.data["summary"][i]  for i in selected_indices]
-          self.id = [self.data["id"][i]  for i in selected_indices]
-        else:
-          self.dialogue = self.data['dialogue']
-          self.summary = self.data['summary']
-          self.id = self.data['id']
+          split_index = JsonlIndex(dialogsum_path(split_type), id_field='fname')
+          split_len = len(split_index)
+          selected_ids = random.sample(split_index.ids, int((self.subset_size)/100 * split_len))
+        self.data = custom_load_dataset('dialogsum', split=split_type, ids=selected_ids, index=split_index)
+        self.dialogue = self.data['dialogue']
+        self.summary = self.data['summary']
+        self.id = self.data['id']
         if split_type == "test":
             self.summary2 = self.data['summary2']
             self.summary3 = self.data['summary3']
             self.id = self.data['id']
 
-        self.nlp = spacy.load('en_core_web_sm')
         
         if self.extra_context==True:
             if self.paracomet==False:
@@ -526,16 +988,13 @@ class DialogsumDataset(Dataset):
                 # CODE FOR COMET 
                 ###########################
                 
-                with open(f"../data/COMET_data/comet/dialogue/dialogsum/comet_{self.split_type}.json") as f:
-                    self.dialogue_comet_inference = json.load(f)
+                self.dialogue_comet_inference = self.load_json(f"../data/COMET_data/comet/dialogue/dialogsum/comet_{self.split_type}.json")
 
                 if self.roberta:
-                    with open(f"../data/COMET_data/comet/dialogue/dialogsum/roberta_nli/roberta_classified_top1_{self.split_type}.json") as f:
-                        self.roberta_classified_z = json.load(f)
+                    self.roberta_classified_z = self.load_json(f"../data/COMET_data/comet/dialogue/dialogsum/roberta_nli/roberta_classified_top1_{self.split_type}.json")
 
                 if self.sentence_transformer:
-                    with open(f"../data/COMET_data/comet/dialogue/dialogsum/sentence_transformer/comet_{self.split_type}_z.json", "r") as f:
-                        self.sentence_transformer_classified_z = json.load(f)
+                    self.sentence_transformer_classified_z = self.load_json(f"../data/COMET_data/comet/dialogue/dialogsum/sentence_transformer/comet_{self.split_type}_z.json")
 
                 
             else:
@@ -543,16 +1002,13 @@ class DialogsumDataset(Dataset):
                 # CODE FOR PARACOMET
                 ###########################
                 
-                with open(f"../data/COMET_data/paracomet/dialogue/dialogsum/dialog_{self.split_type}_split5_collated.json") as f:
-                    self.dialogue_comet_inference = json.load(f)
+                self.dialogue_comet_inference = self.load_json(f"../data/COMET_data/paracomet/dialogue/dialogsum/dialog_{self.split_type}_split5_collated.json")
                 
                 if self.roberta:
-                    with open(f"../data/COMET_data/paracomet/dialogue/dialogsum/roberta_nli/paracomet_dialogsum_roberta_classified_top1_{self.split_type}.json") as f:
-                        self.roberta_classified_z = json.load(f)
+                    self.roberta_classified_z = self.load_json(f"../data/COMET_data/paracomet/dialogue/dialogsum/roberta_nli/paracomet_dialogsum_roberta_classified_top1_{self.split_type}.json")
 
                 if self.sentence_transformer:
-                    with open(f"../data/COMET_data/paracomet/dialogue/dialogsum/sentence_transformer/paracomet_{self.split_type}_z.json", "r") as f:
-                        self.sentence_transformer_classified_z = json.load(f)
+                    self.sentence_transformer_classified_z = self.load_json(f"../data/COMET_data/paracomet/dialogue/dialogsum/sentence_transformer/paracomet_{self.split_type}_z.json")
 
                
         
@@ -562,380 +1018,247 @@ class DialogsumDataset(Dataset):
                     ######################
                     # CODE FOR COMET
                     ######################
-                    with open(f"../data/COMET_data/comet/summary/dialogsum/comet_train_w.json") as f:
-                        self.summary_comet_inference = json.load(f)
+                    self.summary_comet_inference = self.load_json(f"../data/COMET_data/comet/summary/dialogsum/comet_train_w.json", dialogue_source=False)
                     
                     if self.roberta:
-                        with open(f"../data/COMET_data/comet/dialogue/dialogsum/roberta_nli/roberta_classified_top1_w.json")as f:
-                            self.roberta_classified_w = json.load(f)
+                        self.roberta_classified_w = self.load_json(f"../data/COMET_data/comet/dialogue/dialogsum/roberta_nli/roberta_classified_top1_w.json", dialogue_source=False)
 
                     if sentence_transformer:
-                        with open(f"../data/COMET_data/comet/summary/dialogsum/sentence_transformer/comet_train_w.json", "r") as f:
-                            self.sentence_transformer_classified_w = json.load(f)
+                        self.sentence_transformer_classified_w = self.load_json(f"../data/COMET_data/comet/summary/dialogsum/sentence_transformer/comet_train_w.json", dialogue_source=False)
 
                 else:
                     ########################
                     # CODE FOR PARACOMET
                     ########################
-                    with open("../data/COMET_data/paracomet/summary/dialogsum/summary_train_split5_collated.json") as f:
-                        self.summary_comet_inference = json.load(f)
+                    self.summary_comet_inference = self.load_json("../data/COMET_data/paracomet/summary/dialogsum/summary_train_split5_collated.json", dialogue_source=False)
                     
                     if self.roberta:
-                        with open("../data/COMET_data/paracomet/summary/dialogsum/roberta_nli/roberta_classified_top1_w.json") as f:
-                            self.roberta_classified_w = json.load(f)
+                        self.roberta_classified_w = self.load_json("../data/COMET_data/paracomet/summary/dialogsum/roberta_nli/roberta_classified_top1_w.json", dialogue_source=False)
 
                     if sentence_transformer:
-                        with open("../data/COMET_data/paracomet/summary/dialogsum/sentence_transformer/paracomet_train_w.json", "r") as f:
-                            self.sentence_transformer_classified_w = json.load(f)
+                        self.sentence_transformer_classified_w = self.load_json("../data/COMET_data/paracomet/summary/dialogsum/sentence_transformer/paracomet_train_w.json", dialogue_source=False)
 
         self.data_len = len(self.id)
 
+        self.prepare()
+
+    @profiling.timed('best relation')
     def compute_best_relation(self, d: dict):
-      sentence = d['sentence']
-      encoded_sentence = self.tokenizer(sentence,
-                                            padding='max_length', 
-                                            truncation=True, 
-                                            max_length=self.encoder_max_len, 
-                                            return_tensors='pt')
-      commonsenseDict = {}
-      if self.paracomet:
-        commonsenseDict['<|xReact|>'] = d['<|xReact|>'][0]
-        commonsenseDict['<|xWant|>'] = d['<|xWant|>'][0]
-        commonsenseDict['<|xIntent|>'] = d['<|xIntent|>'][0]
-        commonsenseDict['<|xAttr|>'] = d['<|xAttr|>'][0]
-        commonsenseDict['<|xEffect|>'] = d['<|xEffect|>'][0]
-      else:
-        commonsenseDict['HinderedBy'] = d['HinderedBy'][0]
-        commonsenseDict['xWant'] = d['xWant'][0]
-        commonsenseDict['xIntent'] = d['xIntent'][0]
-        commonsenseDict['xNeed'] = d['xNeed'][0]
-        commonsenseDict['xReason'] = d['xReason'][0]
-
-      #print(commonsenseDict)
-        
-      for k, v in commonsenseDict.items():
-        encoded = self.tokenizer(v, padding='max_length', 
-                                              truncation=True, 
-                                              max_length=self.encoder_max_len, 
-                                              return_tensors='pt')
-        similarity = cosine_similarity(encoded_sentence['input_ids'], encoded['input_ids'])
-        commonsenseDict[k] = similarity[0][0]
-      
-      #print(f"The best relation is: {max(commonsenseDict, key=commonsenseDict.get)}")
-      best_relation = max(commonsenseDict, key=commonsenseDict.get)
+      best_relation = self.relation_scorer.best_relation(d['sentence'], d)
       return d[best_relation][0]
 
-    def __len__(self):
-        return self.data_len
+    def needs_sentence_segments(self):
+      return self.extra_context==True and self.paracomet==False and not self.roberta and not self.sentence_transformer
 
-    def __getitem__(self, index):
-        if self.extra_context==False:
-            #(1, sequence_length)
-            encoded_dialogue = self.tokenizer(self.dialogue[index], 
-                                            padding='max_length', 
-                                            truncation=True, 
-                                            max_length=self.encoder_max_len, 
-                                            return_tensors='pt')
-        else:
-            if self.split_type == "validation":
-                dialog_id = f"dev_{self.id[index]}"
+    def comet_key(self, index):
+      if self.split_type == "validation":
+        return f"dev_{self.id[index]}"
+      return f"{self.split_type}_{self.id[index]}"
 
-            else:
-                dialog_id = f"{self.split_type}_{self.id[index]}"
-            if self.sentence_transformer:
-                cur_dialog_data = self.sentence_transformer_classified_z[dialog_id]
-                dialogue = ""
-                for sentence_idx in range(len(cur_dialog_data.keys())):
+    def build_dialogue(self, index):
+        if self.split_type == "validation":
+            dialog_id = f"dev_{self.id[index]}"
+
+        else:
+            dialog_id = f"{self.split_type}_{self.id[index]}"
+        if self.sentence_transformer:
+            cur_dialog_data = self.sentence_transformer_classified_z[dialog_id]
+            dialogue = ""
+            for sentence_idx in range(len(cur_dialog_data.keys())):
+                sentence = cur_dialog_data[str(sentence_idx)]["sentence"]
+                relation = cur_dialog_data[str(sentence_idx)]["relation"]
+                commonsense = cur_dialog_data[str(sentence_idx)]["out"]
+
+                dialogue += sentence + "\n"
+                dialogue+= '<I> '
+                dialogue+= commonsense+'.'
+                dialogue+= ' </I>'+'\n'
+        
+        elif self.roberta:
+            cur_dialog_data = self.roberta_classified_z[dialog_id]
+            dialogue=""
+            for sentence_idx in range(len(cur_dialog_data.keys())):
+                try:
                     sentence = cur_dialog_data[str(sentence_idx)]["sentence"]
                     relation = cur_dialog_data[str(sentence_idx)]["relation"]
                     commonsense = cur_dialog_data[str(sentence_idx)]["out"]
 
                     dialogue += sentence + "\n"
-                    dialogue+= '<I> '
-                    dialogue+= commonsense+'.'
-                    dialogue+= ' </I>'+'\n'
+                    dialogue+= "<I> "
+                    dialogue+= commonsense+"."
+                    dialogue+= " </I>"+"\n"
+                except KeyError:
+                    continue
             
-            elif self.roberta:
-                cur_dialog_data = self.roberta_classified_z[dialog_id]
-                dialogue=""
-                for sentence_idx in range(len(cur_dialog_data.keys())):
-                    try:
-                        sentence = cur_dialog_data[str(sentence_idx)]["sentence"]
-                        relation = cur_dialog_data[str(sentence_idx)]["relation"]
-                        commonsense = cur_dialog_data[str(sentence_idx)]["out"]
-
-                        dialogue += sentence + "\n"
-                        dialogue+= "<I> "
-                        dialogue+= commonsense+"."
-                        dialogue+= " </I>"+"\n"
-                    except KeyError:
-                        continue
-                
 
-            elif self.paracomet==False:
-                #######################
-                # CODE FOR COMET
-                #######################
-                # extra context exist 
-                # z is available
-                splitted_dialogue = self.dialogue[index].replace('\r\n','\n').split('\n')
-                
-                def split_sentences(text, speaker):
-                    doc = self.nlp(text)
-                    sents = [speaker.replace(":","") + ' said "' + sent.text + '"' for sent in doc.sents]
-                    return sents
+        elif self.paracomet==False:
+            #######################
+            # CODE FOR COMET
+            #######################
+            # extra context exist 
+            # z is available
+            splitted_dialogue = self.dialogue[index].replace('\r\n','\n').split('\n')
+            
+            ## sentences of each utterance, split for the whole split at once
+            segments = self.sentence_segments(index)
+            
+            splitted_sentences = []
+            for idx, utterance in enumerate(splitted_dialogue):
+                speaker = re.search(".*?\:",utterance)[0]
+                splitted_sentences.extend(speaker.replace(":","") + ' said "' + sent + '"' for sent in segments[idx])
                 
-                splitted_sentences = []
-                for idx, utterance in enumerate(splitted_dialogue):
-                    speaker = re.search(".*?\:",utterance)[0]
-                    utterance = utterance.replace(speaker,"").strip()
-                    utterance = split_sentences(utterance,speaker)
-                    splitted_sentences.extend(utterance)
-                    
-                dialogue= ""
-                idx=0
-                for utterance in splitted_sentences:
-                    dialogue+= utterance+'\n'
-                    if self.split_type=='train':
-                        try:
-                            while True:
-                                #print(self.dialogue_comet_inference['train_'+self.id[index]][idx]['sentence'] not in ("#Person1#:","#Person2#:"))
-                                #print(self.dialogue_comet_inference['train_'+self.id[index]][idx]['sentence'])
-                                if self.dialogue_comet_inference['train_'+self.id[index]][idx]['sentence'] not in ("#Person1#:","#Person2#:"):
-                                  if self.relation == '<|best_relation|>':
-                                    commonsense = self.compute_best_relation(self.dialogue_comet_inference['train_'+self.id[index]][idx])
-                                    #print(commonsense)
-                                    
-                                  else:
-                                    commonsense = self.dialogue_comet_inference['train_'+self.id[index]][idx][self.relation][0].strip()
-                                    # commonsense = commonsense.replace("PersonX","Person").replace("PersonY","Person")
-                                  break
-                                else:
-                                    idx+=1
-                                continue
-                        except:
+            dialogue= ""
+            idx=0
+            for utterance in splitted_sentences:
+                dialogue+= utterance+'\n'
+                if self.split_type=='train':
+                    try:
+                        while True:
+                            #print(self.dialogue_comet_inference['train_'+self.id[index]][idx]['sentence'] not in ("#Person1#:","#Person2#:"))
+                            #print(self.dialogue_comet_inference['train_'+self.id[index]][idx]['sentence'])
+                            if self.dialogue_comet_inference['train_'+self.id[index]][idx]['sentence'] not in ("#Person1#:","#Person2#:"):
+                              if self.relation == '<|best_relation|>':
+                                commonsense = self.compute_best_relation(self.dialogue_comet_inference['train_'+self.id[index]][idx])
+                                #print(commonsense)
+                                
+                              else:
+                                commonsense = self.dialogue_comet_inference['train_'+self.id[index]][idx][self.relation][0].strip()
+                                # commonsense = commonsense.replace("PersonX","Person").replace("PersonY","Person")
+                              break
+                            else:
+                                idx+=1
                             continue
-                    elif self.split_type=='validation':
-                        try:
-                            while True:
-                                if self.dialogue_comet_inference['dev_'+self.id[index]][idx]['sentence'] not in ("#Person1#:","#Person2#:"):
-                                    if self.relation == '<|best_relation|>':
-                                      commonsense = self.compute_best_relation(self.dialogue_comet_inference['dev_'+self.id[index]][idx])
-                                      
-                                    else:
-                                        commonsense = self.dialogue_comet_inference['dev_'+self.id[index]][idx][self.relation][0].strip()
-                                        commonsense = commonsense.replace("PersonX","Person").replace("PersonY","Person")
-                                    break
+                    except:
+                        continue
+                elif self.split_type=='validation':
+                    try:
+                        while True:
+                            if self.dialogue_comet_inference['dev_'+self.id[index]][idx]['sentence'] not in ("#Person1#:","#Person2#:"):
+                                if self.relation == '<|best_relation|>':
+                                  commonsense = self.compute_best_relation(self.dialogue_comet_inference['dev_'+self.id[index]][idx])
+                                  
                                 else:
-                                    idx+=1
-                                continue
-                        except:
+                                    commonsense = self.dialogue_comet_inference['dev_'+self.id[index]][idx][self.relation][0].strip()
+                                    commonsense = person_normalized(commonsense)
+                                break
+                            else:
+                                idx+=1
                             continue
-                    else: # self.split_type=='test':
-                        try:
-                            while True:
-                                if self.dialogue_comet_inference['test_'+self.id[index]][idx]['sentence'] not in ("#Person1#:","#Person2#:"):
-                                  if self.relation == '<|best_relation|>':
-                                    commonsense = self.compute_best_relation(self.dialogue_comet_inference['test_'+self.id[index]][idx])
-                                  else:
-                                    commonsense = self.dialogue_comet_inference['test_'+self.id[index]][idx][self.relation][0].strip()
-                                  break
-                                else:
-                                    idx+=1
-                                continue
-
-                        except:
+                    except:
+                        continue
+                else: # self.split_type=='test':
+                    try:
+                        while True:
+                            if self.dialogue_comet_inference['test_'+self.id[index]][idx]['sentence'] not in ("#Person1#:","#Person2#:"):
+                              if self.relation == '<|best_relation|>':
+                                commonsense = self.compute_best_relation(self.dialogue_comet_inference['test_'+self.id[index]][idx])
+                              else:
+                                commonsense = self.dialogue_comet_inference['test_'+self.id[index]][idx][self.relation][0].strip()
+                              break
+                            else:
+                                idx+=1
                             continue
-                    if 'none' not in commonsense:
-                        dialogue+= '<I> '
-                        dialogue+= commonsense+'.'
-                        dialogue+= ' </I>'+'\n'
-                    idx+=1
-                    #print(dialogue)
-            ############################### PARACOMET START #######################################################
-            else:
-                
-                if self.split_type=='validation':
-                    dia = self.dialogue_comet_inference['dev'+'_'+self.id[index]]
-                else:
-                    dia = self.dialogue_comet_inference[self.split_type+'_'+self.id[index]]
-                dialogue=""
-                dialogue_clean = ""
-                for _,sent in dia.items():
-                    sentence = sent['sentence'].strip()
-                    person = sentence.split()[0]
-                    if self.relation == '<|best_relation|>':
-                      commonsense = self.compute_best_relation(sent)
-                    else:
-                      commonsense = sent[self.relation][0].strip()
-
-                    dialogue += sentence +"\n"
-                    dialogue_clean +=  sentence + ".\"" + '\n' 
-                    if sentence != commonsense:
-                        if ('<file_photo>' in sentence) or ('<photo_file>' in sentence) or ('<file_picture>' in sentence):
-                            dialogue += "<I> " + person + " sent a photo. </I>" + '\n' 
-                        elif ('<video>' in sentence) or ('<file_video>' in sentence):
-                            dialogue += "<I> " + person + " sent a video. </I>" + '\n'
-                        elif '<file_gif>' in sentence:
-                            dialogue += "<I> " + person + " sent a file. </I>" + '\n'
-                        elif ('<file_other>' in sentence) or ('<file_others>' in sentence):
-                            dialogue += "<I> " + person + " sent a file. </I>" + '\n'
-                        elif ('<link>' in sentence) or ('<file_link>' in sentence):
-                            dialogue += "<I> " + person + " sent a link. </I>" + '\n'
-                        elif '<location>' in sentence:
-                            dialogue += "<I> " + person + " sent a location. </I>" + '\n'
-                        else:
-                            if commonsense.strip() != 'none':
-                                ## ADD emotion
-                                if self.emotion == True :   ## Create the emotion aware commensense 
-                                    ## Detect the emotion from the given utterance
-                                    emotion = emotion_analyzer.predict(sentence).output
-                                    ## emotion injection 
-                                    if emotion == "others" : ## In case of "others" emotion detected 
-                                        ## Create the context consisiting of previous utterances
-                                        previous = '\n'.join(line for line in dialogue_clean.splitlines()[-5:] if not line.strip().startswith('<I>'))
-                                        ## We analyzee the previous context of the dialogue to extract the new emotion
-                                        emotion2 = emotion_analyzer.predict(previous).output 
-                                        ## Inject the new context emotion aware commensense
-                                        dialogue += "<I> " + commonsense.strip() + "," + emotion2 + ". </I>" + '\n'
-                                    else :
-                                        ## Inject the new  emotion aware commensense
-                                        dialogue += "<I> " + commonsense.strip() + "," + emotion + ". </I>" + '\n'
-                                else : ## Emotion not extracted
-                                    dialogue += "<I> " + commonsense.strip() + ". </I>" + '\n'
-            encoded_dialogue = self.tokenizer(dialogue,
-                                            padding='max_length', 
-                                            truncation=True, 
-                                            max_length=self.encoder_max_len, 
-                                            add_special_tokens=True,
-                                            return_tensors='pt')
-
-        # (1, sequence_length)
-        #with self.tokenizer.as_target_tokenizer():
-        encoded_summary = self.tokenizer(self.summary[index], 
-                                            padding='max_length', 
-                                            truncation=True, 
-                                            max_length=self.decoder_max_len, 
-                                            add_special_tokens=True,
-                                            return_tensors='pt')
-        
-        
-        model_inputs = encoded_dialogue
-        model_inputs['input_ids'] = model_inputs['input_ids'].squeeze(0)
-        model_inputs['attention_mask'] = model_inputs['attention_mask'].squeeze(0)
-        model_inputs['labels'] = encoded_summary['input_ids']
-        def shift_tokens_right(input_ids: torch.Tensor, pad_token_id: int, decoder_start_token_id: int):
-            """
-            Shift input ids one token to the right.
-            """
-            shifted_input_ids = input_ids.new_zeros(input_ids.shape)
-
-            shifted_input_ids[:, 1:] = input_ids[:, :-1].clone()
-            shifted_input_ids[:, 0] = decoder_start_token_id
-
-            if pad_token_id is None:
-                raise ValueError("self.model.config.pad_token_id has to be defined.")
-            # replace possible -100 values in labels by `pad_token_id`
-            shifted_input_ids.masked_fill_(shifted_input_ids == -100, pad_token_id)
-
-            return shifted_input_ids
-
-        #model_inputs['decoder_input_ids'] = shift_tokens_right(model_inputs['labels'].clone(),self.tokenizer.pad_token_id,0).squeeze(0)
-        model_inputs['labels'] = model_inputs['labels'].squeeze(0)
-
-        
-
-
-        if self.split_type == "test":
-            encoded_summary2 = self.tokenizer(self.summary2[index], 
-                                            padding='max_length', 
-                                            truncation=True, 
-                                            max_length=self.decoder_max_len, 
-                                            return_tensors='pt')
-            model_inputs['labels2'] = encoded_summary2['input_ids'].squeeze(0)
-
-
-        
-            encoded_summary3 = self.tokenizer(self.summary3[index], 
-                                            padding='max_length', 
-                                            truncation=True, 
-                                            max_length=self.decoder_max_len, 
-                                            return_tensors='pt')
-            model_inputs['labels3'] = encoded_summary3['input_ids'].squeeze(0)
-
-        
 
-
-        if self.extra_supervision==True:
-            if self.split_type=='train':
-                if self.sentence_transformer:
-                    cur_summary_commonsense_data = self.sentence_transformer_classified_w[f"train_{self.id[index]}"]
-                    summary_commonsense = ""
-                    for summary_sentence_idx in range(len(cur_summary_commonsense_data.keys())):
-                        commonsense = cur_summary_commonsense_data[str(summary_sentence_idx)]["out"].strip()+" ."
-                        summary_commonsense += commonsense
-
-                    
-                elif self.roberta:
-                    cur_summary_commonsense_data =  self.roberta_classified_w[f"train_{self.id[index]}"]
-                    summary_commonsense = ""
-                    for summary_sentence_idx in range(len(cur_summary_commonsense_data.keys())):
-                        commonsense = cur_summary_commonsense_data[str(summary_sentence_idx)]["out"].strip()+" ."
-                        summary_commonsense += commonsense
-
-                
-
-                elif self.paracomet==False:
-                    summary_commonsense = ""
-                    for summ in self.summary_comet_inference["train_"+self.id[index]]:
-                        commonsense = summ[self.supervision_relation][0].strip() +'. '
-                        commonsense = commonsense.replace('PersonX','Person').replace('PersonY','Person')
-                        summary_commonsense += commonsense
-
-                ####################################### PARACOMET START ###########################################
+                    except:
+                        continue
+                if 'none' not in commonsense:
+                    dialogue+= '<I> '
+                    dialogue+= commonsense+'.'
+                    dialogue+= ' </I>'+'\n'
+                idx+=1
+                #print(dialogue)
+        ############################### PARACOMET START #######################################################
+        else:
+            
+            if self.split_type=='validation':
+                dia = self.dialogue_comet_inference['dev'+'_'+self.id[index]]
+            else:
+                dia = self.dialogue_comet_inference[self.split_type+'_'+self.id[index]]
+            dialogue=""
+            window = ContextWindow(self.emotion_context)
+            for sent_idx,sent in dia.items():
+                sentence = sent['sentence'].strip()
+                person = sentence.split()[0]
+                if self.relation == '<|best_relation|>':
+                  commonsense = self.compute_best_relation(sent)
                 else:
-                    summary_commonsense = ""
-                    if self.split_type=='validation':
-                        for _,summ in self.summary_comet_inference['dev'+'_'+self.id[index]].items():
-                            summary_commonsense += summ[self.supervision_relation][0].strip() +'. '
+                  commonsense = sent[self.relation][0].strip()
+
+                dialogue += sentence +"\n"
+                window.add(sentence + ".\"" + '\n')
+                if sentence != commonsense:
+                    if ('<file_photo>' in sentence) or ('<photo_file>' in sentence) or ('<file_picture>' in sentence):
+                        dialogue += "<I> " + person + " sent a photo. </I>" + '\n' 
+                    elif ('<video>' in sentence) or ('<file_video>' in sentence):
+                        dialogue += "<I> " + person + " sent a video. </I>" + '\n'
+                    elif '<file_gif>' in sentence:
+                        dialogue += "<I> " + person + " sent a file. </I>" + '\n'
+                    elif ('<file_other>' in sentence) or ('<file_others>' in sentence):
+                        dialogue += "<I> " + person + " sent a file. </I>" + '\n'
+                    elif ('<link>' in sentence) or ('<file_link>' in sentence):
+                        dialogue += "<I> " + person + " sent a link. </I>" + '\n'
+                    elif '<location>' in sentence:
+                        dialogue += "<I> " + person + " sent a location. </I>" + '\n'
                     else:
-                        for _,summ in self.summary_comet_inference[self.split_type+'_'+self.id[index]].items():
-                            summary_commonsense += summ[self.supervision_relation][0].strip() +'. '
-
-                with self.tokenizer.as_target_tokenizer():
-                    encoded_extra_supervision = self.tokenizer(summary_commonsense,
-                                                            padding='max_length',
-                                                            truncation=True,
-                                                            max_length=self.decoder_max_len,
-                                                            return_tensors='pt')
-
-                model_inputs['extra_labels'] = encoded_extra_supervision['input_ids'].squeeze(0)
-                    
-        return model_inputs
+                        if commonsense.strip() != 'none':
+                            ## ADD emotion
+                            if self.emotion == True :   ## Create the emotion aware commensense 
+                                ## Create the context consisiting of previous utterances
+                                previous = window.text()
+                                ## Detect the emotion from the given utterance, or from the previous context in case of "others" emotion detected
+                                emotion = self.emotion_of(sentence, previous, (self.id[index], sent_idx))
+                                ## Inject the new  emotion aware commensense
+                                dialogue += "<I> " + commonsense.strip() + "," + emotion + ". </I>" + '\n'
+                            else : ## Emotion not extracted
+                                dialogue += "<I> " + commonsense.strip() + ". </I>" + '\n'
+        return dialogue
+
+    def build_summary_commonsense(self, index):
+        if self.sentence_transformer:
+            cur_summary_commonsense_data = self.sentence_transformer_classified_w[f"train_{self.id[index]}"]
+            summary_commonsense = ""
+            for summary_sentence_idx in range(len(cur_summary_commonsense_data.keys())):
+                commonsense = cur_summary_commonsense_data[str(summary_sentence_idx)]["out"].strip()+" ."
+                summary_commonsense += commonsense
+
+        elif self.roberta:
+            cur_summary_commonsense_data =  self.roberta_classified_w[f"train_{self.id[index]}"]
+            summary_commonsense = ""
+            for summary_sentence_idx in range(len(cur_summary_commonsense_data.keys())):
+                commonsense = cur_summary_commonsense_data[str(summary_sentence_idx)]["out"].strip()+" ."
+                summary_commonsense += commonsense
+
+        elif self.paracomet==False:
+            summary_commonsense = ""
+            for summ in self.summary_comet_inference["train_"+self.id[index]]:
+                commonsense = person_normalized(summ[self.supervision_relation][0].strip()) + '. '
+                summary_commonsense += commonsense
+
+        ####################################### PARACOMET START ###########################################
+        else:
+            summary_commonsense = ""
+            if self.split_type=='validation':
+                for _,summ in self.summary_comet_inference['dev'+'_'+self.id[index]].items():
+                    summary_commonsense += summ[self.supervision_relation][0].strip() +'. '
+            else:
+                for _,summ in self.summary_comet_inference[self.split_type+'_'+self.id[index]].items():
+                    summary_commonsense += summ[self.supervision_relation][0].strip() +'. '
+        return summary_commonsense
 
 
-class DialogsumDataset_total:
+class DialogsumDataset_total(LazySplits):
     def __init__(self, encoder_max_len, decoder_max_len, tokenizer, subset_size, 
                  extra_context=False, extra_supervision=False, paracomet=False, 
                  relation="xReason",roberta=False,supervision_relation='isAfter', 
-                 sentence_transformer=False, emotion = False):
-        self.train_dataset = DialogsumDataset(encoder_max_len, decoder_max_len, 'train',tokenizer,subset_size, extra_context,extra_supervision,paracomet=paracomet,relation=relation,roberta=roberta,supervision_relation=supervision_relation, sentence_transformer=sentence_transformer,  emotion = emotion)
-        self.eval_dataset = DialogsumDataset(encoder_max_len, decoder_max_len, 'validation', tokenizer,subset_size, extra_context,extra_supervision,paracomet=paracomet,relation=relation,roberta=roberta,supervision_relation=supervision_relation, sentence_transformer=sentence_transformer,  emotion = emotion)
-        self.test_dataset = DialogsumDataset(encoder_max_len, decoder_max_len, 'test', tokenizer,subset_size, extra_context,extra_supervision,paracomet=paracomet,relation=relation,roberta=roberta,supervision_relation=supervision_relation, sentence_transformer=sentence_transformer,  emotion = emotion)
-        print(self.train_dataset.data_len)
-    def getTrainData(self):
-        return self.train_dataset
-    
-    def getEvalData(self):
-        return self.eval_dataset
+                 sentence_transformer=False, emotion = False, cache_dir=None, token_store_dir=None, dynamic_padding=False, emotion_dir=None, relation_index=None, num_proc=1, fit_commonsense=False, emotion_context=5):
+        super().__init__(DialogsumDataset, subset_size, encoder_max_len=encoder_max_len, decoder_max_len=decoder_max_len, tokenizer=tokenizer, extra_context=extra_context,extra_supervision=extra_supervision,paracomet=paracomet,relation=relation,roberta=roberta,supervision_relation=supervision_relation, sentence_transformer=sentence_transformer,  emotion = emotion, cache_dir=cache_dir, token_store_dir=token_store_dir, dynamic_padding=dynamic_padding, emotion_dir=emotion_dir, relation_index=relation_index, num_proc=num_proc, fit_commonsense=fit_commonsense, emotion_context=emotion_context)
 
-    def getTestData(self):
-        return self.test_dataset
 
 
+class TweetsummDataset(CommonsenseDataset):
+    dataset_name = 'tweetsumm'
 
-class TweetsummDataset(Dataset):
-    def __init__(self, encoder_max_len, decoder_max_len, split_type, tokenizer, subset_size, extra_context=False, extra_supervision=False, paracomet=False, relation="xReason", supervision_relation="isAfter", roberta=False, sentence_transformer=False, emotion = False):
+    def __init__(self, encoder_max_len, decoder_max_len, split_type, tokenizer, subset_size, extra_context=False, extra_supervision=False, paracomet=False, relation="xReason", supervision_relation="isAfter", roberta=False, sentence_transformer=False, emotion = False, cache_dir=None, token_store_dir=None, dynamic_padding=False, emotion_dir=None, relation_index=None, num_proc=1, fit_commonsense=False, emotion_context=5):
         self.encoder_max_len = encoder_max_len
         self.decoder_max_len = decoder_max_len
         self.split_type = split_type
@@ -950,6 +1273,23 @@ class TweetsummDataset(Dataset):
         
         self.roberta=roberta
         self.sentence_transformer = sentence_transformer
+        self.cache_dir = cache_dir
+        self.token_store_dir = token_store_dir
+        self.source_files = []
+        self.summary_source_files = []
+        self.augmented_cache = None
+        self.token_store = None
+        self.dynamic_padding = dynamic_padding
+        self.example_lengths = {}
+        self.emotion_dir = emotion_dir
+        self.emotion_store = None
+        self.emotion_requests = None
+        self.relation_index = relation_index
+        self.num_proc = num_proc
+        self.fit_commonsense = fit_commonsense
+        self.key_errors = 0
+        self.emotion_context = emotion_context
+        self.segments = None
 
         self.supervision_relation = supervision_relation
         if not self.sentence_transformer:
@@ -976,7 +1316,6 @@ class TweetsummDataset(Dataset):
           self.id = self.data['id']
         
         
-        self.nlp = spacy.load('en_core_web_sm')
         
         if self.extra_context==True:
             if self.paracomet==False:
@@ -984,8 +1323,7 @@ class TweetsummDataset(Dataset):
                 # CODE FOR COMET 
                 ###########################
                 
-                with open(f"../data/COMET_data/comet/dialogue/tweetsumm/comet_{self.split_type}.json") as f:
-                    self.dialogue_comet_inference = json.load(f)
+                self.dialogue_comet_inference = self.load_json(f"../data/COMET_data/comet/dialogue/tweetsumm/comet_{self.split_type}.json")
 
                 if self.roberta:
                     print("ROBERTA not available for tweetsumm")
@@ -1007,8 +1345,7 @@ class TweetsummDataset(Dataset):
                     ######################
                     # CODE FOR COMET
                     ######################
-                    with open(f"../data/COMET_data/comet/summary/tweetsumm/comet_train.json") as f:
-                        self.summary_comet_inference = json.load(f)
+                    self.summary_comet_inference = self.load_json(f"../data/COMET_data/comet/summary/tweetsumm/comet_train.json", dialogue_source=False)
                     
                     if self.roberta:
                         print("ROBERTA not available for tweetsumm")
@@ -1023,256 +1360,157 @@ class TweetsummDataset(Dataset):
                     print("PARACOMET not available for tweetsumm")
 
         self.data_len = len(self.id)
+
+        self.prepare()
     
+    @profiling.timed('best relation')
     def compute_best_relation(self, d: dict):
-      #print(f"Sentence: {sentence}")
-      sentence = d['sentence']
-      encoded_sentence = self.tokenizer(sentence,
-                                            padding='max_length', 
-                                            truncation=True, 
-                                            max_length=self.encoder_max_len, 
-                                            return_tensors='pt')
-      commonsenseDict = {}
-      if self.paracomet:
-        commonsenseDict['<|xReact|>'] = d['<|xReact|>'][0]
-        commonsenseDict['<|xWant|>'] = d['<|xWant|>'][0]
-        commonsenseDict['<|xIntent|>'] = d['<|xIntent|>'][0]
-        commonsenseDict['<|xAttr|>'] = d['<|xAttr|>'][0]
-        commonsenseDict['<|xEffect|>'] = d['<|xEffect|>'][0]
-      else:
-        commonsenseDict['HinderedBy'] = d['HinderedBy'][0]
-        commonsenseDict['xWant'] = d['xWant'][0]
-        commonsenseDict['xIntent'] = d['xIntent'][0]
-        commonsenseDict['xNeed'] = d['xNeed'][0]
-        commonsenseDict['xReason'] = d['xReason'][0]
-
-      #print(commonsenseDict)
-        
-      for k, v in commonsenseDict.items():
-        encoded = self.tokenizer(v, padding='max_length', 
-                                              truncation=True, 
-                                              max_length=self.encoder_max_len, 
-                                              return_tensors='pt')
-        similarity = cosine_similarity(encoded_sentence['input_ids'], encoded['input_ids'])
-        commonsenseDict[k] = similarity[0][0]
-      
-      #print(f"The best relation is: {max(commonsenseDict, key=commonsenseDict.get)}")
-      best_relation = max(commonsenseDict, key=commonsenseDict.get)
+      best_relation = self.relation_scorer.best_relation(d['sentence'], d)
       return d[best_relation][0]
 
+    def needs_sentence_segments(self):
+      return self.extra_context==True and self.paracomet==False and not self.roberta and not self.sentence_transformer
 
-    def __len__(self):
-        return self.data_len
+    def comet_key(self, index):
+      if self.split_type == "validation":
+        return f"dev_{self.id[index]}"
+      return f"{self.split_type}_{self.id[index]}"
+
+
+    def build_dialogue(self, index):
+        if self.split_type == "validation":
+            dialog_id = f"dev_{self.id[index]}"
 
-    def __getitem__(self, index):
-        if self.extra_context==False:
-            #(1, sequence_length)
-            encoded_dialogue = self.tokenizer(self.dialogue[index], 
-                                            padding='max_length', 
-                                            truncation=True, 
-                                            max_length=self.encoder_max_len, 
-                                            return_tensors='pt')
         else:
-            if self.split_type == "validation":
-                dialog_id = f"dev_{self.id[index]}"
+            dialog_id = f"{self.split_type}_{self.id[index]}"
+        if self.sentence_transformer:
+            print("Sentence Transformer not available for tweetsumm")
+        
+        elif self.roberta:
+            print("ROBERTA not available for tweetsumm")
+            
 
-            else:
-                dialog_id = f"{self.split_type}_{self.id[index]}"
-            if self.sentence_transformer:
-                print("Sentence Transformer not available for tweetsumm")
+        elif self.paracomet==False:
+            #######################
+            # CODE FOR COMET
+            #######################
+            # extra context exist 
+            # z is available
+            splitted_dialogue = self.dialogue[index].replace('\r\n','\n').split('\n')
             
-            elif self.roberta:
-                print("ROBERTA not available for tweetsumm")
+            ## sentences of each utterance, split for the whole split at once
+            segments = self.sentence_segments(index)
+            
+            splitted_sentences = []
+            for idx, utterance in enumerate(splitted_dialogue):
+                speaker_match = re.search(".*?:", utterance)
+                if speaker_match:
+                    speaker = speaker_match.group()
+                else:
+                  continue
                 
 
-            elif self.paracomet==False:
-                #######################
-                # CODE FOR COMET
-                #######################
-                # extra context exist 
-                # z is available
-                splitted_dialogue = self.dialogue[index].replace('\r\n','\n').split('\n')
-                
-                def split_sentences(text, speaker):
-                    doc = self.nlp(text)
-                    sents = [speaker.replace(":","") + ' said "' + sent.text + '"' for sent in doc.sents]
-                    return sents
-                
-                splitted_sentences = []
-                for idx, utterance in enumerate(splitted_dialogue):
-                    speaker_match = re.search(".*?:", utterance)
-                    if speaker_match:
-                        speaker = speaker_match.group()
-                    else:
-                      continue
-                    
+                splitted_sentences.extend(speaker.replace(":","") + ' said "' + sent + '"' for sent in segments[idx])
 
-                    utterance = utterance.replace(speaker,"").strip()
-                    utterance = split_sentences(utterance,speaker)
-                    splitted_sentences.extend(utterance)
-
-                dialogue= ""
-                dialogue_clean = ""
-                idx=0
-                for utterance in splitted_sentences:
-                    dialogue+= utterance+'\n'
-                    dialogue_clean += utterance+'\n'
-                    if self.split_type=='train':
-                        try:
-                            while True:
-                                if self.dialogue_comet_inference['train_'+self.id[index]][idx]['sentence'] not in ("#Person1#:","#Person2#:"):
-                                    if self.relation == '<|best_relation|>':
-                                        commonsense = self.compute_best_relation(self.dialogue_comet_inference['train_'+self.id[index]][idx])
-                                    
-                                    else:
-                                        commonsense = self.dialogue_comet_inference['train_'+self.id[index]][idx][self.relation][0].strip()
-                                    break
+            dialogue= ""
+            window = ContextWindow(self.emotion_context)
+            idx=0
+            for utterance in splitted_sentences:
+                dialogue+= utterance+'\n'
+                window.add(utterance+'\n')
+                if self.split_type=='train':
+                    try:
+                        while True:
+                            if self.dialogue_comet_inference['train_'+self.id[index]][idx]['sentence'] not in ("#Person1#:","#Person2#:"):
+                                if self.relation == '<|best_relation|>':
+                                    commonsense = self.compute_best_relation(self.dialogue_comet_inference['train_'+self.id[index]][idx])
+                                
                                 else:
-                                    idx+=1
-                                continue
-                        except:
+                                    commonsense = self.dialogue_comet_inference['train_'+self.id[index]][idx][self.relation][0].strip()
+                                break
+                            else:
+                                idx+=1
                             continue
-                    elif self.split_type=='validation':
-                        try:
-                            while True:
-                                if self.dialogue_comet_inference['dev_'+self.id[index]][idx]['sentence'] not in ("#Person1#:","#Person2#:"):
-                                    if self.relation == '<|best_relation|>':
-                                      commonsense = self.compute_best_relation(self.dialogue_comet_inference['dev_'+self.id[index]][idx])
-                                      
-                                    else:
-                                        commonsense = self.dialogue_comet_inference['dev_'+self.id[index]][idx][self.relation][0].strip()
-                                        commonsense = commonsense.replace("PersonX","Person").replace("PersonY","Person")
-                                    break
+                    except:
+                        continue
+                elif self.split_type=='validation':
+                    try:
+                        while True:
+                            if self.dialogue_comet_inference['dev_'+self.id[index]][idx]['sentence'] not in ("#Person1#:","#Person2#:"):
+                                if self.relation == '<|best_relation|>':
+                                  commonsense = self.compute_best_relation(self.dialogue_comet_inference['dev_'+self.id[index]][idx])
+                                  
                                 else:
-                                    idx+=1
-                                continue
-                        except:
+                                    commonsense = self.dialogue_comet_inference['dev_'+self.id[index]][idx][self.relation][0].strip()
+                                    commonsense = person_normalized(commonsense)
+                                break
+                            else:
+                                idx+=1
                             continue
-                    else:
-                        try:
-                            while True:
-                                if self.dialogue_comet_inference['test_'+self.id[index]][idx]['sentence'] not in ("#Person1#:","#Person2#:"):
-                                  if self.relation == '<|best_relation|>':
-                                    commonsense = self.compute_best_relation(self.dialogue_comet_inference['test_'+self.id[index]][idx])
-                                  else:
-                                    commonsense = self.dialogue_comet_inference['test_'+self.id[index]][idx][self.relation][0].strip()
-                                  break
-                                else:
-                                    idx+=1
-                                continue
-
-                        except:
+                    except:
+                        continue
+                else:
+                    try:
+                        while True:
+                            if self.dialogue_comet_inference['test_'+self.id[index]][idx]['sentence'] not in ("#Person1#:","#Person2#:"):
+                              if self.relation == '<|best_relation|>':
+                                commonsense = self.compute_best_relation(self.dialogue_comet_inference['test_'+self.id[index]][idx])
+                              else:
+                                commonsense = self.dialogue_comet_inference['test_'+self.id[index]][idx][self.relation][0].strip()
+                              break
+                            else:
+                                idx+=1
                             continue
 
-                    if 'none' not in commonsense:
-                        ## ADD emotion
-                        if self.emotion == True :  ## Create the emotion aware commensense 
-                            ## Detect the emotion from the given utterance
-                            emotion = emotion_analyzer.predict(utterance).output
-                            if emotion == "others" : ## In case of "others" eemotion detected 
-                                ## Create the context consisiting of previous utterances
-                                previous = '\n'.join(line for line in dialogue_clean.splitlines()[-5:] if not line.strip().startswith('<I>'))
-                                ## We analyzee the previous context of the dialogue to extract the new emotion
-                                emotion2 = emotion_analyzer.predict(previous).output 
-                                ## Inject the new context emotion aware commensense
-                                dialogue += "<I> " + commonsense.strip() + "," + emotion2 + ". </I>" + '\n'
-                            else :
-                                ## Inject the new  emotion aware commensense
-                                dialogue += "<I> " + commonsense.strip() + "," + emotion + ". </I>" + '\n'
-                        else :   ## Emotion not extracted 
-                            dialogue+= '<I> '
-                            dialogue+= commonsense+'.'
-                            dialogue+= ' </I>'+'\n'
-                    idx+=1
-            ############################### PARACOMET START #######################################################
-            else:
-                print("PARACOMET not available for tweetsumm")
-
-            encoded_dialogue = self.tokenizer(dialogue,
-                                            padding='max_length', 
-                                            truncation=True, 
-                                            max_length=self.encoder_max_len, 
-                                            add_special_tokens=True,
-                                            return_tensors='pt')
-
-        encoded_summary = self.tokenizer(self.summary[index], 
-                                            padding='max_length', 
-                                            truncation=True, 
-                                            max_length=self.decoder_max_len, 
-                                            add_special_tokens=True,
-                                            return_tensors='pt')
-        
-        
-        model_inputs = encoded_dialogue
-        model_inputs['input_ids'] = model_inputs['input_ids'].squeeze(0)
-        model_inputs['attention_mask'] = model_inputs['attention_mask'].squeeze(0)
-        model_inputs['labels'] = encoded_summary['input_ids']
-        def shift_tokens_right(input_ids: torch.Tensor, pad_token_id: int, decoder_start_token_id: int):
-            """
-            Shift input ids one token to the right.
-            """
-            shifted_input_ids = input_ids.new_zeros(input_ids.shape)
-
-            shifted_input_ids[:, 1:] = input_ids[:, :-1].clone()
-            shifted_input_ids[:, 0] = decoder_start_token_id
-
-            if pad_token_id is None:
-                raise ValueError("self.model.config.pad_token_id has to be defined.")
-            shifted_input_ids.masked_fill_(shifted_input_ids == -100, pad_token_id)
-
-            return shifted_input_ids
-
-        model_inputs['labels'] = model_inputs['labels'].squeeze(0)
-
-        
-
-
-        if self.extra_supervision==True:
-            if self.split_type=='train':
-                if self.sentence_transformer:
-                    print
-                    
-                elif self.roberta:
-                    print("ROBERTA not available for tweetsumm")
+                    except:
+                        continue
 
-                elif self.paracomet==False:
-                    summary_commonsense = ""
-                    for summ in self.summary_comet_inference["train_"+self.id[index]]:
-                        commonsense = summ[self.supervision_relation][0].strip() +'. '
-                        commonsense = commonsense.replace('PersonX','Person').replace('PersonY','Person')
-                        summary_commonsense += commonsense
+                if 'none' not in commonsense:
+                    ## ADD emotion
+                    if self.emotion == True :  ## Create the emotion aware commensense 
+                        ## Create the context consisiting of previous utterances
+                        previous = window.text()
+                        ## Detect the emotion from the given utterance, or from the previous context in case of "others" emotion detected
+                        emotion = self.emotion_of(utterance, previous, (self.id[index], idx))
+                        ## Inject the new  emotion aware commensense
+                        dialogue += "<I> " + commonsense.strip() + "," + emotion + ". </I>" + '\n'
+                    else :   ## Emotion not extracted 
+                        dialogue+= '<I> '
+                        dialogue+= commonsense+'.'
+                        dialogue+= ' </I>'+'\n'
+                idx+=1
+        ############################### PARACOMET START #######################################################
+        else:
+            print("PARACOMET not available for tweetsumm")
+        return dialogue
 
-                ####################################### PARACOMET START ###########################################
-                else:
-                    print("PARACOMET not available for tweetsumm")
+    def build_summary_commonsense(self, index):
+        if self.sentence_transformer:
+            print
+            
+        elif self.roberta:
+            print("ROBERTA not available for tweetsumm")
 
-                with self.tokenizer.as_target_tokenizer():
-                    encoded_extra_supervision = self.tokenizer(summary_commonsense,
-                                                            padding='max_length',
-                                                            truncation=True,
-                                                            max_length=self.decoder_max_len,
-                                                            return_tensors='pt')
+        elif self.paracomet==False:
+            summary_commonsense = ""
+            for summ in self.summary_comet_inference["train_"+self.id[index]]:
+                commonsense = person_normalized(summ[self.supervision_relation][0].strip()) + '. '
+                summary_commonsense += commonsense
 
-                model_inputs['extra_labels'] = encoded_extra_supervision['input_ids'].squeeze(0)
-                    
-        return model_inputs
+        ####################################### PARACOMET START ###########################################
+        else:
+            print("PARACOMET not available for tweetsumm")
+        return summary_commonsense
 
 
-class TweetsummDataset_total:
+class TweetsummDataset_total(LazySplits):
     def __init__(self, encoder_max_len, decoder_max_len, tokenizer, subset_size, 
                  extra_context=False, extra_supervision=False, paracomet=False, 
                  relation="xReason",roberta=False,supervision_relation='isAfter', 
-                 sentence_transformer=False, emotion = False):
-        self.train_dataset = TweetsummDataset(encoder_max_len, decoder_max_len, 'train',tokenizer,subset_size, extra_context,extra_supervision,paracomet=paracomet,relation=relation,roberta=roberta,supervision_relation=supervision_relation, sentence_transformer=sentence_transformer,  emotion = emotion)
-        self.eval_dataset = TweetsummDataset(encoder_max_len, decoder_max_len, 'validation', tokenizer,subset_size, extra_context,extra_supervision,paracomet=paracomet,relation=relation,roberta=roberta,supervision_relation=supervision_relation, sentence_transformer=sentence_transformer,  emotion = emotion)
-        self.test_dataset = TweetsummDataset(encoder_max_len, decoder_max_len, 'test', tokenizer,100, extra_context,extra_supervision,paracomet=paracomet,relation=relation,roberta=roberta,supervision_relation=supervision_relation, sentence_transformer=sentence_transformer,  emotion = emotion)
-        print(self.train_dataset.data_len)
-    def getTrainData(self):
-        return self.train_dataset
-    
-    def getEvalData(self):
-        return self.eval_dataset
+                 sentence_transformer=False, emotion = False, cache_dir=None, token_store_dir=None, dynamic_padding=False, emotion_dir=None, relation_index=None, num_proc=1, fit_commonsense=False, emotion_context=5):
+        super().__init__(TweetsummDataset, subset_size, encoder_max_len=encoder_max_len, decoder_max_len=decoder_max_len, tokenizer=tokenizer, extra_context=extra_context,extra_supervision=extra_supervision,paracomet=paracomet,relation=relation,roberta=roberta,supervision_relation=supervision_relation, sentence_transformer=sentence_transformer,  emotion = emotion, cache_dir=cache_dir, token_store_dir=token_store_dir, dynamic_padding=dynamic_padding, emotion_dir=emotion_dir, relation_index=relation_index, num_proc=num_proc, fit_commonsense=fit_commonsense, emotion_context=emotion_context)
 
-    def getTestData(self):
-        return self.test_dataset
+    def subset_size_of(self, split_type):
+        ## the whole test split is always used
+        return 100 if split_type == 'test' else self.subset_size
 
@@ -0,0 +1,100 @@
+import os
+import json
+import hashlib
+from collections import deque
+from storage import write_atomic
+
+
+#####################################################################################
+# Precomputed emotion labels of a split, stored next to the commonsense files.
+# The file maps dialogue id -> utterance index -> label code, with the label names
+# stored once:  {"labels": ["joy", "others", ...], "dialogues": {"13818513": {"0": 3, ...}}}
+#####################################################################################
+
+## emotion of every text (utterance or context window) analyzed by this process, by text hash:
+## a window repeated in another dialogue, split or epoch is never analyzed again
+EMOTIONS = {}
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def predict_emotions(analyzer, texts, batch_size=256):
+    ###########################################################
+    # run the pysentimiento analyzer over unique texts in batches
+    ###########################################################
+    texts = list(dict.fromkeys(texts))
+    missing = [text for text in texts if text_hash(text) not in EMOTIONS]
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        for text, output in zip(batch, analyzer.predict(batch)):
+            EMOTIONS[text_hash(text)] = output.output
+        print(f"predicted emotions of {min(start + batch_size, len(missing))}/{len(missing)} texts")
+    return {text: EMOTIONS[text_hash(text)] for text in texts}
+
+
+def predict_emotion(analyzer, text):
+    key = text_hash(text)
+    if key not in EMOTIONS:
+        EMOTIONS[key] = analyzer.predict(text).output
+    return EMOTIONS[key]
+
+
+class ContextWindow:
+    """
+    The last n lines of a dialogue, the context whose emotion is used for utterances labelled "others".
+    Lines are added as the dialogue is built; text() is the window without its <I> lines, the same
+    as '\n'.join(line for line in dialogue_clean.splitlines()[-n:] if not line.strip().startswith('<I>')).
+    """
+    def __init__(self, n=5):
+        self.lines = deque(maxlen=n)
+
+    def add(self, text):
+        self.lines.extend(text.splitlines())
+
+    def text(self):
+        return '\n'.join(line for line in self.lines if not line.strip().startswith('<I>'))
+
+
+class EmotionStore:
+    def __init__(self, path):
+        self.path = path
+        self.dialogues = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            labels = data['labels']
+            self.dialogues = {id: {utterance: labels[code] for utterance, code in utterances.items()}
+                              for id, utterances in data['dialogues'].items()}
+
+    def __contains__(self, id):
+        return str(id) in self.dialogues
+
+    def get(self, id, utterance):
+        return self.dialogues.get(str(id), {}).get(str(utterance))
+
+    def fill(self, ids, requests, analyzer, batch_size=256):
+        ###########################################################
+        # requests: (dialogue id, utterance index) -> (utterance, previous)
+        # the previous context is only analyzed for utterances labelled "others"
+        ###########################################################
+        for id in ids:
+            self.dialogues.setdefault(str(id), {})
+        emotions = predict_emotions(analyzer, [utterance for utterance, _ in requests.values()], batch_size)
+        context_emotions = predict_emotions(analyzer, [previous for utterance, previous in requests.values() if emotions[utterance] == "others"], batch_size)
+        for (id, utterance_idx), (utterance, previous) in requests.items():
+            emotion = emotions[utterance]
+            if emotion == "others":
+                emotion = context_emotions[previous]
+            self.dialogues[str(id)][str(utterance_idx)] = emotion
+
+    def save(self):
+        labels = sorted({emotion for utterances in self.dialogues.values() for emotion in utterances.values()})
+        code = {label: i for i, label in enumerate(labels)}
+        data = {'labels': labels,
+                'dialogues': {id: {utterance: code[emotion] for utterance, emotion in utterances.items()}
+                              for id, utterances in self.dialogues.items()}}
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with write_atomic(self.path) as f:
+            json.dump(data, f, separators=(',', ':'))
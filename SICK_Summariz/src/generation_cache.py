@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from storage import select_in
+
+
+#####################################################################################
+# Persistent cache of COMET / PARACOMET generations shared by every corpus and run.
+# An entry is addressed by the hash of (model id, relation, normalized sentence, decoding
+# parameters), so that the same utterance found in SAMSum, DialogSum and TweetSumm, or
+# extracted again with other relations, is only generated for the pairs never seen.
+# Entries are stored in SQLite with their size and last use; when the cache grows past
+# max_bytes, the least recently used entries are evicted.
+#####################################################################################
+
+
+def normalize(sentence):
+    return ' '.join(sentence.split())
+
+
+def entry_key(model_id, relation, sentence, decoding):
+    key = {'model': model_id, 'relation': relation, 'sentence': normalize(sentence), 'decoding': decoding}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+class GenerationCache:
+    def __init__(self, path, model_id, decoding, max_bytes=1 << 30):
+        self.path = path
+        self.model_id = model_id
+        self.decoding = decoding
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS generations (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS generations_last_used ON generations (last_used)")
+        self.connection.commit()
+
+    def key(self, sentence, relation):
+        return entry_key(self.model_id, relation, sentence, self.decoding)
+
+    def get_many(self, pairs):
+        ###########################################################
+        # pairs: (sentence, relation) -> generations of the cached ones
+        ###########################################################
+        keys = {}
+        for sentence, relation in pairs:
+            ## sentences differing only by whitespace share their entry
+            keys.setdefault(self.key(sentence, relation), []).append((sentence, relation))
+        found = {}
+        hits = []
+        for key, value in select_in(self.connection, "SELECT key, value FROM generations WHERE key IN ({})", keys):
+            hits.append(key)
+            for pair in keys[key]:
+                found[pair] = json.loads(value)
+        now = time.time()
+        self.connection.executemany("UPDATE generations SET last_used = ? WHERE key = ?", ((now, key) for key in hits))
+        self.connection.commit()
+        return found
+
+    def put_many(self, generations):
+        ## generations: (sentence, relation) -> generations
+        now = time.time()
+        rows = []
+        for (sentence, relation), value in generations.items():
+            value = json.dumps(value)
+            rows.append((self.key(sentence, relation), value, len(value.encode()), now))
+        self.connection.executemany("INSERT OR REPLACE INTO generations VALUES (?, ?, ?, ?)", rows)
+        self.connection.commit()
+        self.evict()
+
+    def size(self):
+        return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM generations").fetchone()[0]
+
+    def evict(self):
+        ## least recently used entries first, until the cache fits in max_bytes
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return
+        evicted = []
+        cursor = self.connection.execute("SELECT key, size FROM generations ORDER BY last_used")
+        for key, size in cursor:
+            evicted.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        cursor.close()
+        self.connection.executemany("DELETE FROM generations WHERE key = ?", evicted)
+        self.connection.commit()
+        print(f"evicted {len(evicted)} generations from {self.path}")
+
+    def close(self):
+        self.connection.close()
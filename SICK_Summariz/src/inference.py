@@ -15,10 +15,12 @@ import numpy as np
 import argparse
 import torch
 # import transformers
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, Subset
 from transformers import BartForConditionalGeneration, AutoTokenizer
 from datasets import load_metric
 from dataset import SamsumDataset_total, DialogsumDataset_total, TweetsummDataset_total
+import profiling
+from batching import DynamicPaddingCollator, LengthBucketBatchSampler
 from models.bart import BartForConditionalGeneration_DualDecoder, BartForConditionalGeneration_DualHead
 from tqdm import tqdm
 from bleurt import score
@@ -37,8 +39,18 @@ parser.add_argument('--use_roberta',type=bool,default=False)
 parser.add_argument('--use_sentence_transformer',type=bool,default=False)
 parser.add_argument('--relation',type=str,default="xIntent")
 parser.add_argument('--supervision_relation',type=str,default='isAfter')
+parser.add_argument('--cache_dir',type=str,default='') #set to a directory (e.g. ../data/cache) to cache the augmented dialogues on disk
+parser.add_argument('--token_store_dir',type=str,default='') #set to a directory to serve pre-tokenized memory-mapped splits
+parser.add_argument('--relation_index',type=str,default='') #with --relation '<|best_relation|>': token or embedding, to read the best relations from build_relation_index.py
+parser.add_argument('--num_proc',type=int,default=1) #processes used to prepare the splits (spaCy sentence splitting)
+parser.add_argument('--fit_commonsense',type=bool,default=False) #drop the least useful <I> inserts of dialogues longer than encoder_max_len instead of truncating their tail
 parser.add_argument('--num_beams', type=int, default=20)
+parser.add_argument('--test_batch_size',type=int,default=1)
+parser.add_argument('--dynamic_padding',type=bool,default=False) #pad each batch to its longest dialogue, batching dialogues of similar length together
+parser.add_argument('--profile',type=str,default='') #set to a .json or .csv file to record the time spent in each data loading stage (COMET lookup, emotion analysis, tokenization, ...)
 args = parser.parse_args()
+if args.profile:
+    profiling.enable()
 
 # Set GPU
 print('######################################################################')
@@ -117,13 +129,13 @@ tokenizer = AutoTokenizer.from_pretrained("lidiya/bart-base-samsum")
 
 # Set dataset
 if args.dataset_name=='samsum':
-    total_dataset = SamsumDataset_total(args.encoder_max_len,args.decoder_max_len,tokenizer,subset_size = args.subset_size, extra_context=True,extra_supervision=True,paracomet=args.use_paracomet,relation=args.relation,supervision_relation=args.supervision_relation,roberta=args.use_roberta, sentence_transformer=args.use_sentence_transformer)
+    total_dataset = SamsumDataset_total(args.encoder_max_len,args.decoder_max_len,tokenizer,subset_size = args.subset_size, extra_context=True,extra_supervision=True,paracomet=args.use_paracomet,relation=args.relation,supervision_relation=args.supervision_relation,roberta=args.use_roberta, sentence_transformer=args.use_sentence_transformer, cache_dir=args.cache_dir, token_store_dir=args.token_store_dir, dynamic_padding=args.dynamic_padding, relation_index=args.relation_index, num_proc=args.num_proc, fit_commonsense=args.fit_commonsense)
     test_dataset = total_dataset.getTestData()
 elif args.dataset_name=='dialogsum':
-    total_dataset = DialogsumDataset_total(args.encoder_max_len,args.decoder_max_len,tokenizer,subset_size = args.subset_size, extra_context=True,extra_supervision=True,paracomet=args.use_paracomet,relation=args.relation,supervision_relation=args.supervision_relation, sentence_transformer=args.use_sentence_transformer, roberta=args.use_roberta)
+    total_dataset = DialogsumDataset_total(args.encoder_max_len,args.decoder_max_len,tokenizer,subset_size = args.subset_size, extra_context=True,extra_supervision=True,paracomet=args.use_paracomet,relation=args.relation,supervision_relation=args.supervision_relation, sentence_transformer=args.use_sentence_transformer, roberta=args.use_roberta, cache_dir=args.cache_dir, token_store_dir=args.token_store_dir, dynamic_padding=args.dynamic_padding, relation_index=args.relation_index, num_proc=args.num_proc, fit_commonsense=args.fit_commonsense)
     test_dataset = total_dataset.getTestData()
 elif args.dataset_name=='tweetsumm':
-    total_dataset = TweetsummDataset_total(args.encoder_max_len,args.decoder_max_len,tokenizer,subset_size = args.subset_size, extra_context=True,extra_supervision=True,paracomet=False,relation=args.relation,supervision_relation=args.supervision_relation, sentence_transformer=args.use_sentence_transformer, roberta=args.use_roberta)
+    total_dataset = TweetsummDataset_total(args.encoder_max_len,args.decoder_max_len,tokenizer,subset_size = args.subset_size, extra_context=True,extra_supervision=True,paracomet=False,relation=args.relation,supervision_relation=args.supervision_relation, sentence_transformer=args.use_sentence_transformer, roberta=args.use_roberta, cache_dir=args.cache_dir, token_store_dir=args.token_store_dir, dynamic_padding=args.dynamic_padding, relation_index=args.relation_index, num_proc=args.num_proc, fit_commonsense=args.fit_commonsense)
     test_dataset = total_dataset.getTestData()
     
 print('######################################################################')
@@ -132,7 +144,13 @@ print(len(test_dataset))
 print('######################################################################')
 
 # Build dataloader
-test_dataloader = DataLoader(dataset=test_dataset, batch_size=1, shuffle=False)
+## only the first subset_size% of the test set is evaluated
+test_indices = range(min(len(test_dataset), int(len(test_dataset)*args.subset_size/100)+1))
+if args.dynamic_padding:
+    test_sampler = LengthBucketBatchSampler(test_dataset.lengths(), args.test_batch_size, shuffle=False, indices=test_indices)
+    test_dataloader = DataLoader(dataset=test_dataset, batch_sampler=test_sampler, collate_fn=DynamicPaddingCollator(tokenizer.pad_token_id))
+else:
+    test_dataloader = DataLoader(dataset=Subset(test_dataset, test_indices), batch_size=args.test_batch_size, shuffle=False)
 
 total_rouge1_scores = 0.0
 total_rouge2_scores = 0.0
@@ -144,8 +162,6 @@ total_decoded_labels = []
 
 with torch.no_grad():
     for idx, data in enumerate(tqdm(test_dataloader),0):
-        if idx > int(len(test_dataset)*args.subset_size/100):
-           break
         # if idx % 40 ==0:
         #     print(total_rouge1_scores)
         #     print(idx)
@@ -174,16 +190,9 @@ with torch.no_grad():
         bertscore_metric.add_batch(predictions=decoded_preds, references=decoded_labels)
        
         if args.dataset_name=='dialogsum':
-            y2 = data['labels2'].to(device,dtype=torch.long)
-            y2 = y2.cpu()
-            y3 = data['labels3'].to(device,dtype=torch.long)
-            y3 = y3.cpu()
-
-            decoded_labels2 = tokenizer.batch_decode(y2, skip_special_tokens=True, clean_up_tokenization_space=True)
-            decoded_labels3 = tokenizer.batch_decode(y3, skip_special_tokens=True, clean_up_tokenization_space=True)
-
-            decoded_labels2 = ["\n".join(nltk.sent_tokenize(label.strip())) for label in decoded_labels2]
-            decoded_labels3 = ["\n".join(nltk.sent_tokenize(label.strip())) for label in decoded_labels3]
+            ## the other two references are given as text by the test split, no decoding needed
+            decoded_labels2 = ["\n".join(nltk.sent_tokenize(label.strip())) for label in data['references2']]
+            decoded_labels3 = ["\n".join(nltk.sent_tokenize(label.strip())) for label in data['references3']]
 
             result2 = metric2.add_batch(predictions=decoded_preds, references=decoded_labels2)
             result3 = metric3.add_batch(predictions=decoded_preds, references=decoded_labels3)
@@ -203,6 +212,9 @@ with torch.no_grad():
        
         
             
+if args.profile:
+    profiling.export(args.profile)
+
 print(total_decoded_preds)
 print(len(total_decoded_preds))
 bertscore_result = bertscore_metric.compute(lang='en',model_type='bert-base-uncased')
@@ -0,0 +1,85 @@
+import os
+import json
+from collections.abc import Sequence
+from storage import write_atomic
+
+
+#####################################################################################
+# Streaming access to .jsonl files (one JSON record per line, e.g. DialogSum).
+# stream_jsonl parses the records one line at a time, JsonlIndex gives random access
+# by position or id through an on-disk index of line offsets, written next to the file
+# as <file>.index.json and rebuilt when the .jsonl file changes. Only the records that
+# are accessed are parsed, so a random subset never materializes the whole split.
+#####################################################################################
+
+
+def stream_jsonl(path):
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def index_path(path):
+    return f"{os.path.splitext(path)[0]}.index.json"
+
+
+class JsonlIndex(Sequence):
+    def __init__(self, path, id_field=None):
+        self.path = path
+        self.id_field = id_field
+        self.offsets, self.ids = self.load_index()
+        self.position = None if self.ids is None else {id: position for position, id in enumerate(self.ids)}
+
+    def source_state(self):
+        return [os.path.getmtime(self.path), os.path.getsize(self.path), self.id_field]
+
+    def load_index(self):
+        path = index_path(self.path)
+        if os.path.exists(path):
+            with open(path) as f:
+                index = json.load(f)
+            if index['source'] == self.source_state():
+                return index['offsets'], index['ids']
+        offsets = []
+        ids = [] if self.id_field else None
+        with open(self.path, 'rb') as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    offsets.append(offset)
+                    if ids is not None:
+                        ids.append(json.loads(line)[self.id_field])
+                offset += len(line)
+        try:
+            with write_atomic(path) as f:
+                json.dump({'source': self.source_state(), 'offsets': offsets, 'ids': ids}, f)
+        except OSError:
+            ## read-only data directory: the index is only kept in memory
+            pass
+        return offsets, ids
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, position):
+        with open(self.path, 'rb') as f:
+            f.seek(self.offsets[position])
+            return json.loads(f.readline())
+
+    def records(self, positions):
+        ## several records with one open file, in the order of positions
+        with open(self.path, 'rb') as f:
+            for position in positions:
+                f.seek(self.offsets[position])
+                yield json.loads(f.readline())
+
+    def get(self, id):
+        return self[self.position[id]]
+
+    def records_by_id(self, ids):
+        ## several records with one open file, in the order of ids
+        return self.records(self.position[id] for id in ids)
+
+    def __iter__(self):
+        return stream_jsonl(self.path)
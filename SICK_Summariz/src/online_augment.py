@@ -0,0 +1,190 @@
+# Summarize new conversations with the context / full configurations, whose COMET z is not in the precomputed files.
+# python online_augment.py --input dialogues.jsonl --output summaries.jsonl --comet_model_path ../../processing_tweetsumm/comet-atomic-2020/models/comet_atomic2020_bart/comet-atomic_2020_BART --model_checkpoint ./context_final_BART_weights_Samsum_5epoch --train_configuration context --relation xIntent
+# --input: one {"id": ..., "dialogue": "Amanda: ...\nTom: ..."} per line (or a .json list of them)
+# writes one {"id", "dialogue", "augmented", "summary"} per line, without "summary" when no --model_checkpoint is given
+import re
+import sys
+sys.path.append('../')
+import json
+import argparse
+import torch
+from dataset import person_normalized, commonsense_insert, needs_emotion
+from emotion_store import ContextWindow, predict_emotions
+from commonsense_budget import fit_to_budget
+from storage import write_atomic
+import resources
+from comet_generation import Comet, cached_results, generate_all, open_cache, query
+
+
+#####################################################################################
+# Online augmentation of raw SAMSum-style dialogues ("speaker: utterance" lines), in the
+# format SamsumDataset.build_dialogue gives the COMET files: every utterance followed by the
+# <I> line of its commonsense for the configured relation (media messages rewritten, emotion
+# appended with --emotion). Dialogues are augmented a chunk at a time:
+#   1. the unique utterances of the chunk are looked up in the generation cache shared with
+#      comet_extraction.py, and the missing ones generated by COMET in length-sorted batches
+#   2. the emotions of the utterances, then of the context windows of the utterances labelled
+#      "others", are predicted in batches (and memoized by emotion_store)
+#   3. the dialogues are assembled as the datasets do
+#####################################################################################
+
+
+def parse_dialogue(dialogue):
+    ## (person, utterance) of every line, person None for lines without a speaker
+    utterances = []
+    for line in dialogue.replace('\r\n', '\n').split('\n'):
+        if not line.strip():
+            continue
+        speaker = re.search(".*?:", line)
+        if speaker:
+            utterances.append((speaker.group().replace(":", "").strip(), line.replace(speaker.group(), "", 1).strip()))
+        else:
+            utterances.append((None, line.strip()))
+    return utterances
+
+
+class OnlineAugmenter:
+    def __init__(self, comet, relation="xIntent", emotion=False, emotion_context=5, batch_size=32, num_generate=5, cache=None):
+        self.comet = comet
+        self.relation = relation
+        self.emotion = emotion
+        self.emotion_context = emotion_context
+        self.batch_size = batch_size
+        self.num_generate = num_generate
+        self.cache = cache
+
+    def commonsense(self, sentences):
+        ###########################################################
+        # sentence -> its first COMET generation for the relation
+        ###########################################################
+        queries = {query(sentence, self.relation): (sentence, self.relation) for sentence in dict.fromkeys(sentences)}
+        results = cached_results(self.cache, queries)
+        generated = generate_all(self.comet, [q for q in queries if q not in results], self.batch_size, self.num_generate)
+        if self.cache is not None:
+            self.cache.put_many({queries[q]: generations for q, generations in generated.items()})
+        results.update(generated)
+        return {queries[q][0]: person_normalized(generations[0].strip()) for q, generations in results.items()}
+
+    def emotions(self, requests):
+        ## requests: (utterance, previous context) -> emotion, the context's one for utterances labelled "others"
+        if not requests:
+            return {}
+        analyzer = resources.get('emotion_analyzer')
+        emotions = predict_emotions(analyzer, [utterance for utterance, _ in requests])
+        context_emotions = predict_emotions(analyzer, [previous for utterance, previous in requests if emotions[utterance] == "others"])
+        return {(utterance, previous): context_emotions[previous] if emotions[utterance] == "others" else emotions[utterance]
+                for utterance, previous in requests}
+
+    def augment(self, dialogues):
+        ## augmented text of each raw dialogue
+        parsed = [parse_dialogue(dialogue) for dialogue in dialogues]
+        commonsense = self.commonsense([sentence for utterances in parsed for person, sentence in utterances if person is not None])
+
+        ## for each dialogue, its lines, each (line, None) or (None, (sentence, person, emotion request)) for an <I> line
+        layouts = []
+        requests = set()
+        for utterances in parsed:
+            layout = []
+            window = ContextWindow(self.emotion_context)
+            for person, sentence in utterances:
+                if person is None:
+                    layout.append((sentence + '\n', None))
+                    window.add(sentence + '\n')
+                    continue
+                line = person + " said \"" + sentence + ".\"" + '\n'
+                window.add(line)
+                request = None
+                if self.emotion == True and needs_emotion(sentence, commonsense[sentence]):
+                    ## the utterance and its context, as build_dialogue gives them to emotion_of
+                    request = (sentence, window.text())
+                    requests.add(request)
+                layout.append((line, None))
+                layout.append((None, (sentence, person, request)))
+            layouts.append(layout)
+
+        emotions = self.emotions(list(requests))
+        augmented = []
+        for layout in layouts:
+            dialogue = ""
+            for line, insert in layout:
+                if insert is None:
+                    dialogue += line
+                else:
+                    sentence, person, request = insert
+                    dialogue += commonsense_insert(sentence, person, commonsense[sentence], emotions.get(request))
+            augmented.append(dialogue)
+        return augmented
+
+
+def read_dialogues(path):
+    with open(path) as f:
+        if path.endswith('.jsonl'):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, required=True) #.jsonl (or .json list) of {"id", "dialogue"}
+    parser.add_argument('--output', type=str, required=True) #.jsonl of {"id", "dialogue", "augmented", "summary"}
+    parser.add_argument('--comet_model_path', type=str, default='../../processing_tweetsumm/comet-atomic-2020/models/comet_atomic2020_bart/comet-atomic_2020_BART')
+    parser.add_argument('--relation', type=str, default="xIntent")
+    parser.add_argument('--emotion', type = bool, default = False) #set to true in order to use emotion-aware commonsense, always on with --train_configuration full
+    parser.add_argument('--emotion_context',type=int,default=5) #with --emotion: number of last utterances whose emotion is used for utterances labelled "others"
+    parser.add_argument('--comet_batch_size', type=int, default=32) #COMET queries generated at a time
+    parser.add_argument('--chunk_size', type=int, default=1000) #dialogues augmented (and written) at a time
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument('--cache', type=str, default='../data/COMET_data/generation_cache.sqlite') #COMET generations shared with comet_extraction.py, '' to disable
+    parser.add_argument('--cache_max_mb', type=int, default=2048)
+    parser.add_argument('--model_checkpoint', type=str, default='') #summarizer trained with the context / full configuration, '' to only augment
+    parser.add_argument('--train_configuration', type=str, default="context") #context, full: configuration the checkpoint was trained with, as in inference.py
+    parser.add_argument('--tokenizer_name', type=str, default="lidiya/bart-base-samsum")
+    parser.add_argument('--encoder_max_len', type=int, default=1024)
+    parser.add_argument('--fit_commonsense',type=bool,default=False) #drop the least useful <I> inserts of dialogues longer than encoder_max_len instead of truncating their tail
+    parser.add_argument('--num_beams', type=int, default=20)
+    parser.add_argument('--test_batch_size', type=int, default=8)
+    args = parser.parse_args()
+    if args.train_configuration not in ("context", "full"):
+        raise ValueError(f"--train_configuration {args.train_configuration}: only the context and full configurations take commonsense")
+    ## as inference.py, the full configuration is trained with emotion-aware commonsense
+    emotion = args.emotion or args.train_configuration == "full"
+
+    comet = Comet(args.comet_model_path, args.device)
+    cache = open_cache(args.cache, args.comet_model_path, max_mb=args.cache_max_mb) if args.cache else None
+    augmenter = OnlineAugmenter(comet, args.relation, emotion, args.emotion_context, args.comet_batch_size, cache=cache)
+
+    tokenizer = None
+    if args.model_checkpoint or args.fit_commonsense:
+        from transformers import AutoTokenizer, BartForConditionalGeneration
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name)
+    if args.model_checkpoint:
+        if args.train_configuration == "full":
+            ## dual decoder checkpoint, loaded as inference.py does
+            from models.bart import BartForConditionalGeneration_DualDecoder
+            finetune_model = BartForConditionalGeneration_DualDecoder.from_pretrained(args.model_checkpoint).to(args.device)
+        else:
+            finetune_model = BartForConditionalGeneration.from_pretrained(args.model_checkpoint).to(args.device)
+        finetune_model.eval()
+
+    examples = read_dialogues(args.input)
+    with write_atomic(args.output) as f:
+        for start in range(0, len(examples), args.chunk_size):
+            chunk = examples[start:start + args.chunk_size]
+            augmented = augmenter.augment([example['dialogue'] for example in chunk])
+            if args.fit_commonsense:
+                augmented = [fit_to_budget(dialogue, tokenizer, args.encoder_max_len) for dialogue in augmented]
+            summaries = [None] * len(chunk)
+            if args.model_checkpoint:
+                for batch_start in range(0, len(chunk), args.test_batch_size):
+                    batch = tokenizer(augmented[batch_start:batch_start + args.test_batch_size], padding=True, truncation=True,
+                                      max_length=args.encoder_max_len, return_tensors='pt').to(args.device)
+                    with torch.no_grad():
+                        generated_ids = finetune_model.generate(input_ids=batch['input_ids'], attention_mask=batch['attention_mask'],
+                                                                max_length=100, num_beams=args.num_beams)
+                    summaries[batch_start:batch_start + args.test_batch_size] = tokenizer.batch_decode(generated_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+            for example, dialogue, summary in zip(chunk, augmented, summaries):
+                record = {'id': example.get('id'), 'dialogue': example['dialogue'], 'augmented': dialogue}
+                if summary is not None:
+                    record['summary'] = summary
+                f.write(json.dumps(record) + '\n')
+            print(f"augmented {min(start + args.chunk_size, len(examples))}/{len(examples)} dialogues")
@@ -0,0 +1,77 @@
+# Build the augmented and tokenized splits once, ahead of training / inference, over every core.
+# python prepare.py --target context --dataset_name dialogsum --relation xIntent --emotion True
+# then run the --target script (train_summarization_context.py, train_summarization_full.py or inference.py) with the
+# same arguments and the same --cache_dir / --token_store_dir: it loads the augmented dialogue caches and the
+# pre-tokenized memory-mapped splits written here. The tokenizer and the dataset flags are the ones of that script:
+#   --target context:   tokenizer of --model_name with <I> </I>, no extra supervision
+#   --target full:      tokenizer of --model_name with <I> </I>, extra supervision, --model_name facebook/bart-large-xsum by default
+#   --target inference: lidiya/bart-base-samsum tokenizer, extra supervision, no emotions, test split only by default
+import os
+import time
+import argparse
+from transformers import AutoTokenizer
+from dataset import SamsumDataset_total, DialogsumDataset_total, TweetsummDataset_total
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--dataset_name',type=str, default='samsum')
+parser.add_argument('--target',type=str, default='context') #context, full or inference: the script whose tokenizer and dataset arguments are reproduced
+parser.add_argument('--splits',type=str, nargs='+', default=None) #train, validation and test by default, test only for --target inference
+parser.add_argument('--subset_size', type = int, default = 100) #same value as the training script, the subsets are drawn the same way
+parser.add_argument('--model_name',type=str, default='') #tokenizer of the trained model, the default of the --target script when empty (unused for inference)
+parser.add_argument('--encoder_max_len', type=int, default=1024)
+parser.add_argument('--decoder_max_len', type=int, default=100)
+parser.add_argument('--use_paracomet',type=bool,default=False)
+parser.add_argument('--use_roberta',type=bool,default=False)
+parser.add_argument('--use_sentence_transformer',type=bool,default=False)
+parser.add_argument('--relation',type=str,default="xReason")
+parser.add_argument('--supervision_relation',type=str,default='isAfter')
+parser.add_argument('--emotion', type = bool, default = False) #set to true in order to use emotion-aware commonsense
+parser.add_argument('--emotion_context',type=int,default=5) #with --emotion: number of last utterances whose emotion is used for utterances labelled "others"
+parser.add_argument('--cache_dir',type=str,default='../data/cache') #where augmented dialogues are cached
+parser.add_argument('--token_store_dir',type=str,default='../data/token_store') #where the pre-tokenized splits are written
+parser.add_argument('--relation_index',type=str,default='') #with --relation '<|best_relation|>': token or embedding, to read the best relations from build_relation_index.py
+parser.add_argument('--emotion_dir',type=str,default='../data/cache') #where emotion labels are precomputed in batches with --emotion
+parser.add_argument('--fit_commonsense',type=bool,default=False) #drop the least useful <I> inserts of dialogues longer than encoder_max_len instead of truncating their tail
+parser.add_argument('--dynamic_padding',type=bool,default=False) #the token store does not depend on it, kept for the same arguments as the training scripts
+parser.add_argument('--num_proc',type=int,default=os.cpu_count()) #processes used to augment the dialogues and to split sentences
+args = parser.parse_args()
+
+## model_name, extra_supervision, emotion, splits of each --target script
+targets = {'context': ('facebook/bart-large', False, True, ['train','validation','test']),
+           'full': ('facebook/bart-large-xsum', True, True, ['train','validation','test']),
+           'inference': (None, True, False, ['test'])}
+if args.target not in targets:
+    raise ValueError(f"unknown target {args.target}, expected one of {', '.join(targets)}")
+model_name, extra_supervision, uses_emotion, splits = targets[args.target]
+splits = args.splits or splits
+
+if args.target == 'inference':
+    ## inference.py tokenizes with lidiya/bart-base-samsum, without <I> </I>, and builds no emotions
+    tokenizer = AutoTokenizer.from_pretrained("lidiya/bart-base-samsum")
+else:
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name or model_name)
+    special_tokens_dict = {'additional_special_tokens':['<I>','</I>']}
+    tokenizer.add_special_tokens(special_tokens_dict)
+emotion = args.emotion if uses_emotion else False
+emotion_dir = args.emotion_dir if uses_emotion else None
+emotion_context = args.emotion_context if uses_emotion else 5
+## inference.py reads the COMET files of TweetSumm
+paracomet = args.use_paracomet and not (args.target == 'inference' and args.dataset_name == 'tweetsumm')
+
+total_datasets = {'samsum': SamsumDataset_total, 'dialogsum': DialogsumDataset_total, 'tweetsumm': TweetsummDataset_total}
+if args.dataset_name not in total_datasets:
+    raise ValueError(f"unknown dataset {args.dataset_name}, expected one of {', '.join(total_datasets)}")
+total_dataset = total_datasets[args.dataset_name](args.encoder_max_len,args.decoder_max_len,tokenizer,subset_size = args.subset_size, extra_context=True, extra_supervision=extra_supervision, paracomet=paracomet,relation=args.relation,supervision_relation=args.supervision_relation,roberta=args.use_roberta, sentence_transformer=args.use_sentence_transformer,emotion = emotion, cache_dir=args.cache_dir, token_store_dir=args.token_store_dir, dynamic_padding=args.dynamic_padding, emotion_dir=emotion_dir, relation_index=args.relation_index, num_proc=args.num_proc, fit_commonsense=args.fit_commonsense, emotion_context=emotion_context)
+
+report = []
+for split_type in splits:
+    print(f"Preparing {args.dataset_name} {split_type} for {args.target} with {args.num_proc} processes")
+    start = time.perf_counter()
+    dataset = total_dataset.get_split(split_type)
+    report.append((split_type, len(dataset), time.perf_counter() - start, dataset.key_errors))
+
+print(f"{'split':<12}{'examples':>10}{'seconds':>10}{'key errors':>12}")
+for split_type, examples, seconds, key_errors in report:
+    print(f"{split_type:<12}{examples:>10}{seconds:>10.1f}{key_errors:>12}")
+print(f"augmented dialogues in {args.cache_dir}, tokenized splits in {args.token_store_dir}")
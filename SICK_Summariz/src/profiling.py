@@ -0,0 +1,119 @@
+import csv
+import json
+import time
+import functools
+from contextlib import contextmanager
+from collections.abc import Mapping
+
+
+#####################################################################################
+# Opt-in timing of the data loading stages of the datasets (COMET lookup, best relation,
+# emotion analysis, sentence splitting, media rewriting, tokenization, ...).
+# For each (dataset class, stage): the number of calls, the total time, and the own time,
+# i.e. without the time of the stages nested in it (emotion analysis inside media
+# rewriting, COMET lookups inside augmentation, ...), so that own times add up.
+# Nothing is recorded unless enable() is called before the datasets are built; the stats
+# are the ones of this process (data loading in the main process, dataloader_num_workers=0).
+#####################################################################################
+
+ENABLED = False
+## (dataset class, stage) -> [calls, seconds, own seconds]
+STATS = {}
+## time spent in the nested stages of every running stage
+_children = []
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def reset():
+    STATS.clear()
+
+
+@contextmanager
+def stage(owner, name):
+    if not ENABLED:
+        yield
+        return
+    _children.append(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        children = _children.pop()
+        if _children:
+            _children[-1] += elapsed
+        stats = STATS.setdefault((owner, name), [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] += elapsed - children
+
+
+def timed(name):
+    ## method decorator: every call is a stage of the class of the dataset
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not ENABLED:
+                return method(self, *args, **kwargs)
+            with stage(type(self).__name__, name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class ProfiledMapping(Mapping):
+    """A commonsense file (LazyJson or CometStore) whose lookups are timed as a stage."""
+    def __init__(self, data, owner, name):
+        self.data = data
+        self.path = data.path
+        self.owner = owner
+        self.name = name
+
+    def __getitem__(self, key):
+        with stage(self.owner, self.name):
+            return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+
+def rows():
+    ## one row per (dataset class, stage), by decreasing own time
+    rows = []
+    for (owner, name), (calls, seconds, own_seconds) in STATS.items():
+        rows.append({'dataset': owner,
+                     'stage': name,
+                     'calls': calls,
+                     'seconds': round(seconds, 6),
+                     'own_seconds': round(own_seconds, 6),
+                     'ms_per_call': round(1000 * seconds / calls, 6)})
+    return sorted(rows, key=lambda row: row['own_seconds'], reverse=True)
+
+
+def export(path):
+    ###########################################################
+    # write the report as .csv, or as .json for any other extension
+    ###########################################################
+    report = rows()
+    if path.endswith('.csv'):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['dataset', 'stage', 'calls', 'seconds', 'own_seconds', 'ms_per_call'])
+            writer.writeheader()
+            writer.writerows(report)
+    else:
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(f"{'dataset':<20}{'stage':<24}{'calls':>10}{'seconds':>12}{'own seconds':>14}")
+    for row in report:
+        print(f"{row['dataset']:<20}{row['stage']:<24}{row['calls']:>10}{row['seconds']:>12.2f}{row['own_seconds']:>14.2f}")
+    print(f"data loading profile written to {path}")
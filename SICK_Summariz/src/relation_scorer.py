@@ -0,0 +1,125 @@
+import os
+import json
+import numpy as np
+
+
+#####################################################################################
+# Best commonsense relation of an utterance: the candidate (first generation of each
+# relation) whose token ids are the most cosine-similar to the utterance's token ids,
+# both padded to max_length as the datasets always did.
+# Padding does not need to be materialized: the positions past the longest sequence of a
+# batch hold pad_token_id in every vector, so they add (max_length - width) * pad^2 to
+# every dot product and squared norm.
+#####################################################################################
+
+COMET_RELATIONS = ('HinderedBy', 'xWant', 'xIntent', 'xNeed', 'xReason')
+PARACOMET_RELATIONS = ('<|xReact|>', '<|xWant|>', '<|xIntent|>', '<|xAttr|>', '<|xEffect|>')
+
+
+def cosines(tokenizer, max_length, groups, pad=None):
+    ###########################################################
+    # groups: tuples of texts, all of the same size; returns the
+    # (groups, size - 1) cosines of the first text of each group
+    # with each of the others, with one tokenizer call
+    ###########################################################
+    if pad is None:
+        pad = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+    group = len(groups[0])
+    encoded = tokenizer([text for texts in groups for text in texts],
+                        padding=False,
+                        truncation=True,
+                        max_length=max_length)['input_ids']
+    width = max(len(ids) for ids in encoded)
+    vectors = np.full((len(encoded), width), pad, dtype=np.float64)
+    for i, ids in enumerate(encoded):
+        vectors[i, :len(ids)] = ids
+    vectors = vectors.reshape(len(groups), group, width)
+
+    padding = (max_length - width) * float(pad) ** 2
+    dots = np.einsum('bw,bcw->bc', vectors[:, 0], vectors[:, 1:]) + padding
+    norms = np.sqrt(np.einsum('bgw,bgw->bg', vectors, vectors) + padding)
+    denominators = norms[:, :1] * norms[:, 1:]
+    denominators[denominators == 0] = 1
+    return dots / denominators
+
+
+class BestRelationScorer:
+    def __init__(self, tokenizer, max_length, relations):
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.relations = relations
+        self.pad = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+        ## (utterance, candidate of each relation) -> best relation
+        self.memo = {}
+
+    def key(self, sentence, d):
+        return (sentence,) + tuple(d[relation][0] for relation in self.relations)
+
+    def score(self, pairs, batch_size=256):
+        ###########################################################
+        # pairs: (utterance, COMET/PARACOMET utterance dict)
+        # every utterance not seen yet is scored, batch_size at a time,
+        # with one tokenizer call and one array operation per batch
+        ###########################################################
+        todo = list(dict.fromkeys(key for key in (self.key(sentence, d) for sentence, d in pairs) if key not in self.memo))
+        for start in range(0, len(todo), batch_size):
+            batch = todo[start:start + batch_size]
+            ## argmax keeps the first relation on ties, as max() over the relation dict did
+            best = np.argmax(cosines(self.tokenizer, self.max_length, batch, self.pad), axis=1)
+            for key, relation in zip(batch, best):
+                self.memo[key] = self.relations[relation]
+
+    def pin(self, sentence, d, relation):
+        ## relation chosen elsewhere (e.g. by a RelationIndex), used instead of scoring
+        self.memo[self.key(sentence, d)] = relation
+
+    def best_relation(self, sentence, d):
+        key = self.key(sentence, d)
+        if key not in self.memo:
+            self.score([(sentence, d)])
+        return self.memo[key]
+
+
+## one scorer (and memo) per tokenizer / max_length / relation set, shared by the splits of a process
+_scorers = {}
+
+
+def get_scorer(tokenizer, max_length, relations):
+    key = (tokenizer.name_or_path, len(tokenizer), max_length, relations)
+    if key not in _scorers:
+        _scorers[key] = BestRelationScorer(tokenizer, max_length, relations)
+    return _scorers[key]
+
+
+#####################################################################################
+# Offline index of the best relation of every utterance of a COMET/PARACOMET file,
+# built by build_relation_index.py. Per dialogue it stores one character per utterance,
+# in file order: the position of the best relation in `relations`, or '-' when the
+# utterance does not have every relation.
+#####################################################################################
+
+def relation_index_path(source, scoring):
+    return f"{os.path.splitext(source)[0]}.best_relation_{scoring}.json"
+
+
+class RelationIndex:
+    def __init__(self, path):
+        with open(path) as f:
+            data = json.load(f)
+        self.path = path
+        self.scoring = data['scoring']
+        self.tokenizer = data['tokenizer']
+        self.max_length = data['max_length']
+        self.strip_sentence = data['strip_sentence']
+        self.relations = tuple(data['relations'])
+        self.dialogues = data['dialogues']
+
+    def matches(self, tokenizer, max_length, strip_sentence, relations):
+        ## token cosine depends on the tokenizer and max_length, embedding similarity does not
+        if self.relations != relations or self.strip_sentence != strip_sentence:
+            return False
+        return self.scoring != 'token' or (self.tokenizer == tokenizer.name_or_path and self.max_length == max_length)
+
+    def best_relations(self, key):
+        ## best relation of each utterance of a dialogue, None where it was not scored
+        return [None if code == '-' else self.relations[int(code)] for code in self.dialogues[key]]
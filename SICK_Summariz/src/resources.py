@@ -0,0 +1,57 @@
+import os
+import threading
+
+
+#####################################################################################
+# Heavy NLP resources (emotion analyzer, spaCy pipeline, ...) shared by every dataset
+# of a process. Each one is loaded on first use only, so runs that never need it do not
+# pay for it. Resources that are not fork safe (torch models possibly living on the GPU)
+# are loaded again inside DataLoader worker processes instead of reusing the parent's copy.
+#####################################################################################
+
+_factories = {}
+_fork_safe = {}
+_resources = {}
+_owner = {}
+_lock = threading.RLock()
+
+
+def register(name, factory, fork_safe=False):
+    _factories[name] = factory
+    _fork_safe[name] = fork_safe
+
+
+def get(name):
+    pid = os.getpid()
+    with _lock:
+        if name in _resources and not _fork_safe[name] and _owner[name] != pid:
+            ## inherited from the parent through fork
+            del _resources[name]
+        if name not in _resources:
+            _resources[name] = _factories[name]()
+            _owner[name] = pid
+        return _resources[name]
+
+
+# We are interested in Emotion analysis task, for English Language
+EMOTION_ANALYZER = {'task': "emotion", 'lang': "en"}
+
+
+def emotion_analyzer_version():
+    ## what the emotion labels depend on: the model pysentimiento picks for the task and language comes with its version
+    from importlib.metadata import version
+    return dict(EMOTION_ANALYZER, pysentimiento=version('pysentimiento'))
+
+
+def _emotion_analyzer():
+    from pysentimiento import create_analyzer
+    return create_analyzer(**EMOTION_ANALYZER)
+
+
+def _spacy_nlp():
+    import spacy
+    return spacy.load('en_core_web_sm')
+
+
+register('emotion_analyzer', _emotion_analyzer)
+register('spacy', _spacy_nlp, fork_safe=True)
@@ -0,0 +1,41 @@
+import re
+
+
+#####################################################################################
+# spaCy sentence segmentation of whole splits. The COMET files of DialogSum / TweetSumm
+# were generated per sentence of each utterance, so the segmentation has to stay the one
+# of the en_core_web_sm parser: only the components the parser needs are kept, the other
+# ones (tagger, lemmatizer, NER, ...) are disabled, and texts are piped in batches.
+#####################################################################################
+
+SENTENCE_PIPES = ('tok2vec', 'parser')
+
+
+def split_dialogues(nlp, dialogues, batch_size=1000, n_process=1):
+    ###########################################################
+    # dialogues: dialogue id -> dialogue text
+    # returns dialogue id -> for each line, the sentences of what the speaker said
+    # (None for lines that do not start with "speaker:")
+    ###########################################################
+    segments = {}
+    lines = []
+    for id, dialogue in dialogues.items():
+        segments[id] = []
+        for line in dialogue.replace('\r\n', '\n').split('\n'):
+            speaker = re.search(".*?:", line)
+            if speaker:
+                text = line.replace(speaker.group(), "").strip()
+                lines.append(text)
+                segments[id].append(text)
+            else:
+                segments[id].append(None)
+
+    texts = list(dict.fromkeys(lines))
+    sentences = {}
+    with nlp.select_pipes(enable=[pipe for pipe in SENTENCE_PIPES if pipe in nlp.pipe_names]):
+        for text, doc in zip(texts, nlp.pipe(texts, batch_size=batch_size, n_process=n_process)):
+            sentences[text] = [sent.text for sent in doc.sents]
+    print(f"split {len(texts)} utterances of {len(dialogues)} dialogues into sentences")
+
+    return {id: [None if text is None else sentences[text] for text in texts_of_dialogue]
+            for id, texts_of_dialogue in segments.items()}
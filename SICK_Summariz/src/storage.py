@@ -0,0 +1,53 @@
+import os
+import shutil
+from contextlib import contextmanager
+
+
+#####################################################################################
+# Helpers shared by the on-disk caches and stores (augmented dialogues, sentence splits,
+# token stores, emotion stores, COMET stores, relation indexes, generation cache, ...).
+# Files are written atomically: to a temporary path next to their destination first,
+# then moved over it with os.replace, so that a reader (or a run interrupted while
+# writing) never sees a partial file, and a file that exists is complete.
+#####################################################################################
+
+## ids / keys passed to one "IN (...)" query, below sqlite's limit on the number of query parameters
+SQLITE_MAX_PARAMETERS = 500
+
+
+@contextmanager
+def atomic_path(path):
+    ## temporary path (file, directory or sqlite database) moved to path once the block completes
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        yield tmp_path
+    except BaseException:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if os.path.isdir(tmp_path) and os.path.isdir(path):
+        ## a directory can only replace an empty one
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def write_atomic(path, mode='w'):
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, mode) as f:
+            yield f
+
+
+def select_in(connection, query, values):
+    ###########################################################
+    # rows of query, whose "IN ({})" is filled with placeholders
+    # for values, SQLITE_MAX_PARAMETERS values at a time
+    ###########################################################
+    values = list(values)
+    rows = []
+    for start in range(0, len(values), SQLITE_MAX_PARAMETERS):
+        chunk = values[start:start + SQLITE_MAX_PARAMETERS]
+        rows.extend(connection.execute(query.format(','.join('?' * len(chunk))), chunk).fetchall())
+    return rows
@@ -0,0 +1,88 @@
+import os
+import json
+import numpy as np
+from storage import atomic_path
+
+
+#####################################################################################
+# Pre-tokenized splits stored as flat memory-mapped arrays.
+# Every field (input_ids, labels, extra_labels, ...) is one int32 file holding the
+# unpadded token ids of all examples back to back, plus an offsets index so that
+# example i of a field is tokens[offsets[i]:offsets[i+1]].
+#####################################################################################
+
+TOKEN_DTYPE = np.int32
+
+
+class TokenStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.fields = self.meta['fields']
+        self.ids = self.meta['ids']
+        self.position = {id: i for i, id in enumerate(self.ids)}
+        self.arrays = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getstate__(self):
+        ## memmaps are reopened in each DataLoader worker instead of being pickled as copies
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
+
+    def open(self):
+        self.arrays = {}
+        for field in self.fields:
+            offsets = np.load(os.path.join(self.path, f"{field}.idx.npy"))
+            if offsets[-1] > 0:
+                # copy-on-write mapping: pages are shared between processes and slices are writable views
+                tokens = np.memmap(os.path.join(self.path, f"{field}.bin"), dtype=TOKEN_DTYPE, mode='c')
+            else:
+                tokens = np.zeros(0, dtype=TOKEN_DTYPE)
+            self.arrays[field] = (tokens, offsets)
+
+    def get(self, field, position):
+        if self.arrays is None:
+            self.open()
+        tokens, offsets = self.arrays[field]
+        return tokens[offsets[position]:offsets[position + 1]]
+
+    def lengths(self, field):
+        if self.arrays is None:
+            self.open()
+        return np.diff(self.arrays[field][1])
+
+
+def build_token_store(dataset, path, batch_size=1000):
+    ###########################################################
+    # tokenize a whole split once, in batches, without padding
+    ###########################################################
+    ## each batch is one call of the (fast) tokenizer, which encodes
+    ## the batch over every core itself: no process pool is needed
+    fields = dataset.text_fields()
+    ids = [dataset.id[index] for index in range(len(dataset))]
+    tokens = {field: [] for field in fields}
+    for start in range(0, len(ids), batch_size):
+        batch = [dataset.get_texts(index) for index in range(start, min(start + batch_size, len(ids)))]
+        for field in fields:
+            encoded = dataset.tokenizer([texts[field] for texts in batch],
+                                        padding=False,
+                                        truncation=True,
+                                        max_length=dataset.max_length(field))
+            tokens[field].extend(encoded['input_ids'])
+        print(f"tokenized {min(start + batch_size, len(ids))}/{len(ids)} {dataset.split_type} examples")
+
+    with atomic_path(path) as tmp_path:
+        os.makedirs(tmp_path, exist_ok=True)
+        for field in fields:
+            offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(t) for t in tokens[field]])
+            flat = np.fromiter((token for t in tokens[field] for token in t), dtype=TOKEN_DTYPE, count=int(offsets[-1]))
+            flat.tofile(os.path.join(tmp_path, f"{field}.bin"))
+            np.save(os.path.join(tmp_path, f"{field}.idx.npy"), offsets)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'fields': fields, 'ids': ids, 'tokenizer': dataset.tokenizer.name_or_path}, f)
+    return TokenStore(path)
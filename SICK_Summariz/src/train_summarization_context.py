@@ -2,6 +2,7 @@ import os
 #os.environ['WANDB_SILENT']="true"
 
 import sys
+sys.path.append('../')
 import argparse
 import random
 import json
@@ -16,6 +17,11 @@ from transformers import Seq2SeqTrainingArguments, Seq2SeqTrainer
 from datasets import load_metric
 #import wandb
 from dataset import SamsumDataset_total, DialogsumDataset_total,  TweetsummDataset_total
+import profiling
+from batching import DynamicPaddingCollator, LengthBucketBatchSampler, TokenBudgetBatchSampler, PackingCollator, PackedBatchSampler
+from arrow_dataset import build_arrow_dataset, arrow_lengths
+from models.bart import BartForConditionalGeneration_Packed
+from src.trainer import BucketedSeq2SeqTrainer
 
 # Set Argument Parser
 parser = argparse.ArgumentParser()
@@ -57,7 +63,24 @@ parser.add_argument('--test_output_file_name',type=str, default='samsum_context_
 parser.add_argument('--relation',type=str,default="xReason")
 parser.add_argument('--supervision_relation',type=str,default='isAfter')
 parser.add_argument('--emotion', type = bool, default = False) #set to true in order to use emotion-aware commonsense
+parser.add_argument('--emotion_context',type=int,default=5) #with --emotion: number of last utterances whose emotion is used for utterances labelled "others"
+parser.add_argument('--cache_dir',type=str,default='') #set to a directory (e.g. ../data/cache) to cache the augmented dialogues on disk
+parser.add_argument('--token_store_dir',type=str,default='') #set to a directory to serve pre-tokenized memory-mapped splits
+parser.add_argument('--relation_index',type=str,default='') #with --relation '<|best_relation|>': token or embedding, to read the best relations from build_relation_index.py
+parser.add_argument('--num_proc',type=int,default=1) #processes used to prepare the splits (spaCy sentence splitting, --arrow_dir maps)
+parser.add_argument('--fit_commonsense',type=bool,default=False) #drop the least useful <I> inserts of dialogues longer than encoder_max_len instead of truncating their tail
+parser.add_argument('--arrow_dir',type=str,default='') #set to a directory to build the train/eval splits with batched datasets.map stages, cached as Arrow files (with --cache_dir '' the augmentation runs in the map processes too)
+parser.add_argument('--emotion_dir',type=str,default='') #set to a directory (e.g. ../data/cache) to precompute the emotion labels in batches with --emotion, instead of predicting them per utterance
+parser.add_argument('--dynamic_padding',type=bool,default=False) #pad each batch to its longest example instead of encoder/decoder_max_len
+parser.add_argument('--bucket_size_multiplier',type=int,default=100) #training batches are length-sorted inside buckets of train_batch_size*bucket_size_multiplier examples
+parser.add_argument('--max_tokens',type=int,default=0) #set to form training batches by a padded token budget over encoder+decoder lengths instead of train_batch_size examples
+parser.add_argument('--packing',type=bool,default=False) #pack several training dialogues into each encoder_max_len row (block-diagonal attention), train_batch_size rows per batch, BART only
+parser.add_argument('--profile',type=str,default='') #set to a .json or .csv file to record the time spent in each data loading stage (COMET lookup, emotion analysis, tokenization, ...)
 args = parser.parse_args()
+if args.profile:
+    profiling.enable()
+## packed and token budget training batches are built from unpadded examples
+args.dynamic_padding = args.dynamic_padding or args.packing or args.max_tokens > 0
 
 
 # Set GPU
@@ -165,34 +188,36 @@ tokenizer.add_special_tokens(special_tokens_dict)
 
 # Set dataset
 if args.dataset_name=='samsum':
-    total_dataset = SamsumDataset_total(args.encoder_max_len,args.decoder_max_len,tokenizer,subset_size = args.subset_size, extra_context=True,paracomet=args.use_paracomet,relation=args.relation,supervision_relation=args.supervision_relation,roberta=args.use_roberta, sentence_transformer=args.use_sentence_transformer,emotion = args.emotion)
+    total_dataset = SamsumDataset_total(args.encoder_max_len,args.decoder_max_len,tokenizer,subset_size = args.subset_size, extra_context=True,paracomet=args.use_paracomet,relation=args.relation,supervision_relation=args.supervision_relation,roberta=args.use_roberta, sentence_transformer=args.use_sentence_transformer,emotion = args.emotion, cache_dir=args.cache_dir, token_store_dir=args.token_store_dir, dynamic_padding=args.dynamic_padding, emotion_dir=args.emotion_dir, relation_index=args.relation_index, num_proc=args.num_proc, fit_commonsense=args.fit_commonsense, emotion_context=args.emotion_context)
     train_dataset = total_dataset.getTrainData()
     eval_dataset = total_dataset.getEvalData()
-    test_dataset = total_dataset.getTestData()
 elif args.dataset_name=='dialogsum':
-    total_dataset = DialogsumDataset_total(args.encoder_max_len,args.decoder_max_len,tokenizer,subset_size = args.subset_size, extra_context=True,paracomet=args.use_paracomet,relation=args.relation,supervision_relation=args.supervision_relation, sentence_transformer=args.use_sentence_transformer, roberta=args.use_roberta, emotion = args.emotion)
+    total_dataset = DialogsumDataset_total(args.encoder_max_len,args.decoder_max_len,tokenizer,subset_size = args.subset_size, extra_context=True,paracomet=args.use_paracomet,relation=args.relation,supervision_relation=args.supervision_relation, sentence_transformer=args.use_sentence_transformer, roberta=args.use_roberta, emotion = args.emotion, cache_dir=args.cache_dir, token_store_dir=args.token_store_dir, dynamic_padding=args.dynamic_padding, emotion_dir=args.emotion_dir, relation_index=args.relation_index, num_proc=args.num_proc, fit_commonsense=args.fit_commonsense, emotion_context=args.emotion_context)
     train_dataset = total_dataset.getTrainData()
     eval_dataset = total_dataset.getEvalData()
-    test_dataset = total_dataset.getTestData()
 elif args.dataset_name=='tweetsumm':
-    total_dataset = TweetsummDataset_total(args.encoder_max_len,args.decoder_max_len,tokenizer,subset_size = args.subset_size, extra_context=True,paracomet=args.use_paracomet,relation=args.relation,supervision_relation=args.supervision_relation, sentence_transformer=args.use_sentence_transformer, roberta=args.use_roberta, emotion = args.emotion)
+    total_dataset = TweetsummDataset_total(args.encoder_max_len,args.decoder_max_len,tokenizer,subset_size = args.subset_size, extra_context=True,paracomet=args.use_paracomet,relation=args.relation,supervision_relation=args.supervision_relation, sentence_transformer=args.use_sentence_transformer, roberta=args.use_roberta, emotion = args.emotion, cache_dir=args.cache_dir, token_store_dir=args.token_store_dir, dynamic_padding=args.dynamic_padding, emotion_dir=args.emotion_dir, relation_index=args.relation_index, num_proc=args.num_proc, fit_commonsense=args.fit_commonsense, emotion_context=args.emotion_context)
     train_dataset = total_dataset.getTrainData()
     eval_dataset = total_dataset.getEvalData()
-    test_dataset = total_dataset.getTestData()
+
+if args.arrow_dir:
+    train_dataset = build_arrow_dataset(train_dataset, args.arrow_dir, num_proc=args.num_proc)
+    eval_dataset = build_arrow_dataset(eval_dataset, args.arrow_dir, num_proc=args.num_proc)
 
 print('######################################################################')
 print('Training Dataset Size is : ')
 print(len(train_dataset))
 print('Validation Dataset Size is : ')
 print(len(eval_dataset))
-print('Test Dataset Size is : ')
-print(len(test_dataset))
 print('######################################################################')
 
 
 # Loading checkpoint of model
 config = AutoConfig.from_pretrained(args.model_name)
-finetune_model = AutoModelForSeq2SeqLM.from_pretrained(args.model_name)
+if args.packing:
+    finetune_model = BartForConditionalGeneration_Packed.from_pretrained(args.model_name)
+else:
+    finetune_model = AutoModelForSeq2SeqLM.from_pretrained(args.model_name)
 print('######################################################################')
 print("Number of Model Parameters are : ",finetune_model.num_parameters())
 print('######################################################################')
@@ -276,18 +301,40 @@ def preprocess_logits_for_metrics(logits, labels):
 
     return logits_reduced
 
-finetune_trainer = Seq2SeqTrainer(
+# Dynamic padding: batches are padded to their longest example and training batches group dialogues of similar length
+# Token budget: training batches hold as many examples as fit in max_tokens padded tokens
+# Sequence packing: training batches are train_batch_size encoder rows holding as many dialogues as fit, evaluation batches are only dynamically padded
+data_collator = None
+train_batch_sampler = None
+train_data_collator = None
+if args.dynamic_padding:
+    data_collator = DynamicPaddingCollator(tokenizer.pad_token_id)
+    train_lengths = arrow_lengths(train_dataset) if args.arrow_dir else train_dataset.lengths()
+    if args.packing:
+        train_data_collator = PackingCollator(tokenizer.pad_token_id, args.encoder_max_len)
+        train_batch_sampler = PackedBatchSampler(train_lengths, args.encoder_max_len, args.train_batch_size, seed=516)
+    elif args.max_tokens > 0:
+        train_batch_sampler = TokenBudgetBatchSampler([train_lengths] + [arrow_lengths(train_dataset, field) if args.arrow_dir else train_dataset.lengths(field) for field in ('labels',)], args.max_tokens, bucket_size=args.train_batch_size*args.bucket_size_multiplier, seed=516)
+    else:
+        train_batch_sampler = LengthBucketBatchSampler(train_lengths, args.train_batch_size, bucket_size_multiplier=args.bucket_size_multiplier, seed=516)
+
+finetune_trainer = BucketedSeq2SeqTrainer(
     model = finetune_model,
     args = finetune_args,
     train_dataset = train_dataset,
     eval_dataset = eval_dataset,
     tokenizer = tokenizer,
+    data_collator = data_collator,
+    train_batch_sampler = train_batch_sampler,
+    train_data_collator = train_data_collator,
     compute_metrics=compute_metrics,
     # preprocess_logits_for_metrics=preprocess_logits_for_metrics
 )
 
 # Run Training (Finetuning)
 finetune_trainer.train()
+if args.profile:
+    profiling.export(args.profile)
 
 
 # Save final weights
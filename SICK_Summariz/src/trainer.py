@@ -29,7 +29,32 @@ class MultilabelTrainer(Trainer):
                         labels.float().view(-1, self.model.config.num_labels))
         return (loss, outputs) if return_outputs else loss
 
-class DialoGPTTrainer(Seq2SeqTrainer):
+# training batches drawn from a batch sampler (e.g. length bucketed) instead of a fixed-size random sampler,
+# optionally collated differently from evaluation batches (e.g. packed, see batching.PackingCollator)
+class BatchSamplerMixin:
+    def __init__(self, *args, train_batch_sampler=None, train_data_collator=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.train_batch_sampler = train_batch_sampler
+        self.train_data_collator = train_data_collator
+
+    def get_train_dataloader(self) -> DataLoader:
+        if self.train_batch_sampler is None:
+            return super().get_train_dataloader()
+        train_dataloader = DataLoader(
+            self.train_dataset,
+            batch_sampler=self.train_batch_sampler,
+            collate_fn=self.train_data_collator or self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+        if hasattr(self, "accelerator"):
+            return self.accelerator.prepare(train_dataloader)
+        return train_dataloader
+
+class BucketedSeq2SeqTrainer(BatchSamplerMixin, Seq2SeqTrainer):
+    pass
+
+class DialoGPTTrainer(BatchSamplerMixin, Seq2SeqTrainer):
     def compute_loss(self, model, inputs, return_outputs=False):
         if model.training:
             labels = inputs.get("labels")
@@ -47,7 +72,7 @@ class DialoGPTTrainer(Seq2SeqTrainer):
 
 
 # trainer used for setting in extra_supervision, full
-class DualDecoderTrainer(Seq2SeqTrainer):
+class DualDecoderTrainer(BatchSamplerMixin, Seq2SeqTrainer):
     def compute_loss(self, model, inputs, return_outputs=False):
         if model.training:
             labels = inputs.get("labels")
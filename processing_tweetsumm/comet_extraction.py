@@ -0,0 +1,239 @@
+# Scripted version of comet.ipynb: COMET-ATOMIC 2020 commonsense of every sentence of the dialogues and summaries.
+# python comet_extraction.py --model_path comet-atomic-2020/models/comet_atomic2020_bart/comet-atomic_2020_BART --data_dir ../SICK_Summariz/data/Tweetsumm_Data --output_dir ../SICK_Summariz/data/COMET_data/comet
+# Writes dialogue/{dataset}/comet_{split}.json and summary/{dataset}/comet_{split}.json in the layout of create_dict.
+# Generation is checkpointed in shards under --work_dir: an interrupted run started again with the same
+# arguments only generates the shards that are missing. --num_workers processes share the shards.
+# Generations are also kept in a cache shared by every corpus (--cache, see SICK_Summariz/src/generation_cache.py):
+# only the (sentence, relation) pairs it does not have yet are generated.
+import os
+import json
+import time
+import hashlib
+import argparse
+import sys
+import multiprocessing
+import torch
+from transformers import AutoTokenizer
+## the batched generation and its cache are shared with the online augmentation of SICK_Summariz/src
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../SICK_Summariz/src'))
+from comet_generation import Comet, cached_results, generate_all, length_sorted, open_cache, query
+from storage import write_atomic
+
+
+#####################################################################################
+# The notebook generated one "{sentence} {rel} [GEN]" query per sentence x relation, in
+# input order and one at a time, so that the sentences repeated across dialogues (greetings,
+# "thanks", ...) were generated again every time. Here the queries of every dialogue and
+# split are deduplicated first, generated in length-sorted batches (comet_generation.py),
+# and the generations are scattered back into the per-dialogue layout of create_dict.
+#####################################################################################
+
+# chosen relations for the dialogs and for the summaries
+DIALOGS_RELATIONS = ['HinderedBy', 'xWant', 'xIntent', 'xNeed', 'xReason']
+SUMMARIES_RELATIONS = ['HinderedBy', 'isAfter', 'isBefore', 'xEffect', 'xNeed']
+## prefix of the dialogue ids in the COMET files, as the datasets look them up
+COMET_SPLIT_PREFIX = {'train': 'train', 'validation': 'dev', 'test': 'test'}
+
+
+def sentences_of(element, is_dialog):
+    return element['sentence'] if is_dialog else element
+
+
+def collect_queries(data, relations, is_dialog=True):
+    ###########################################################
+    # data: split -> dialogue id -> dialogue (or summary)
+    # returns the unique queries of every split, in first-seen
+    # order, each with its (sentence, relation)
+    ###########################################################
+    queries = {}
+    for dialogs in data.values():
+        for dialog in dialogs.values():
+            if dialog is None:
+                continue
+            for element in dialog:
+                sentence = sentences_of(element, is_dialog)
+                for rel in relations:
+                    queries.setdefault(query(sentence, rel), (sentence, rel))
+    return queries
+
+
+def create_dict(results, dialogs, relations, is_dialog=True, split=None):
+    ###########################################################
+    # per-dialogue layout of the notebook: for each sentence
+    # {'sentence', one entry per relation, 'speaker' for dialogs}
+    ###########################################################
+    dialogs_results = {}
+    for sample, dialog in dialogs.items():
+        if dialog is None:
+            continue
+        if split is not None and sample.startswith(f'{split}_'):
+            sample = COMET_SPLIT_PREFIX[split] + sample[len(split):]
+        dialogs_results[sample] = []
+        for element in dialog:
+            sentence = sentences_of(element, is_dialog)
+            result_dict = {'sentence': sentence}
+            for rel in relations:
+                result_dict[rel] = results[query(sentence, rel)]
+            if is_dialog:
+                result_dict['speaker'] = element['author_id']
+            dialogs_results[sample].append(result_dict)
+    return dialogs_results
+
+
+def extract_commonsense(comet, data, relations, is_dialog=True, batch_size=32, num_generate=5, cache=None):
+    ## data: split -> dialogue id -> dialogue (or summary); returns split -> COMET file content
+    queries = collect_queries(data, relations, is_dialog)
+    total = sum(len(dialog) * len(relations) for dialogs in data.values() for dialog in dialogs.values() if dialog is not None)
+    print(f"{len(queries)} unique queries out of {total}")
+    results = cached_results(cache, queries)
+    generated = generate_all(comet, [query for query in queries if query not in results], batch_size, num_generate)
+    if cache is not None:
+        cache.put_many({queries[query]: generations for query, generations in generated.items()})
+    results.update(generated)
+    return {split: create_dict(results, dialogs, relations, is_dialog, split) for split, dialogs in data.items()}
+
+
+#####################################################################################
+# Checkpointed generation. The unique queries, in length order, are cut into shards of
+# shard_size queries, and the generations of each shard are written to their own file,
+# atomically (storage.write_atomic): a shard file that exists is complete.
+# The shard plan is stored with the shards, in a directory named by the hash of the
+# queries and of the generation settings, so that a restart with the same inputs resumes
+# where it stopped and different inputs never mix with earlier shards. Workers take the
+# shards i with i % num_workers == rank, and the shards are merged into the COMET files
+# once they are all done.
+#####################################################################################
+
+
+def write_json(data, path):
+    with write_atomic(path) as json_file:
+        json.dump(data, json_file)
+
+
+def shard_path(shard_dir, shard):
+    return os.path.join(shard_dir, f'shard_{shard:05d}.json')
+
+
+def plan_shards(queries, tokenizer, work_dir, data_type, model_path, num_generate=5):
+    ## directory of the shards of these queries, with plan.json: the queries in generation order
+    key = hashlib.sha1(json.dumps({'queries': sorted(queries), 'model': os.path.abspath(model_path), 'num_generate': num_generate}).encode()).hexdigest()[:16]
+    shard_dir = os.path.join(work_dir, f'{data_type}_{key}')
+    path = os.path.join(shard_dir, 'plan.json')
+    if not os.path.exists(path):
+        os.makedirs(shard_dir, exist_ok=True)
+        write_json(length_sorted(queries, tokenizer), path)
+    return shard_dir
+
+
+def load_plan(shard_dir):
+    with open(os.path.join(shard_dir, 'plan.json')) as json_file:
+        return json.load(json_file)
+
+
+def missing_shards(shard_dir, shard_size):
+    num_shards = (len(load_plan(shard_dir)) + shard_size - 1) // shard_size
+    return [shard for shard in range(num_shards) if not os.path.exists(shard_path(shard_dir, shard))]
+
+
+def run_shards(rank, num_workers, shard_dir, model_path, shard_size, batch_size=32, num_generate=5, device='cpu'):
+    ###########################################################
+    # generate the missing shards of worker rank of num_workers
+    ###########################################################
+    shards = [shard for shard in missing_shards(shard_dir, shard_size) if shard % num_workers == rank]
+    if not shards:
+        return
+    if num_workers > 1 and device == 'cpu':
+        ## the cores are shared by the workers
+        torch.set_num_threads(max(1, os.cpu_count() // num_workers))
+    comet = Comet(model_path, device)
+    queries = load_plan(shard_dir)
+    for done, shard in enumerate(shards, 1):
+        start = time.perf_counter()
+        shard_queries = queries[shard * shard_size:(shard + 1) * shard_size]
+        results = {}
+        for batch_start in range(0, len(shard_queries), batch_size):
+            batch = shard_queries[batch_start:batch_start + batch_size]
+            results.update(zip(batch, comet.generate(batch, num_generate=num_generate)))
+        write_json(results, shard_path(shard_dir, shard))
+        print(f"worker {rank}: shard {shard} done in {time.perf_counter() - start:.1f}s ({done}/{len(shards)})")
+
+
+def merge_shards(shard_dir, shard_size):
+    ## query -> generations of every shard
+    missing = missing_shards(shard_dir, shard_size)
+    if missing:
+        raise RuntimeError(f"{len(missing)} shards of {shard_dir} are not generated yet, e.g. {missing[:5]}")
+    results = {}
+    num_shards = (len(load_plan(shard_dir)) + shard_size - 1) // shard_size
+    for shard in range(num_shards):
+        with open(shard_path(shard_dir, shard)) as json_file:
+            results.update(json.load(json_file))
+    return results
+
+
+def extract_commonsense_sharded(data, relations, is_dialog, data_type, args, cache=None):
+    ## extract_commonsense, checkpointed in shards and over args.num_workers processes
+    queries = collect_queries(data, relations, is_dialog)
+    total = sum(len(dialog) * len(relations) for dialogs in data.values() for dialog in dialogs.values() if dialog is not None)
+    print(f"{len(queries)} unique queries out of {total}")
+    results = cached_results(cache, queries)
+    to_generate = [query for query in queries if query not in results]
+    if to_generate:
+        generated = generate_sharded(to_generate, data_type, args)
+        if cache is not None:
+            cache.put_many({queries[query]: generations for query, generations in generated.items()})
+        results.update(generated)
+    return {split: create_dict(results, dialogs, relations, is_dialog, split) for split, dialogs in data.items()}
+
+
+def generate_sharded(queries, data_type, args):
+    ## query -> generations, through the shards of these queries
+    shard_dir = plan_shards(queries, AutoTokenizer.from_pretrained(args.model_path), args.work_dir, data_type, args.model_path, args.num_generate)
+    missing = missing_shards(shard_dir, args.shard_size)
+    print(f"{len(missing)} shards of {args.shard_size} queries to generate in {shard_dir}")
+    worker_args = [(rank, args.num_workers, shard_dir, args.model_path, args.shard_size, args.batch_size, args.num_generate, args.device)
+                   for rank in range(args.num_workers)]
+    if args.num_workers > 1 and missing:
+        ## spawned, torch is not fork safe
+        workers = [multiprocessing.get_context('spawn').Process(target=run_shards, args=arguments) for arguments in worker_args]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    elif missing:
+        run_shards(*worker_args[0])
+    return merge_shards(shard_dir, args.shard_size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default='comet-atomic-2020/models/comet_atomic2020_bart/comet-atomic_2020_BART')
+    parser.add_argument('--data_dir', type=str, default='../SICK_Summariz/data/Tweetsumm_Data') #{split}_dialogs.json and {split}_summaries.json of preprocess_tweetsumm.py
+    parser.add_argument('--output_dir', type=str, default='../SICK_Summariz/data/COMET_data/comet')
+    parser.add_argument('--work_dir', type=str, default='../SICK_Summariz/data/COMET_data/shards') #where the generated shards are checkpointed
+    parser.add_argument('--dataset_name', type=str, default='tweetsumm')
+    parser.add_argument('--splits', type=str, nargs='+', default=['train', 'validation', 'test'])
+    parser.add_argument('--batch_size', type=int, default=32) #queries generated at a time
+    parser.add_argument('--shard_size', type=int, default=1000) #queries per checkpointed shard
+    parser.add_argument('--num_workers', type=int, default=1) #processes generating disjoint shards, each with its own model
+    parser.add_argument('--num_generate', type=int, default=5)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--cache', type=str, default='../SICK_Summariz/data/COMET_data/generation_cache.sqlite') #generations shared by every corpus and run, '' to disable
+    parser.add_argument('--cache_max_mb', type=int, default=2048) #least recently used generations are evicted past this size
+    parser.add_argument('--model_id', type=str, default='') #name of the model in the cache, the name of --model_path by default
+    args = parser.parse_args()
+    cache = open_cache(args.cache, args.model_path, args.num_generate, args.cache_max_mb, args.model_id) if args.cache else None
+
+    for data_type, folder, relations, is_dialog in (('dialogs', 'dialogue', DIALOGS_RELATIONS, True),
+                                                     ('summaries', 'summary', SUMMARIES_RELATIONS, False)):
+        data = {}
+        for split in args.splits:
+            with open(os.path.join(args.data_dir, f'{split}_{data_type}.json')) as json_file:
+                data[split] = json.load(json_file)
+        print(f'generating commonsense for {data_type}...')
+        results = extract_commonsense_sharded(data, relations, is_dialog, data_type, args, cache)
+        os.makedirs(os.path.join(args.output_dir, folder, args.dataset_name), exist_ok=True)
+        for split, split_results in results.items():
+            file_path = os.path.join(args.output_dir, folder, args.dataset_name, f'comet_{split}.json')
+            write_json(split_results, file_path)
+            print(f"JSON file saved to {file_path}")
@@ -0,0 +1,103 @@
+# Scripted version of preprocessing.ipynb: rebuild the TweetSumm dialogues from twcs.csv in one pass.
+# python preprocess_tweetsumm.py --tweets datasets/all_tweets/twcs.csv --tweetsumm_dir datasets/tweetsumm --output_dir ../SICK_Summariz/data/Tweetsumm_Data
+# Writes {split}_dialogs.json and {split}_summaries.json for train, validation and test, keyed {split}_{i}
+# as custom_load_dataset('tweetsumm', split) reads them.
+import os
+import re
+import json
+import argparse
+import pandas as pd
+import nltk
+from nltk.tokenize import sent_tokenize
+from tqdm import tqdm
+
+
+#####################################################################################
+# twcs.csv (millions of tweets) is read in chunks, and only the tweets referenced by the
+# TweetSumm .jsonl files are kept: their URLs are removed and they are split into sentences
+# once, into a hash index tweet_id -> (author_id, sentences). Every dialogue is then a
+# sequence of lookups in that index instead of two scans of the whole DataFrame per tweet.
+#####################################################################################
+
+SPLIT_FILES = {'train': 'train_tweetsum.jsonl', 'validation': 'valid_tweetsum.jsonl', 'test': 'test_tweetsum.jsonl'}
+
+
+# function to remove URLs from text
+def remove_urls(text):
+    url_pattern = re.compile(r'https?://\S+')
+    return url_pattern.sub('', text)
+
+
+def read_conversations(path):
+    conversations = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                conversations.append(json.loads(line))
+    return conversations
+
+
+def build_tweet_index(tweets_path, tweet_ids, chunksize=200000):
+    ###########################################################
+    # tweet_id -> (author_id, sentences) of the tweets in tweet_ids
+    ###########################################################
+    index = {}
+    with tqdm(desc="reading tweets", unit=" tweets") as progress:
+        for chunk in pd.read_csv(tweets_path, usecols=['tweet_id', 'author_id', 'text'], chunksize=chunksize):
+            progress.update(len(chunk))
+            chunk = chunk[chunk['tweet_id'].isin(tweet_ids)]
+            for tweet_id, author_id, text in zip(chunk['tweet_id'], chunk['author_id'], chunk['text']):
+                index[int(tweet_id)] = (str(author_id), sent_tokenize(remove_urls(str(text))))
+            if len(index) == len(tweet_ids):
+                ## every tweet needed is found, the rest of the file is not read
+                break
+    return index
+
+
+def retrieve_dialogue(conversation, index):
+    dialog = []
+    for dic in conversation['tweet_ids_sentence_offset']:
+        author_id, sentences = index[dic['tweet_id']]
+        for sentence in sentences:
+            dialog.append({'sentence': sentence, 'author_id': author_id})
+    return dialog
+
+
+def retrieve_summary(conversation):
+    # only one summary per dialogue
+    return conversation['annotations'][0]['abstractive']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tweets', type=str, default='datasets/all_tweets/twcs.csv') #Customer Support on Twitter dataset
+    parser.add_argument('--tweetsumm_dir', type=str, default='datasets/tweetsumm') #train_tweetsum.jsonl, valid_tweetsum.jsonl and test_tweetsum.jsonl
+    parser.add_argument('--output_dir', type=str, default='../SICK_Summariz/data/Tweetsumm_Data')
+    parser.add_argument('--chunksize', type=int, default=200000) #rows of twcs.csv read at a time
+    args = parser.parse_args()
+
+    ## punkt_tab for recent nltk versions
+    for resource in ('punkt', 'punkt_tab'):
+        nltk.download(resource, quiet=True)
+    splits = {split: read_conversations(os.path.join(args.tweetsumm_dir, file)) for split, file in SPLIT_FILES.items()}
+    for split, conversations in splits.items():
+        print(f'number of {split} dialogues: ', len(conversations))
+
+    tweet_ids = {dic['tweet_id'] for conversations in splits.values() for conversation in conversations for dic in conversation['tweet_ids_sentence_offset']}
+    index = build_tweet_index(args.tweets, tweet_ids, args.chunksize)
+    missing = tweet_ids - index.keys()
+    if missing:
+        raise KeyError(f"{len(missing)} TweetSumm tweets are not in {args.tweets}, e.g. {sorted(missing)[:5]}")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for split, conversations in splits.items():
+        dialogs = {}
+        summaries = {}
+        for i, conversation in enumerate(conversations):
+            dialogs[f'{split}_{i}'] = retrieve_dialogue(conversation, index)
+            summaries[f'{split}_{i}'] = retrieve_summary(conversation)
+        for name, data in (('dialogs', dialogs), ('summaries', summaries)):
+            file_path = os.path.join(args.output_dir, f'{split}_{name}.json')
+            with open(file_path, 'w') as json_file:
+                json.dump(data, json_file)
+            print(f'file saved at {file_path}')